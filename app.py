@@ -209,19 +209,24 @@ celery.conf.update(app.config)
 # --- Import and Register Blueprints ---
 from blueprints.aws_panel import aws_bp
 from blueprints.azure_panel import azure_bp, init_db as init_azure_db
-from blueprints.oci_panel import oci_bp, init_db as init_oci_db, recover_snatching_tasks
+from blueprints.oci_panel import oci_bp, init_db as init_oci_db, recover_snatching_tasks, resume_dns_outbox, resume_tg_notifications
 from blueprints.api_bp import api_bp
+from blueprints.metrics_bp import metrics_bp, init_app as init_metrics
 
 app.register_blueprint(aws_bp, url_prefix='/aws')
 app.register_blueprint(azure_bp, url_prefix='/azure')
 app.register_blueprint(oci_bp, url_prefix='/oci')
 app.register_blueprint(api_bp, url_prefix='/api/v1/oci')
+app.register_blueprint(metrics_bp)
+init_metrics(app)
 
 @worker_ready.connect
 def on_worker_ready(**kwargs):
     print("Celery worker is ready. Running OCI task recovery check...")
     with app.app_context():
         recover_snatching_tasks()
+        resume_dns_outbox()
+        resume_tg_notifications()
 
 # --- MFA Helper Functions ---
 def get_mfa_secret():
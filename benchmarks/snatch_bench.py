@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+抢占引擎压测脚本。
+
+在进程内用模拟的 OCI compute / identity / vnet 客户端驱动真实的 _snatch_instance_task
+(或组抢占 _snatch_group_task) 与调度器，统计不同并发规模下的：
+尝试速率、每次尝试的 SQLite 读写次数、线程数峰值、抢占成功耗时分位数。
+
+在容器内运行 (需要完整依赖)：
+    docker compose exec worker python benchmarks/snatch_bench.py
+    docker compose exec worker python benchmarks/snatch_bench.py --tasks 10 100 --capacity-rate 0.95 --throttle-rate 0.02
+
+默认不连接 Redis (限流、缓存与控制通道均使用进程内退化逻辑)，并在临时目录中使用独立的数据库，
+不会触碰正式数据。加 --redis 可连接 REDIS_URL 测试共享限流 (会写入 oci:* 键)。
+"""
+
+import os, sys, json, time, uuid, random, argparse, tempfile, threading, logging, statistics, datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="抢占引擎压测 (模拟 OCI 后端)")
+    parser.add_argument('--tasks', type=int, nargs='+', default=[10, 100, 1000], help="每轮并发任务数")
+    parser.add_argument('--accounts', type=int, default=10, help="任务平均分配到的模拟账号数 (每个账号独立租户)")
+    parser.add_argument('--capacity-rate', type=float, default=0.9, help="launch 返回 Out of host capacity 的概率")
+    parser.add_argument('--throttle-rate', type=float, default=0.05, help="launch 返回 429 TooManyRequests 的概率")
+    parser.add_argument('--latency-ms', type=float, default=200, help="模拟 API 平均延迟 (毫秒，实际在 0.5x~1.5x 之间浮动)")
+    parser.add_argument('--min-delay', type=int, default=1, help="任务两次尝试之间的最小间隔 (秒)")
+    parser.add_argument('--max-delay', type=int, default=3, help="任务两次尝试之间的最大间隔 (秒)")
+    parser.add_argument('--launch-rate', type=float, default=None, help="覆盖 OCI_LAUNCH_RATE (每租户每秒令牌数)")
+    parser.add_argument('--launch-burst', type=float, default=None, help="覆盖 OCI_LAUNCH_BURST")
+    parser.add_argument('--group-size', type=int, default=1, help="大于 1 时按组抢占派发，每组的槽位数")
+    parser.add_argument('--max-seconds', type=float, default=300, help="每轮最长运行时间，超时后停止剩余任务")
+    parser.add_argument('--redis', action='store_true', help="使用 REDIS_URL 中的 Redis，而不是进程内退化逻辑")
+    parser.add_argument('--json', action='store_true', help="以 JSON 输出结果，便于与历史结果比较")
+    parser.add_argument('--verbose', action='store_true', help="输出面板自身的日志")
+    return parser.parse_args()
+
+
+# --- 模拟 OCI 后端 ---
+class FakeObject:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeBackend:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.launches = 0
+
+    def latency(self):
+        time.sleep(self.args.latency_ms / 1000.0 * random.uniform(0.5, 1.5))
+
+    def response(self, operation, data):
+        import oci
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        self.latency()
+        return oci.response.Response(200, {}, data, None)
+
+    def clients(self, profile_config):
+        return {
+            "identity": FakeIdentityClient(self),
+            "compute": FakeComputeClient(self),
+            "vnet": FakeVnetClient(self),
+            "bs": None,
+        }
+
+
+class FakeIdentityClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def list_availability_domains(self, compartment_id, **kwargs):
+        return self.backend.response('ListAvailabilityDomains', [FakeObject(name=f"bench:AP-BENCH-1-AD-{i}") for i in (1, 2, 3)])
+
+
+class FakeVnetClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get_subnet(self, subnet_id, **kwargs):
+        return self.backend.response('GetSubnet', FakeObject(id=subnet_id, lifecycle_state='AVAILABLE'))
+
+
+class FakeComputeClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def list_images(self, compartment_id, **kwargs):
+        return self.backend.response('ListImages', [FakeObject(id="ocid1.image.bench")])
+
+    def create_compute_capacity_report(self, details, **kwargs):
+        status = 'OUT_OF_HOST_CAPACITY' if random.random() < self.backend.args.capacity_rate else 'AVAILABLE'
+        report = FakeObject(shape_availabilities=[FakeObject(availability_status=status)])
+        return self.backend.response('CreateComputeCapacityReport', report)
+
+    def launch_instance(self, launch_details, **kwargs):
+        from oci.exceptions import ServiceError
+        args = self.backend.args
+        with self.backend.lock:
+            self.backend.launches += 1
+            self.backend.calls['LaunchInstance'] = self.backend.calls.get('LaunchInstance', 0) + 1
+        self.backend.latency()
+        roll = random.random()
+        if roll < args.throttle_rate:
+            raise ServiceError(429, "TooManyRequests", {}, "Too many requests for the user")
+        if roll < args.throttle_rate + args.capacity_rate:
+            raise ServiceError(500, "InternalError", {}, "Out of host capacity.")
+        instance = FakeObject(id=f"ocid1.instance.bench.{uuid.uuid4().hex[:12]}", display_name=launch_details.display_name)
+        import oci
+        return oci.response.Response(200, {}, instance, None)
+
+
+# --- 统计 ---
+class BenchStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.db_writes = 0
+        self.db_reads = 0
+        self.started_at = {}
+        self.succeeded_at = {}
+        self.peak_threads = threading.active_count()
+
+    def reset(self):
+        with self.lock:
+            self.db_writes = self.db_reads = 0
+            self.started_at.clear()
+            self.succeeded_at.clear()
+            self.peak_threads = threading.active_count()
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def install_instrumentation(oci_panel, backend, stats):
+    original_execute = oci_panel._db_execute_celery
+    original_query = oci_panel.query_db
+
+    def counted_execute(query, params=(), task_id=None):
+        with stats.lock:
+            stats.db_writes += 1
+        return original_execute(query, params, task_id=task_id)
+
+    def counted_query(query, args=(), one=False):
+        with stats.lock:
+            stats.db_reads += 1
+        return original_query(query, args, one)
+
+    class BenchPostLaunch:
+        """替代置备流水线：只记录成功时间并结束任务，不计入抢占阶段的数据库读写。"""
+        @staticmethod
+        def delay(task_id, profile_config, alias, details, status_data):
+            with stats.lock:
+                stats.succeeded_at[task_id] = time.time()
+            original_execute('UPDATE tasks SET status = ?, completed_at = ? WHERE id = ?',
+                             ('success', datetime.datetime.now(datetime.timezone.utc).isoformat(), task_id))
+
+    oci_panel._db_execute_celery = counted_execute
+    oci_panel.query_db = counted_query
+    oci_panel._snatch_post_launch_task = BenchPostLaunch
+    oci_panel.get_oci_clients = lambda profile_config, validate=True: (backend.clients(profile_config), None)
+
+
+def write_profiles(accounts):
+    profiles = {}
+    for i in range(accounts):
+        alias = f"bench-{i}"
+        profiles[alias] = {
+            "user": f"ocid1.user.bench.{i}",
+            "tenancy": f"ocid1.tenancy.bench.{i}",
+            "region": "ap-bench-1",
+            "fingerprint": "00:00",
+            "key_content": "bench",
+            "default_subnet_ocid": f"ocid1.subnet.bench.{i}",
+        }
+    with open("oci_profiles.json", "w", encoding="utf-8") as f:
+        json.dump({"profiles": profiles, "profile_order": list(profiles)}, f)
+    return profiles
+
+
+def run_round(oci_panel, args, profiles, stats, task_count):
+    stats.reset()
+    backend_launches_before = BACKEND.launches
+    aliases = list(profiles)
+    details_template = {
+        "display_name_prefix": "bench",
+        "shape": "VM.Standard.A1.Flex",
+        "ocpus": 1,
+        "memory_in_gbs": 6,
+        "boot_volume_size": 50,
+        "os_name_version": "Canonical Ubuntu-22.04",
+        "custom_ssh_key": "ssh-ed25519 AAAA bench",
+        "startup_script": "",
+        "min_delay": args.min_delay,
+        "max_delay": args.max_delay,
+    }
+
+    tasks = []
+    db = oci_panel.get_db_connection()
+    now_iso = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    for i in range(task_count):
+        task_id = str(uuid.uuid4())
+        alias = aliases[i % len(aliases)]
+        db.execute('INSERT INTO tasks (id, type, name, status, result, created_at, account_alias) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   (task_id, 'snatch', f"bench-{i}", 'pending', '', now_iso, alias))
+        tasks.append((task_id, alias, dict(details_template, display_name_prefix=f"bench-{i}")))
+    db.commit()
+    db.close()
+
+    round_start = time.time()
+    if args.group_size > 1:
+        by_alias = {}
+        for task_id, alias, details in tasks:
+            by_alias.setdefault(alias, []).append((task_id, details))
+        for alias, slots in by_alias.items():
+            for start in range(0, len(slots), args.group_size):
+                chunk = slots[start:start + args.group_size]
+                group_id = str(uuid.uuid4())
+                for task_id, details in chunk:
+                    details['group_id'] = group_id
+                    stats.started_at[task_id] = time.time()
+                oci_panel._snatch_group_task(group_id, profiles[alias], alias,
+                                             [[task_id, details, str(uuid.uuid4())] for task_id, details in chunk])
+    else:
+        for task_id, alias, details in tasks:
+            stats.started_at[task_id] = time.time()
+            oci_panel._snatch_instance_task(task_id, profiles[alias], alias, details, str(uuid.uuid4()))
+    dispatch_seconds = time.time() - round_start
+
+    while time.time() - round_start < args.max_seconds:
+        with stats.lock:
+            done = len(stats.succeeded_at)
+            stats.peak_threads = max(stats.peak_threads, threading.active_count())
+        if done >= task_count:
+            break
+        time.sleep(0.2)
+    duration = time.time() - round_start
+
+    # 停止未完成的任务，让调度器把它们清出队列
+    for task_id, _, _ in tasks:
+        if task_id not in stats.succeeded_at:
+            oci_panel.publish_snatch_control(task_id, 'stop')
+    oci_panel._snatch_scheduler.wake()
+
+    attempts = BACKEND.launches - backend_launches_before
+    tts = [stats.succeeded_at[t] - stats.started_at[t] for t in stats.succeeded_at if t in stats.started_at]
+    return {
+        "tasks": task_count,
+        "accounts": len(aliases),
+        "group_size": args.group_size,
+        "succeeded": len(stats.succeeded_at),
+        "duration_s": round(duration, 2),
+        "dispatch_s": round(dispatch_seconds, 2),
+        "attempts": attempts,
+        "attempts_per_s": round(attempts / duration, 2) if duration else 0,
+        "db_writes_per_attempt": round(stats.db_writes / attempts, 2) if attempts else None,
+        "db_reads_per_attempt": round(stats.db_reads / attempts, 2) if attempts else None,
+        "peak_threads": stats.peak_threads,
+        "tts_p50_s": _round(percentile(tts, 50)),
+        "tts_p90_s": _round(percentile(tts, 90)),
+        "tts_p99_s": _round(percentile(tts, 99)),
+        "tts_mean_s": _round(statistics.mean(tts)) if tts else None,
+    }
+
+
+def _round(value):
+    return round(value, 2) if value is not None else None
+
+
+def print_table(results):
+    columns = ["tasks", "succeeded", "duration_s", "attempts", "attempts_per_s", "db_writes_per_attempt",
+               "db_reads_per_attempt", "peak_threads", "tts_p50_s", "tts_p90_s", "tts_p99_s"]
+    widths = [max(len(c), *(len(str(r[c])) for r in results)) for c in columns]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in results:
+        print("  ".join(str(r[c]).ljust(w) for c, w in zip(columns, widths)))
+
+
+BACKEND = None
+
+
+def main():
+    global BACKEND
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+
+    workdir = tempfile.mkdtemp(prefix="snatch-bench-")
+    sys.path.insert(0, REPO_ROOT)
+    os.chdir(workdir)
+
+    import app  # noqa: F401  先导入 app，蓝图模块依赖其中的 celery / redis_client
+    from blueprints import oci_panel, metrics_bp
+    if not args.redis:
+        oci_panel.redis_client = None
+        metrics_bp.redis_client = None
+    if args.launch_rate is not None:
+        oci_panel.OCI_LAUNCH_RATE = args.launch_rate
+        oci_panel.OCI_LAUNCH_RATE_MAX = max(oci_panel.OCI_LAUNCH_RATE_MAX, args.launch_rate)
+    if args.launch_burst is not None:
+        oci_panel.OCI_LAUNCH_BURST = args.launch_burst
+
+    BACKEND = FakeBackend(args)
+    stats = BenchStats()
+    profiles = write_profiles(args.accounts)
+    install_instrumentation(oci_panel, BACKEND, stats)
+
+    results = []
+    for task_count in args.tasks:
+        if not args.json:
+            print(f"--- {task_count} 个任务 / {args.accounts} 个账号 ---", flush=True)
+        results.append(run_round(oci_panel, args, profiles, stats, task_count))
+
+    if args.json:
+        print(json.dumps({"config": vars(args), "api_calls": BACKEND.calls, "results": results}, ensure_ascii=False, indent=2))
+    else:
+        print()
+        print_table(results)
+        print(f"\nAPI 调用次数: {json.dumps(BACKEND.calls)}")
+        print(f"工作目录: {workdir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ import uuid
 from flask import Blueprint, request, jsonify, current_app
 from functools import wraps
 from app import celery
+from .metrics_bp import TimedSQLiteConnection
 
 # 导入需要暴露给API的任务
 from .oci_panel import (
@@ -16,6 +17,12 @@ from .oci_panel import (
     _snatch_instance_task,
     _create_task_entry,
     _ensure_subnet_in_profile,
+    _validate_bulk_actions,
+    _create_bulk_action_task,
+    _validate_ip_rotation,
+    _create_ip_rotation_task,
+    _batch_task_statuses,
+    _parse_task_ids,
     oci
 )
 from .azure_panel import (
@@ -42,7 +49,7 @@ def get_api_key():
         return None
 
 def query_db_api(query, args=(), one=False):
-    conn = sqlite3.connect(DATABASE, timeout=10)
+    conn = sqlite3.connect(DATABASE, timeout=10, factory=TimedSQLiteConnection)
     conn.row_factory = sqlite3.Row
     cur = conn.execute(query, args)
     rv = cur.fetchall()
@@ -179,6 +186,26 @@ def instance_action_for_alias(alias):
 
     return jsonify({"success": True, "message": f"Action '{action}' for instance '{instance_id}' has been queued.", "task_id": task_id}), 202
 
+@api_bp.route('/bulk-instance-action', methods=['POST'])
+@require_api_key
+def bulk_instance_action():
+    data = request.json or {}
+    items, error = _validate_bulk_actions(data.get('actions'), load_profiles().get("profiles", {}))
+    if error:
+        return jsonify({"error": error}), 400
+    task_id = _create_bulk_action_task(items, 'bot')
+    return jsonify({"success": True, "message": f"{len(items)} actions have been queued.", "task_id": task_id}), 202
+
+@api_bp.route('/bulk-rotate-ip', methods=['POST'])
+@require_api_key
+def bulk_rotate_ip():
+    data = request.json or {}
+    items, error = _validate_ip_rotation(data.get('instances'), load_profiles().get("profiles", {}))
+    if error:
+        return jsonify({"error": error}), 400
+    task_id = _create_ip_rotation_task(items, 'bot', data.get('update_dns', True))
+    return jsonify({"success": True, "message": f"IP rotation for {len(items)} instances has been queued.", "task_id": task_id}), 202
+
 @api_bp.route('/<string:alias>/snatch-instance', methods=['POST'])
 @require_api_key
 def snatch_instance_for_alias(alias):
@@ -201,6 +228,17 @@ def snatch_instance_for_alias(alias):
 
     return jsonify({"success": True, "message": "抢占实例任务已提交...", "task_id": task_id}), 202
 
+@api_bp.route('/task-status/batch', methods=['POST'])
+@require_api_key
+def batch_task_status():
+    task_ids, error = _parse_task_ids(request.json)
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        return jsonify(_batch_task_statuses(task_ids, celery_fallback=True))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @api_bp.route('/task-status/<string:task_id>', methods=['GET'])
 @require_api_key
 def get_task_status(task_id):
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
-import boto3, os, threading, time, queue, json, logging, math
+import boto3, os, threading, time, queue, json, logging, math, hashlib, tempfile
 from botocore.exceptions import ClientError
 from botocore.config import Config
 from flask import Blueprint, render_template, jsonify, request, session, g, redirect, url_for, current_app
 from functools import wraps
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .metrics_bp import metrics
+from .task_events import publish_task_event
+from app import redis_client
 
 # --- Blueprint Setup ---
 aws_bp = Blueprint('aws', __name__, template_folder='../templates', static_folder='../static')
@@ -24,6 +29,25 @@ REGION_MAPPING = {
 }
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(name)s:%(message)s')
 task_logs = {}
+# 任务日志写入 Redis 列表，任意 gunicorn worker 都能按偏移量读取，并按序号推送给浏览器；没有 Redis 时才使用进程内队列
+AWS_TASK_LOG_TTL = 3600
+# 全区域查询的并发区域数与单个区域的查询时限 (秒)
+AWS_QUERY_MAX_WORKERS = int(os.environ.get('AWS_QUERY_MAX_WORKERS', 8))
+AWS_REGION_QUERY_TIMEOUT = int(os.environ.get('AWS_REGION_QUERY_TIMEOUT', 60))
+ACTIVE_INSTANCE_STATES = ['pending', 'running', 'stopped']
+AWS_CLIENT_CACHE_SIZE = int(os.environ.get('AWS_CLIENT_CACHE_SIZE', 128))
+# 目录类数据 (区域、镜像、套餐、实例类型) 的磁盘缓存目录与各目录的 TTL (秒)
+AWS_CATALOG_CACHE_DIR = os.environ.get('AWS_CATALOG_CACHE_DIR', 'aws_catalog_cache')
+CATALOG_TTLS = {
+    'regions': 3600,              # 账户的区域及开通状态，激活区域后主动失效；激活中使用 AWS_REGIONS_PENDING_TTL
+    'lightsail_regions': 86400,
+    'debian_ami': 6 * 3600,       # Debian 官方会定期发布新 AMI
+    'lightsail_blueprint': 6 * 3600,
+    'lightsail_bundles': 86400,
+    'instance_types': 86400,
+}
+# 有区域处于 enabling / disabling 时，区域列表只缓存这么久 (秒)，激活完成后面板能及时看到
+AWS_REGIONS_PENDING_TTL = int(os.environ.get('AWS_REGIONS_PENDING_TTL', 60))
 
 # --- DB and Helpers ---
 def init_db():
@@ -35,6 +59,184 @@ def init_db():
     logging.info("AWS dummy database initialized.")
 
 def get_boto_config(): return Config(connect_timeout=15, retries={'max_attempts': 2})
+
+# --- boto3 客户端缓存 ---
+# 创建客户端要加载服务模型，开销较大；客户端本身是线程安全的，按 (账户, 区域, 服务, 配置) 复用，LRU 淘汰。
+# 默认 Session 创建客户端不是线程安全的，所以创建过程也放在锁内。
+_client_cache = OrderedDict()
+_client_cache_lock = threading.Lock()
+
+def get_client(service, region, access_key, secret_key, read_timeout=None):
+    # secret 也作为键的一部分，账户密钥更新后不会继续使用旧客户端
+    key = (access_key, secret_key, region, service, read_timeout)
+    with _client_cache_lock:
+        client = _client_cache.get(key)
+        if client is not None:
+            _client_cache.move_to_end(key)
+            return client
+        config = get_boto_config()
+        if read_timeout is not None:
+            config = config.merge(Config(read_timeout=read_timeout))
+        client = boto3.client(service, region_name=region, aws_access_key_id=access_key, aws_secret_access_key=secret_key, config=config)
+        _client_cache[key] = client
+        if len(_client_cache) > AWS_CLIENT_CACHE_SIZE:
+            _client_cache.popitem(last=False)
+        return client
+
+def evict_clients(access_key):
+    with _client_cache_lock:
+        for key in [k for k in _client_cache if k[0] == access_key]:
+            del _client_cache[key]
+
+# --- 目录缓存 ---
+# 进程内 + 磁盘两级 TTL 缓存。磁盘文件位于共享的工作目录，gunicorn 各 worker 与重启后的进程都能复用；
+# 写入时先写临时文件再 os.replace，读者不会读到半个文件。同一进程内相同 key 并发未命中时只加载一次。
+# 进程内缓存层记录文件的 mtime，文件被其他进程删除或重写后本地副本随之失效。
+class CatalogCache:
+    def __init__(self, directory, ttls):
+        self.directory = directory
+        self.ttls = ttls
+        self._lock = threading.Lock()
+        self._local = {}
+        self._key_locks = {}
+
+    def _path(self, catalog, key):
+        # key 可能来自请求参数 (区域)，只保留安全字符
+        safe_key = "".join(c if c.isalnum() or c in "-_" else "_" for c in key)
+        return os.path.join(self.directory, f"{catalog}-{safe_key}.json")
+
+    def get(self, catalog, key):
+        now = time.time()
+        path = self._path(catalog, key)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        with self._lock:
+            entry = self._local.get((catalog, key))
+            if entry and entry[0] > now and entry[2] == mtime:
+                return entry[1]
+            self._local.pop((catalog, key), None)
+        if mtime is None:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                envelope = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if envelope.get('expires_at', 0) <= now:
+            return None
+        with self._lock:
+            self._local[(catalog, key)] = (envelope['expires_at'], envelope['value'], mtime)
+        return envelope['value']
+
+    def set(self, catalog, key, value, ttl=None):
+        expires_at = time.time() + (ttl if ttl is not None else self.ttls[catalog])
+        path = self._path(catalog, key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"expires_at": expires_at, "value": value}, f)
+            os.replace(tmp_path, path)
+            mtime = os.stat(path).st_mtime_ns
+        except OSError as e:
+            logging.warning(f"写入目录缓存 {catalog}:{key} 失败: {e}")
+            return
+        with self._lock:
+            self._local[(catalog, key)] = (expires_at, value, mtime)
+
+    def invalidate(self, catalog, key):
+        with self._lock:
+            self._local.pop((catalog, key), None)
+        try:
+            os.remove(self._path(catalog, key))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"清除目录缓存 {catalog}:{key} 失败: {e}")
+
+    def get_or_load(self, catalog, key, loader, ttl=None):
+        """ttl 可以是根据加载结果返回 TTL 的函数，返回 None 时使用目录的默认 TTL。"""
+        value = self.get(catalog, key)
+        if value is not None:
+            return value
+        with self._lock:
+            # [锁, 等待者数量]，最后一个等待者退出时移除，避免 key 锁无限增长
+            entry = self._key_locks.setdefault((catalog, key), [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                value = self.get(catalog, key)
+                if value is None:
+                    value = loader()
+                    self.set(catalog, key, value, ttl(value) if callable(ttl) else ttl)
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self._key_locks.pop((catalog, key), None)
+        return value
+
+_catalog_cache = CatalogCache(AWS_CATALOG_CACHE_DIR, CATALOG_TTLS)
+
+def _account_key(access_key):
+    # 缓存文件名中不出现原始 Access Key
+    return hashlib.sha256(access_key.encode()).hexdigest()[:16]
+
+def get_account_regions(access_key, secret_key):
+    """账户的全部区域 [{'name', 'enabled', 'status'}]。激活需要几分钟，有区域处于 enabling / disabling 时只短暂缓存。"""
+    def load():
+        response = get_client('ec2', 'us-east-1', access_key, secret_key).describe_regions(AllRegions=True)
+        return [{"name": r['RegionName'], "enabled": r['OptInStatus'] in ['opt-in-not-required', 'opted-in'], "status": r['OptInStatus']} for r in response['Regions']]
+    def ttl(regions):
+        return AWS_REGIONS_PENDING_TTL if any(r['status'] in ['enabling', 'disabling'] for r in regions) else None
+    return _catalog_cache.get_or_load('regions', _account_key(access_key), load, ttl)
+
+def get_lightsail_regions(access_key, secret_key):
+    return set(_catalog_cache.get_or_load('lightsail_regions', 'all',
+        lambda: [r['name'] for r in get_client('lightsail', 'us-east-1', access_key, secret_key).get_regions()['regions']]))
+
+def get_debian_ami(client, region):
+    """区域内最新的 Debian 12 AMI {'image_id', 'root_device_name'}。describe_images 响应很大，结果按区域缓存。"""
+    def load():
+        images = client.describe_images(Owners=['136693071363'], Filters=[{'Name': 'name', 'Values': ['debian-12-amd64-*']}, {'Name': 'state', 'Values': ['available']}])
+        if not images['Images']: raise Exception("未找到Debian 12的AMI")
+        latest = sorted(images['Images'], key=lambda x: x['CreationDate'], reverse=True)[0]
+        return {"image_id": latest['ImageId'], "root_device_name": latest.get('RootDeviceName')}
+    return _catalog_cache.get_or_load('debian_ami', region, load)
+
+def get_debian_blueprint(client, region):
+    def load():
+        blueprints = [bp for page in client.get_paginator('get_blueprints').paginate() for bp in page['blueprints']]
+        debian_blueprints = sorted([bp for bp in blueprints if 'debian' in bp['id'] and bp['isActive']], key=lambda x: x['version'], reverse=True)
+        if not debian_blueprints: raise Exception("未找到可用的Debian蓝图")
+        return debian_blueprints[0]['blueprintId']
+    return _catalog_cache.get_or_load('lightsail_blueprint', region, load)
+
+# --- boto3 调用计时 ---
+# 在默认 Session 的事件系统上注册一次，之后由 boto3.client() 创建的客户端都会继承这些钩子
+def _boto_before_call(model, context, **kwargs):
+    context['_metrics_start'] = time.perf_counter()
+
+def _boto_after_call(http_response, parsed, model, context, **kwargs):
+    start = context.pop('_metrics_start', None)
+    service = model.service_model.service_name
+    if start is not None:
+        metrics.observe('cloud_sdk_request_duration_seconds', time.perf_counter() - start,
+                        provider='aws', service=service, operation=model.name)
+    status = getattr(http_response, 'status_code', 200)
+    if status >= 400:
+        metrics.inc('cloud_sdk_errors_total', provider='aws', service=service, operation=model.name, status=status)
+
+def _boto_after_call_error(exception, model, context, **kwargs):
+    context.pop('_metrics_start', None)
+    metrics.inc('cloud_sdk_errors_total', provider='aws', service=model.service_model.service_name, operation=model.name, status='client_error')
+
+_boto_events = boto3._get_default_session().events
+_boto_events.register('before-call', _boto_before_call)
+_boto_events.register('after-call', _boto_after_call)
+_boto_events.register('after-call-error', _boto_after_call_error)
 def load_keys(keyfile):
     if not os.path.exists(keyfile): return []
     with open(keyfile, "r", encoding="utf-8") as f:
@@ -43,6 +245,18 @@ def save_keys(keyfile, keys):
     with open(keyfile, "w", encoding="utf-8") as f:
         for key in keys: f.write(f"{key['name']}----{key['access_key']}----{key['secret_key']}\n")
 def log_task(task_id, message):
+    if redis_client is not None:
+        try:
+            key = f"aws:task_logs:{task_id}"
+            pipe = redis_client.pipeline()
+            pipe.rpush(key, message)
+            pipe.expire(key, AWS_TASK_LOG_TTL)
+            seq = pipe.execute()[0]
+            publish_task_event('aws', task_id, message=message, seq=seq)
+            return
+        except Exception as e:
+            logging.warning(f"写入任务日志到 Redis 失败: {e}")
+    # 没有 Redis 时退回进程内队列，由不带 offset 的旧接口读取
     if task_id not in task_logs: task_logs[task_id] = queue.Queue()
     task_logs[task_id].put(message)
 def handle_aws_error(e, task_id=None):
@@ -105,22 +319,26 @@ def create_instance_task(service, task_id, access_key, secret_key, region, insta
     log_task(task_id, f"{service.upper()} 任务启动: 区域 {region}, 类型/套餐 {instance_type}")
     try:
         if service == 'ec2':
-            client = boto3.client('ec2', region_name=region, aws_access_key_id=access_key, aws_secret_access_key=secret_key, config=get_boto_config())
-            images = client.describe_images(Owners=['136693071363'], Filters=[{'Name': 'name', 'Values': ['debian-12-amd64-*']}, {'Name': 'state', 'Values': ['available']}])
-            if not images['Images']: raise Exception("未找到Debian 12的AMI")
-            ami_id = sorted(images['Images'], key=lambda x: x['CreationDate'], reverse=True)[0]['ImageId']
+            client = get_client('ec2', region, access_key, secret_key)
+            ami = get_debian_ami(client, region)
+            ami_id = ami['image_id']
             log_task(task_id, f"使用AMI: {ami_id}")
             security_group_id = create_open_security_group(client, task_id)
             run_args = {'ImageId': ami_id, 'InstanceType': instance_type, 'MinCount': 1, 'MaxCount': 1, 'UserData': user_data, 'SecurityGroupIds': [security_group_id]}
             if disk_size:
                 try:
                     disk_size_int = int(disk_size)
-                    ami_details = client.describe_images(ImageIds=[ami_id])['Images'][0]
-                    root_device_name = ami_details['RootDeviceName']
+                    root_device_name = ami['root_device_name'] or client.describe_images(ImageIds=[ami_id])['Images'][0]['RootDeviceName']
                     run_args['BlockDeviceMappings'] = [{'DeviceName': root_device_name, 'Ebs': {'VolumeSize': disk_size_int, 'VolumeType': 'gp3', 'DeleteOnTermination': True}}]
                 except (ValueError, KeyError, IndexError) as e:
                     log_task(task_id, f"警告: 硬盘大小({disk_size})无效或无法获取AMI信息({e})。将使用默认大小。")
-            instance = client.run_instances(**run_args)
+            try:
+                instance = client.run_instances(**run_args)
+            except ClientError as e:
+                # 缓存的 AMI 已被下架时清除缓存，下次创建重新查询
+                if e.response.get("Error", {}).get("Code", "").startswith("InvalidAMIID"):
+                    _catalog_cache.invalidate('debian_ami', region)
+                raise
             instance_id = instance['Instances'][0]['InstanceId']
             log_task(task_id, f"实例请求已发送, ID: {instance_id}")
             waiter = client.get_waiter('instance_running')
@@ -129,11 +347,8 @@ def create_instance_task(service, task_id, access_key, secret_key, region, insta
             ip = desc['Reservations'][0]['Instances'][0].get('PublicIpAddress', 'N/A')
             log_task(task_id, f"实例 {instance_id} 已运行, 公网 IP: {ip}")
         elif service == 'lightsail':
-            client = boto3.client('lightsail', region_name=region, aws_access_key_id=access_key, aws_secret_access_key=secret_key, config=get_boto_config())
-            blueprints = client.get_blueprints()
-            debian_blueprints = sorted([bp for bp in blueprints['blueprints'] if 'debian' in bp['id'] and bp['isActive']], key=lambda x: x['version'], reverse=True)
-            if not debian_blueprints: raise Exception("未找到可用的Debian蓝图")
-            blueprint_id = debian_blueprints[0]['blueprintId']
+            client = get_client('lightsail', region, access_key, secret_key)
+            blueprint_id = get_debian_blueprint(client, region)
             log_task(task_id, f"使用蓝图: {blueprint_id}")
             instance_name = f"lightsail-{region}-{int(time.time())}"
             client.create_instances(instanceNames=[instance_name], availabilityZone=f"{region}a", blueprintId=blueprint_id, bundleId=instance_type, userData=user_data)
@@ -144,37 +359,61 @@ def create_instance_task(service, task_id, access_key, secret_key, region, insta
 def activate_region_task(task_id, access_key, secret_key, region):
     log_task(task_id, f"开始激活区域 {region}...")
     try:
-        client = boto3.client('account', region_name='us-east-1', aws_access_key_id=access_key, aws_secret_access_key=secret_key, config=get_boto_config())
+        client = get_client('account', 'us-east-1', access_key, secret_key)
         client.enable_region(RegionName=region)
+        _catalog_cache.invalidate('regions', _account_key(access_key))
         log_task(task_id, f"区域 {region} 激活请求已成功提交。"); log_task(task_id, "--- 任务完成 ---")
     except Exception as e: handle_aws_error(e, task_id)
+def _ec2_instance_data(region, i):
+    return {"type": "EC2", "region": region, "id": i['InstanceId'], "name": next((t['Value'] for t in i.get('Tags',[]) if t['Key'] == 'Name'), i['InstanceId']), "state": i['State']['Name'], "ip": i.get('PublicIpAddress', 'N/A'), "launch_time": i.get('LaunchTime').isoformat() if i.get('LaunchTime') else None}
+def _lightsail_instance_data(region, i):
+    return {"type": "Lightsail", "region": region, "id": i['name'], "name": i['name'], "state": i['state']['name'], "ip": i.get('publicIpAddress', 'N/A'), "launch_time": i.get('createdAt').isoformat() if i.get('createdAt') else None}
+def _query_region_instances(task_id, region, ec2_client, lightsail_client):
+    """查询单个区域的全部实例 (分页读取)，每找到一个实例立即写入任务日志。超过时限时在翻页之间中止，返回 (找到数量, 是否超时)。"""
+    deadline = time.monotonic() + AWS_REGION_QUERY_TIMEOUT
+    found = 0
+    try:
+        for page in ec2_client.get_paginator('describe_instances').paginate(Filters=[{'Name':'instance-state-name','Values':ACTIVE_INSTANCE_STATES}]):
+            for r in page['Reservations']:
+                for i in r['Instances']:
+                    log_task(task_id, "FOUND_INSTANCE::" + json.dumps(_ec2_instance_data(region, i))); found += 1
+            if time.monotonic() > deadline: return found, True
+    except Exception as e:
+        log_task(task_id, f"查询EC2实例失败({region}): {handle_aws_error(e)}")
+    if lightsail_client is not None:
+        try:
+            for page in lightsail_client.get_paginator('get_instances').paginate():
+                for i in page['instances']:
+                    log_task(task_id, "FOUND_INSTANCE::" + json.dumps(_lightsail_instance_data(region, i))); found += 1
+                if time.monotonic() > deadline: return found, True
+        except Exception as e:
+            log_task(task_id, f"查询Lightsail实例失败({region}): {handle_aws_error(e)}")
+    return found, False
 def query_all_instances_task(task_id, access_key, secret_key):
     log_task(task_id, "开始查询所有已激活区域的实例...")
     try:
-        ec2_client_main = boto3.client('ec2', region_name='us-east-1', aws_access_key_id=access_key, aws_secret_access_key=secret_key, config=get_boto_config())
-        response = ec2_client_main.describe_regions(Filters=[{'Name': 'opt-in-status', 'Values': ['opt-in-not-required', 'opted-in']}])
-        enabled_regions = [r['RegionName'] for r in response['Regions']]
-        lightsail_regions_client = boto3.client('lightsail', region_name='us-east-1', aws_access_key_id=access_key, aws_secret_access_key=secret_key, config=get_boto_config())
-        lightsail_regions = {r['name'] for r in lightsail_regions_client.get_regions()['regions']}
+        enabled_regions = [r['name'] for r in get_account_regions(access_key, secret_key) if r['enabled']]
+        lightsail_regions = get_lightsail_regions(access_key, secret_key)
+        # 单次请求的读取超时不超过区域时限，避免某个区域的慢请求拖住整个查询
+        clients = {region: (get_client('ec2', region, access_key, secret_key, read_timeout=AWS_REGION_QUERY_TIMEOUT),
+                            get_client('lightsail', region, access_key, secret_key, read_timeout=AWS_REGION_QUERY_TIMEOUT) if region in lightsail_regions else None)
+                   for region in enabled_regions}
+        log_task(task_id, f"共 {len(enabled_regions)} 个区域，并发查询中...")
         total_found = 0
-        for region in enabled_regions:
-            log_task(task_id, f"正在查询区域: {region}...")
-            try:
-                ec2_client = boto3.client('ec2', region_name=region, aws_access_key_id=access_key, aws_secret_access_key=secret_key, config=get_boto_config())
-                for r in ec2_client.describe_instances(Filters=[{'Name':'instance-state-name','Values':['pending','running','stopped']}])['Reservations']:
-                    for i in r['Instances']:
-                        instance_data = {"type": "EC2", "region": region, "id": i['InstanceId'], "name": next((t['Value'] for t in i.get('Tags',[]) if t['Key'] == 'Name'), i['InstanceId']), "state": i['State']['Name'], "ip": i.get('PublicIpAddress', 'N/A'), "launch_time": i.get('LaunchTime').isoformat() if i.get('LaunchTime') else None}
-                        log_task(task_id, "FOUND_INSTANCE::" + json.dumps(instance_data)); total_found += 1
-            except Exception as e:
-                log_task(task_id, f"查询EC2实例失败({region}): {handle_aws_error(e)}")
-            if region in lightsail_regions:
+        with ThreadPoolExecutor(max_workers=max(1, min(AWS_QUERY_MAX_WORKERS, len(enabled_regions))), thread_name_prefix="aws-query-region") as executor:
+            futures = {executor.submit(_query_region_instances, task_id, region, *clients[region]): region for region in enabled_regions}
+            for future in as_completed(futures):
+                region = futures[future]
                 try:
-                    lightsail_client = boto3.client('lightsail', region_name=region, aws_access_key_id=access_key, aws_secret_access_key=secret_key, config=get_boto_config())
-                    for i in lightsail_client.get_instances()['instances']:
-                        instance_data = {"type": "Lightsail", "region": region, "id": i['name'], "name": i['name'], "state": i['state']['name'], "ip": i.get('publicIpAddress', 'N/A'), "launch_time": i.get('createdAt').isoformat() if i.get('createdAt') else None}
-                        log_task(task_id, "FOUND_INSTANCE::" + json.dumps(instance_data)); total_found += 1
+                    found, timed_out = future.result()
                 except Exception as e:
-                    log_task(task_id, f"查询Lightsail实例失败({region}): {handle_aws_error(e)}")
+                    log_task(task_id, f"查询区域 {region} 失败: {handle_aws_error(e)}")
+                    continue
+                total_found += found
+                if timed_out:
+                    log_task(task_id, f"区域 {region} 查询超过 {AWS_REGION_QUERY_TIMEOUT} 秒，已中止，结果可能不完整 (已找到 {found} 个实例)。")
+                else:
+                    log_task(task_id, f"区域 {region} 查询完成，找到 {found} 个实例。")
         log_task(task_id, f"所有区域查询完毕，共找到 {total_found} 个实例。"); log_task(task_id, "--- 任务完成 ---")
     except Exception as e: handle_aws_error(e, task_id)
 
@@ -214,6 +453,8 @@ def delete_account(name):
     keys = load_keys(KEY_FILE); keys_to_keep = [k for k in keys if k['name'] != name]
     if len(keys) == len(keys_to_keep): return jsonify({"error": "账户未找到"}), 404
     save_keys(KEY_FILE, keys_to_keep)
+    for k in keys:
+        if k['name'] == name: evict_clients(k['access_key'])
     if session.get('account_name') == name:
         session.pop('account_name', None); session.pop('aws_access_key_id', None); session.pop('aws_secret_access_key', None)
     return jsonify({"success": True})
@@ -238,16 +479,13 @@ def aws_session():
 @aws_login_required
 def get_regions():
     try:
-        lightsail_client = boto3.client('lightsail', region_name='us-east-1', aws_access_key_id=g.aws_access_key_id, aws_secret_access_key=g.aws_secret_access_key, config=get_boto_config())
-        lightsail_supported_regions = {r['name'] for r in lightsail_client.get_regions()['regions']}
-        ec2_client = boto3.client('ec2', region_name='us-east-1', aws_access_key_id=g.aws_access_key_id, aws_secret_access_key=g.aws_secret_access_key, config=get_boto_config())
-        ec2_regions_response = ec2_client.describe_regions(AllRegions=True)
+        lightsail_supported_regions = get_lightsail_regions(g.aws_access_key_id, g.aws_secret_access_key)
         regions = []
-        for r in ec2_regions_response['Regions']:
-            region_code = r['RegionName']
+        for r in get_account_regions(g.aws_access_key_id, g.aws_secret_access_key):
+            region_code = r['name']
             regions.append({
                 "code": region_code, "name": REGION_MAPPING.get(region_code, region_code),
-                "enabled": r['OptInStatus'] in ['opt-in-not-required', 'opted-in'], "supports_lightsail": region_code in lightsail_supported_regions
+                "enabled": r['enabled'], "supports_lightsail": region_code in lightsail_supported_regions
             })
         priority_regions = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2']
         sorted_regions = sorted(regions, key=lambda r: (0 if r['code'] in priority_regions else 1, r['name']))
@@ -262,14 +500,15 @@ def get_instances():
     if not region: return jsonify({"error": "必须提供区域参数"}), 400
     instances = []
     try:
-        ec2_client = boto3.client('ec2', region_name=region, aws_access_key_id=g.aws_access_key_id, aws_secret_access_key=g.aws_secret_access_key, config=get_boto_config())
-        for r in ec2_client.describe_instances(Filters=[{'Name':'instance-state-name','Values':['pending','running','stopped']}])['Reservations']:
-            for i in r['Instances']: instances.append({"type": "EC2", "region": region, "id": i['InstanceId'], "name": next((t['Value'] for t in i.get('Tags',[]) if t['Key'] == 'Name'), i['InstanceId']), "state": i['State']['Name'], "ip": i.get('PublicIpAddress', 'N/A'), "launch_time": i.get('LaunchTime').isoformat() if i.get('LaunchTime') else None})
+        ec2_client = get_client('ec2', region, g.aws_access_key_id, g.aws_secret_access_key)
+        for page in ec2_client.get_paginator('describe_instances').paginate(Filters=[{'Name':'instance-state-name','Values':ACTIVE_INSTANCE_STATES}]):
+            for r in page['Reservations']:
+                for i in r['Instances']: instances.append(_ec2_instance_data(region, i))
         
-        lightsail_regions_client = boto3.client('lightsail', region_name='us-east-1', aws_access_key_id=g.aws_access_key_id, aws_secret_access_key=g.aws_secret_access_key, config=get_boto_config())
-        if region in {r['name'] for r in lightsail_regions_client.get_regions()['regions']}:
-            lightsail_client = boto3.client('lightsail', region_name=region, aws_access_key_id=g.aws_access_key_id, aws_secret_access_key=g.aws_secret_access_key, config=get_boto_config())
-            for i in lightsail_client.get_instances()['instances']: instances.append({"type": "Lightsail", "region": region, "id": i['name'], "name": i['name'], "state": i['state']['name'], "ip": i.get('publicIpAddress', 'N/A'), "launch_time": i.get('createdAt').isoformat() if i.get('createdAt') else None})
+        if region in get_lightsail_regions(g.aws_access_key_id, g.aws_secret_access_key):
+            lightsail_client = get_client('lightsail', region, g.aws_access_key_id, g.aws_secret_access_key)
+            for page in lightsail_client.get_paginator('get_instances').paginate():
+                instances.extend(_lightsail_instance_data(region, i) for i in page['instances'])
         return jsonify(instances)
     except Exception as e: return jsonify({"error": handle_aws_error(e)}), 500
 
@@ -282,7 +521,7 @@ def instance_action():
     if not all([action, region, instance_id, instance_type]): return jsonify({"error": "缺少必要的操作参数"}), 400
     try:
         if instance_type == 'EC2':
-            client = boto3.client('ec2', region_name=region, aws_access_key_id=g.aws_access_key_id, aws_secret_access_key=g.aws_secret_access_key, config=get_boto_config())
+            client = get_client('ec2', region, g.aws_access_key_id, g.aws_secret_access_key)
             if action == 'start': client.start_instances(InstanceIds=[instance_id])
             elif action == 'stop': client.stop_instances(InstanceIds=[instance_id])
             elif action == 'restart': client.reboot_instances(InstanceIds=[instance_id])
@@ -294,7 +533,7 @@ def instance_action():
                 client.associate_address(InstanceId=instance_id, AllocationId=new_eip['AllocationId'])
                 return jsonify({"success": True, "message": f"实例 {instance_id} 已成功更换 IP 为 {new_eip['PublicIp']}"})
         elif instance_type == 'Lightsail':
-            client = boto3.client('lightsail', region_name=region, aws_access_key_id=g.aws_access_key_id, aws_secret_access_key=g.aws_secret_access_key, config=get_boto_config())
+            client = get_client('lightsail', region, g.aws_access_key_id, g.aws_secret_access_key)
             if action == 'start': client.start_instance(instanceName=instance_id)
             elif action == 'stop': client.stop_instance(instanceName=instance_id)
             elif action == 'restart': client.reboot_instance(instanceName=instance_id)
@@ -302,6 +541,26 @@ def instance_action():
         return jsonify({"success": True, "message": f"实例 {instance_id} 的 {action} 请求已发送"})
     except Exception as e: return jsonify({"error": handle_aws_error(e)}), 500
 
+def _load_ec2_instance_types(client, region):
+    paginator_offerings = client.get_paginator('describe_instance_type_offerings')
+    available_types = set()
+    for page in paginator_offerings.paginate(LocationType='region', Filters=[{'Name': 'location', 'Values': [region]}]):
+        for offering in page['InstanceTypeOfferings']: available_types.add(offering['InstanceType'])
+    if not available_types: return []
+    paginator_types = client.get_paginator('describe_instance_types')
+    detailed_types = []
+    for i in range(0, len(list(available_types)), 100):
+        chunk = list(available_types)[i:i + 100]
+        for page in paginator_types.paginate(InstanceTypes=chunk):
+            for inst_type in page['InstanceTypes']:
+                vcpus = inst_type.get('VCpuInfo', {}).get('DefaultVCpus', '?')
+                memory_mib = inst_type.get('MemoryInfo', {}).get('SizeInMiB', 0)
+                detailed_types.append({"value": inst_type['InstanceType'], "text": f"{inst_type['InstanceType']} ({vcpus}C / {round(memory_mib / 1024, 1)}G RAM)"})
+    sorted_types = sorted(detailed_types, key=lambda x: x['value'])
+    for t_name in ['t3.micro', 't2.micro']:
+        if match := next((item for item in sorted_types if item['value'] == t_name), None): sorted_types.insert(0, sorted_types.pop(sorted_types.index(match)))
+    return sorted_types
+
 @aws_bp.route("/api/ec2-instance-types")
 @login_required
 @aws_login_required
@@ -309,25 +568,8 @@ def get_ec2_instance_types():
     region = request.args.get("region")
     if not region: return jsonify({"error": "必须提供区域参数"}), 400
     try:
-        client = boto3.client('ec2', region_name=region, aws_access_key_id=g.aws_access_key_id, aws_secret_access_key=g.aws_secret_access_key, config=get_boto_config())
-        paginator_offerings = client.get_paginator('describe_instance_type_offerings')
-        available_types = set()
-        for page in paginator_offerings.paginate(LocationType='region', Filters=[{'Name': 'location', 'Values': [region]}]):
-            for offering in page['InstanceTypeOfferings']: available_types.add(offering['InstanceType'])
-        if not available_types: return jsonify([])
-        paginator_types = client.get_paginator('describe_instance_types')
-        detailed_types = []
-        for i in range(0, len(list(available_types)), 100):
-            chunk = list(available_types)[i:i + 100]
-            for page in paginator_types.paginate(InstanceTypes=chunk):
-                for inst_type in page['InstanceTypes']:
-                    vcpus = inst_type.get('VCpuInfo', {}).get('DefaultVCpus', '?')
-                    memory_mib = inst_type.get('MemoryInfo', {}).get('SizeInMiB', 0)
-                    detailed_types.append({"value": inst_type['InstanceType'], "text": f"{inst_type['InstanceType']} ({vcpus}C / {round(memory_mib / 1024, 1)}G RAM)"})
-        sorted_types = sorted(detailed_types, key=lambda x: x['value'])
-        for t_name in ['t3.micro', 't2.micro']:
-            if match := next((item for item in sorted_types if item['value'] == t_name), None): sorted_types.insert(0, sorted_types.pop(sorted_types.index(match)))
-        return jsonify(sorted_types)
+        client = get_client('ec2', region, g.aws_access_key_id, g.aws_secret_access_key)
+        return jsonify(_catalog_cache.get_or_load('instance_types', region, lambda: _load_ec2_instance_types(client, region)))
     except Exception as e: return jsonify({"error": handle_aws_error(e)}), 500
 
 @aws_bp.route("/api/lightsail-bundles")
@@ -337,9 +579,11 @@ def get_lightsail_bundles():
     region = request.args.get("region")
     if not region: return jsonify({"error": "必须提供区域参数"}), 400
     try:
-        client = boto3.client('lightsail', region_name=region, aws_access_key_id=g.aws_access_key_id, aws_secret_access_key=g.aws_secret_access_key, config=get_boto_config())
-        bundles = client.get_bundles()['bundles']
-        return jsonify([{"id": b['bundleId'], "name": f"{b['name']} ({b['ramSizeInGb']}GB RAM, {b['diskSizeInGb']}GB 磁盘, ${b['price']}/月)"} for b in bundles if b['isActive']])
+        client = get_client('lightsail', region, g.aws_access_key_id, g.aws_secret_access_key)
+        def load():
+            bundles = [b for page in client.get_paginator('get_bundles').paginate() for b in page['bundles']]
+            return [{"id": b['bundleId'], "name": f"{b['name']} ({b['ramSizeInGb']}GB RAM, {b['diskSizeInGb']}GB 磁盘, ${b['price']}/月)"} for b in bundles if b['isActive']]
+        return jsonify(_catalog_cache.get_or_load('lightsail_bundles', region, load))
     except Exception as e: return jsonify({"error": handle_aws_error(e)}), 500
 
 @aws_bp.route("/api/query-quota", methods=["POST"])
@@ -349,7 +593,7 @@ def query_quota():
     account = next((k for k in load_keys(KEY_FILE) if k['name'] == data.get("account_name")), None)
     if not account: return jsonify({"error": "账户未找到"}), 404
     try:
-        client = boto3.client('service-quotas', region_name=data.get("region", QUOTA_REGION), aws_access_key_id=account['access_key'], aws_secret_access_key=account['secret_key'], config=get_boto_config())
+        client = get_client('service-quotas', data.get("region", QUOTA_REGION), account['access_key'], account['secret_key'])
         quota = client.get_service_quota(ServiceCode='ec2', QuotaCode=QUOTA_CODE)
         return jsonify({"quota": int(quota['Quota']['Value'])})
     except Exception as e: return jsonify({"error": handle_aws_error(e)})
@@ -385,7 +629,16 @@ def start_query_all():
 @aws_bp.route("/api/task/<task_id>/logs")
 @login_required
 def get_task_logs(task_id):
+    offset = request.args.get('offset', type=int)
+    if offset is not None and redis_client is not None:
+        try:
+            logs = redis_client.lrange(f"aws:task_logs:{task_id}", offset, -1)
+            return jsonify({"logs": logs, "next_offset": offset + len(logs)})
+        except Exception as e:
+            logging.warning(f"从 Redis 读取任务日志失败: {e}")
     logs = []
     if task_id in task_logs:
         while not task_logs[task_id].empty(): logs.append(task_logs[task_id].get())
+        if "--- 任务完成 ---" in logs:
+            task_logs.pop(task_id, None)
     return jsonify({"logs": logs})
@@ -6,15 +6,64 @@ from azure.mgmt.compute import ComputeManagementClient
 from azure.mgmt.network import NetworkManagementClient
 from azure.mgmt.resource import ResourceManagementClient, SubscriptionClient
 from azure.core.exceptions import ClientAuthenticationError, ResourceNotFoundError, HttpResponseError
+from azure.core.pipeline.transport import RequestsTransport
+from urllib.parse import urlparse
 
 # 【核心修正】从主程序 app.py 导入共享的 Celery 实例
 from app import celery
+from .oci_panel import _parse_task_ids
+from .task_events import publish_task_event
+from .metrics_bp import metrics
 
 # --- Blueprint Setup & Config ---
 azure_bp = Blueprint('azure', __name__, template_folder='../templates', static_folder='../static')
 KEYS_FILE = "azure_keys.json"
 DATABASE = 'azure_tasks.db'
 
+# --- Azure SDK 调用计时 ---
+# 各管理客户端的请求最终都经过 RequestsTransport.send，在此统一记录耗时与错误码。
+# service 取 URL 中的资源提供程序 (如 Microsoft.Compute)，operation 为 HTTP 方法 + 资源类型路径，
+# 不含资源名称，标签数量有限。登录令牌请求同样经过该处，记录为 login.microsoftonline.com。
+def _azure_operation(http_request):
+    url = urlparse(http_request.url)
+    if not url.netloc.startswith('management.'):
+        # 登录令牌等非管理接口的路径中含租户 ID，只按主机名区分
+        return url.netloc, http_request.method
+    segments = [s for s in url.path.split('/') if s]
+    lowered = [s.lower() for s in segments]
+    if 'providers' in lowered:
+        index = len(lowered) - 1 - lowered[::-1].index('providers')
+        service, types = (segments[index + 1] if index + 1 < len(segments) else 'unknown'), segments[index + 2::2]
+    else:
+        service, types = 'Microsoft.Resources', segments[0::2]
+    return service, f"{http_request.method} {'/'.join(types) or '/'}"
+
+def _instrument_azure_sdk():
+    if getattr(RequestsTransport.send, '_metrics_wrapped', False):
+        return
+    original_send = RequestsTransport.send
+
+    @wraps(original_send)
+    def send(self, request, **kwargs):
+        service, operation = _azure_operation(request)
+        start = time.perf_counter()
+        try:
+            response = original_send(self, request, **kwargs)
+        except Exception:
+            metrics.inc('cloud_sdk_errors_total', provider='azure', service=service, operation=operation, status='client_error')
+            raise
+        finally:
+            metrics.observe('cloud_sdk_request_duration_seconds', time.perf_counter() - start,
+                            provider='azure', service=service, operation=operation)
+        if response.status_code >= 400:
+            metrics.inc('cloud_sdk_errors_total', provider='azure', service=service, operation=operation, status=response.status_code)
+        return response
+
+    send._metrics_wrapped = True
+    RequestsTransport.send = send
+
+_instrument_azure_sdk()
+
 # --- 数据库辅助函数 ---
 def get_db_connection():
     """创建一个新的、配置好的数据库连接"""
@@ -66,12 +115,18 @@ def _db_update_task(task_id, status, result):
         db = get_db_connection()
         db.execute('UPDATE tasks SET status = ?, result = ? WHERE id = ?', (status, result, task_id))
         db.commit()
+        publish_task_event('azure', task_id)
     except Exception as e:
         logging.error(f"Error updating task {task_id} in DB: {e}")
     finally:
         if db:
             db.close()
 
+def _load_task_statuses(task_ids):
+    placeholders = ','.join('?' * len(task_ids))
+    rows = query_db(f"SELECT id, status, result FROM tasks WHERE id IN ({placeholders})", task_ids)
+    return [{'task_id': r['id'], 'status': r['status'], 'result': r['result']} for r in rows]
+
 # --- 其他辅助函数 ---
 def load_keys():
     if not os.path.exists(KEYS_FILE): return []
@@ -260,6 +315,18 @@ def create_vm():
     )
     return jsonify({ "message": f"创建请求已提交...", "task_id": task_id })
 
+@azure_bp.route('/api/task_status/batch', methods=['POST'])
+@login_required
+def batch_task_status():
+    task_ids, error = _parse_task_ids(request.json)
+    if error:
+        return jsonify({"error": error}), 400
+    statuses = {t['task_id']: {'status': t['status'], 'result': t['result']} for t in _load_task_statuses(task_ids)}
+    # 与单任务接口一致，任务表中没有的 ID 返回 not_found
+    for task_id in task_ids:
+        statuses.setdefault(task_id, {'status': 'not_found'})
+    return jsonify(statuses)
+
 @azure_bp.route('/api/task_status/<task_id>')
 @login_required
 def task_status(task_id):
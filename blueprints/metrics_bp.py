@@ -0,0 +1,247 @@
+# /app/blueprints/metrics_bp.py
+# Prometheus 指标导出。
+# 各 gunicorn worker / Celery 线程先在进程内累加增量，后台线程定期用 pipeline 合并到 Redis，
+# /metrics 读取 Redis 中的汇总值，因此抓取到的是所有进程的总和。Redis 不可用时退化为本进程数据。
+
+import os, json, time, threading, logging, sqlite3, atexit, secrets
+from collections import defaultdict
+from contextlib import contextmanager
+from flask import Blueprint, Response, request, session, g
+from app import redis_client
+
+metrics_bp = Blueprint('metrics', __name__)
+
+CONFIG_FILE = 'config.json'
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+METRICS_COUNTERS_KEY = "metrics:counters"
+METRICS_HISTOGRAMS_KEY = "metrics:histograms"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_SEP = "\x1f"
+
+class MetricsRegistry:
+    def __init__(self):
+        self._defs = {}
+        self._lock = threading.Lock()
+        self._pending = defaultdict(float)   # (hash_key, field) -> 待写入 Redis 的增量
+        self._local = defaultdict(float)     # 本进程累计值，Redis 不可用时用于导出
+        self._pid = None
+        self._thread = None
+
+    def counter(self, name, help_text, labels=()):
+        self._defs[name] = {"type": "counter", "help": help_text, "labels": tuple(labels)}
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self._defs[name] = {"type": "histogram", "help": help_text, "labels": tuple(labels), "buckets": tuple(buckets)}
+
+    @staticmethod
+    def _series(name, labels):
+        return name + _SEP + json.dumps(labels, sort_keys=True, ensure_ascii=False)
+
+    def _add(self, hash_key, field, value):
+        self._pending[(hash_key, field)] += value
+        self._local[(hash_key, field)] += value
+
+    def inc(self, name, value=1, **labels):
+        series = self._series(name, {k: str(v) for k, v in labels.items()})
+        with self._lock:
+            self._add(METRICS_COUNTERS_KEY, series, value)
+        self._ensure_started()
+
+    def observe(self, name, value, **labels):
+        series = self._series(name, {k: str(v) for k, v in labels.items()})
+        buckets = self._defs[name]["buckets"]
+        with self._lock:
+            for le in buckets:
+                if value <= le:
+                    self._add(METRICS_HISTOGRAMS_KEY, f"{series}{_SEP}{le}", 1)
+            self._add(METRICS_HISTOGRAMS_KEY, f"{series}{_SEP}+Inf", 1)
+            self._add(METRICS_HISTOGRAMS_KEY, f"{series}{_SEP}sum", value)
+        self._ensure_started()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid and self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == pid and self._thread and self._thread.is_alive():
+                return
+            if self._pid is not None and self._pid != pid:
+                # fork 后的子进程不再重复提交父进程未写出的增量
+                self._pending.clear()
+                self._local.clear()
+            self._pid = pid
+            self._thread = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+            self._thread.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        if not redis_client:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(float)
+        if not pending:
+            return
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for (hash_key, field), value in pending.items():
+                pipe.hincrbyfloat(hash_key, field, value)
+            pipe.execute()
+        except Exception as e:
+            logging.warning(f"指标写入 Redis 失败，将在下次重试: {e}")
+            with self._lock:
+                for key, value in pending.items():
+                    self._pending[key] += value
+
+    def _read_totals(self):
+        if redis_client:
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                pipe.hgetall(METRICS_COUNTERS_KEY)
+                pipe.hgetall(METRICS_HISTOGRAMS_KEY)
+                counters, histograms = pipe.execute()
+                # 叠加本进程尚未写出的增量，保证刚发生的事件立即可见
+                with self._lock:
+                    pending = dict(self._pending)
+                totals = defaultdict(float)
+                for field, value in counters.items():
+                    totals[(METRICS_COUNTERS_KEY, field)] += float(value)
+                for field, value in histograms.items():
+                    totals[(METRICS_HISTOGRAMS_KEY, field)] += float(value)
+                for key, value in pending.items():
+                    totals[key] += value
+                return totals
+            except Exception as e:
+                logging.warning(f"读取 Redis 指标失败，仅导出本进程数据: {e}")
+        with self._lock:
+            return dict(self._local)
+
+    def render(self):
+        totals = self._read_totals()
+        samples = defaultdict(list)
+        for (hash_key, field), value in totals.items():
+            parts = field.split(_SEP)
+            name, labels = parts[0], json.loads(parts[1])
+            if name not in self._defs:
+                continue
+            samples[name].append((labels, parts[2] if len(parts) > 2 else None, value))
+
+        lines = []
+        for name, meta in self._defs.items():
+            lines.append(f"# HELP {name} {meta['help']}")
+            lines.append(f"# TYPE {name} {meta['type']}")
+            if meta['type'] == 'counter':
+                for labels, _, value in sorted(samples.get(name, []), key=lambda s: sorted(s[0].items())):
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            series = defaultdict(dict)
+            for labels, part, value in samples.get(name, []):
+                series[json.dumps(labels, sort_keys=True, ensure_ascii=False)][part] = value
+            for labels_json in sorted(series):
+                labels, parts = json.loads(labels_json), series[labels_json]
+                for le in meta['buckets']:
+                    lines.append(f"{name}_bucket{_format_labels(dict(labels, le=str(le)))} {_format_value(parts.get(str(le), 0))}")
+                count = parts.get('+Inf', 0)
+                lines.append(f"{name}_bucket{_format_labels(dict(labels, le='+Inf'))} {_format_value(count)}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(parts.get('sum', 0))}")
+                lines.append(f"{name}_count{_format_labels(labels)} {_format_value(count)}")
+        return "\n".join(lines) + "\n"
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (f'{k}="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+               for k, v in sorted(labels.items()))
+    return "{" + ",".join(escaped) + "}"
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+metrics = MetricsRegistry()
+atexit.register(metrics.flush)
+
+# --- 指标定义 ---
+metrics.counter('oci_snatch_attempts_total', '抢占 launch 尝试次数', ('account', 'ad', 'outcome', 'code'))
+metrics.histogram('oci_snatch_time_to_success_seconds', '抢占任务从开始到 launch 成功的耗时', ('account',),
+                  buckets=(60, 300, 900, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 86400, 3 * 86400, 7 * 86400))
+metrics.histogram('cloud_sdk_request_duration_seconds', '云厂商 SDK 单次 API 调用耗时', ('provider', 'service', 'operation'))
+metrics.counter('cloud_sdk_errors_total', '云厂商 SDK 调用错误次数', ('provider', 'service', 'operation', 'status'))
+metrics.histogram('sqlite_statement_duration_seconds', 'SQLite 语句耗时 (含忙等待)', ('database', 'statement'))
+metrics.counter('sqlite_lock_errors_total', 'SQLite "database is locked" 错误次数', ('database',))
+metrics.histogram('http_request_duration_seconds', 'Flask 路由处理耗时', ('blueprint', 'endpoint', 'method', 'status'))
+
+# --- SQLite 计时连接 ---
+class TimedSQLiteConnection(sqlite3.Connection):
+    """sqlite3.connect(..., factory=TimedSQLiteConnection)：记录每条语句与提交的耗时。"""
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self._metrics_db = os.path.basename(str(database))
+
+    def _timed(self, statement, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        except sqlite3.OperationalError as e:
+            if "database is locked" in str(e):
+                metrics.inc('sqlite_lock_errors_total', database=self._metrics_db)
+            raise
+        finally:
+            metrics.observe('sqlite_statement_duration_seconds', time.perf_counter() - start,
+                            database=self._metrics_db, statement=statement)
+
+    def execute(self, sql, *args):
+        statement = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'EMPTY'
+        return self._timed(statement, super().execute, sql, *args)
+
+    def commit(self):
+        return self._timed('COMMIT', super().commit)
+
+# --- Flask 路由计时 ---
+def init_app(app):
+    def start_timer():
+        g._metrics_start = time.perf_counter()
+
+    def record_request(response):
+        start = g.pop('_metrics_start', None)
+        if start is not None:
+            metrics.observe('http_request_duration_seconds', time.perf_counter() - start,
+                            blueprint=request.blueprint or 'app',
+                            endpoint=request.url_rule.rule if request.url_rule else 'unmatched',
+                            method=request.method, status=response.status_code)
+        return response
+
+    # 放在最前面，其他 before_request 提前返回时也能计时
+    app.before_request_funcs.setdefault(None, []).insert(0, start_timer)
+    app.after_request(record_request)
+
+def _metrics_token():
+    token = os.environ.get('METRICS_TOKEN')
+    if token:
+        return token
+    try:
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f).get('api_secret_key')
+    except (IOError, json.JSONDecodeError):
+        return None
+
+@metrics_bp.route('/metrics')
+def export_metrics():
+    # Prometheus 使用 Bearer Token (METRICS_TOKEN，默认与面板 API 密钥相同)，已登录的浏览器会话也可直接查看
+    if 'user_logged_in' not in session:
+        token = _metrics_token()
+        auth_header = request.headers.get('Authorization', '')
+        if not token or not auth_header.startswith('Bearer ') or not secrets.compare_digest(auth_header[7:], token):
+            return Response("Unauthorized\n", status=401, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
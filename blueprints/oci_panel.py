@@ -1,6 +1,8 @@
-import os, json, threading, string, random, base64, time, logging, uuid, sqlite3, datetime, signal, requests
+import os, json, threading, string, random, base64, time, logging, uuid, sqlite3, datetime, signal, requests, heapq, itertools, atexit
+from concurrent.futures import ThreadPoolExecutor
 from flask import Blueprint, render_template, jsonify, request, session, g, redirect, url_for, current_app
 from functools import wraps
+from contextlib import contextmanager
 from pypinyin import lazy_pinyin
 from datetime import timezone, timedelta
 import oci
@@ -12,10 +14,15 @@ from oci.core.models import (CreateVcnDetails, CreateSubnetDetails, CreateIntern
                              UpdateInstanceDetails, UpdateBootVolumeDetails, UpdateInstanceShapeConfigDetails,
                              AddVcnIpv6CidrDetails, UpdateSubnetDetails,
                              LaunchInstanceAgentConfigDetails, InstanceAgentPluginConfigDetails,
-                             GetPublicIpByPrivateIpIdDetails, CreatePrivateIpDetails
+                             GetPublicIpByPrivateIpIdDetails, CreatePrivateIpDetails,
+                             CreateComputeCapacityReportDetails, CreateCapacityReportShapeAvailabilityDetails,
+                             CapacityReportInstanceShapeConfig
                              )
 from oci.exceptions import ServiceError
-from app import celery
+from celery import chain, chord, group
+from app import celery, redis_client
+from .metrics_bp import metrics, TimedSQLiteConnection
+from .task_events import publish_task_event
 
 # --- Blueprint Setup ---
 oci_bp = Blueprint('oci', __name__, template_folder='../../templates', static_folder='../../static')
@@ -54,7 +61,7 @@ def timeout(seconds):
 # --- 核心函数区域 ---
 
 def get_db_connection(timeout=3):
-    conn = sqlite3.connect(DATABASE, timeout=timeout)
+    conn = sqlite3.connect(DATABASE, timeout=timeout, factory=TimedSQLiteConnection)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL;")
     return conn
@@ -104,6 +111,8 @@ def init_db():
         logging.info("'tasks' table created successfully in OCI database.")
     else:
         update_db_schema()
+    _init_dns_outbox_table(cursor)
+    db.commit()
     db.close()
 
 def query_db(query, args=(), one=False):
@@ -114,11 +123,50 @@ def query_db(query, args=(), one=False):
     db.close()
     return (rv[0] if rv else None) if one else rv
 
-def _db_execute_celery(query, params=()):
+def _db_execute_celery(query, params=(), task_id=None):
+    """task_id 给出且确有行被更新时，通知推送服务该任务有变化。"""
     db = get_db_connection(timeout=20)
-    db.execute(query, params)
+    cur = db.execute(query, params)
     db.commit()
     db.close()
+    if task_id and cur.rowcount:
+        publish_task_event('oci', task_id)
+    return cur.rowcount
+
+TASK_STATUS_BATCH_MAX = 200
+
+def _load_task_statuses(task_ids):
+    """一次 IN 查询 (主键索引) 读取多个任务的状态。"""
+    placeholders = ','.join('?' * len(task_ids))
+    rows = query_db(f"SELECT id, type, status, result FROM tasks WHERE id IN ({placeholders})", task_ids)
+    return [{'task_id': r['id'], 'type': r['type'], 'status': r['status'], 'result': r['result']} for r in rows]
+
+# Celery 状态映射为任务表使用的小写状态，前端只把 success / failure / not_found 视为结束
+_CELERY_STATE_MAP = {'SUCCESS': 'success', 'FAILURE': 'failure', 'REVOKED': 'failure'}
+
+def _batch_task_statuses(task_ids, celery_fallback=False):
+    """返回 {task_id: {status, result, type}}，数据库中没有的 ID 标记为 not_found。
+    celery_fallback=True 时 (API) 先查询 Celery 结果，状态转换为小写。"""
+    statuses = {t['task_id']: {'status': t['status'], 'result': t['result'], 'type': t['type']} for t in _load_task_statuses(task_ids)}
+    for task_id in task_ids:
+        if task_id in statuses:
+            continue
+        res = celery.AsyncResult(task_id) if celery_fallback else None
+        # 未知 ID 在 Celery 中的状态永远是 PENDING
+        if res is not None and res.state != 'PENDING':
+            statuses[task_id] = {'status': _CELERY_STATE_MAP.get(res.state, res.state.lower()), 'result': str(res.info)}
+        else:
+            statuses[task_id] = {'status': 'not_found'}
+    return statuses
+
+def _parse_task_ids(data):
+    """校验批量查询请求中的 task_ids，返回 (去重后的列表, error)。"""
+    task_ids = (data or {}).get('task_ids')
+    if not isinstance(task_ids, list) or not task_ids or not all(isinstance(t, str) for t in task_ids):
+        return None, "task_ids 必须是非空字符串列表"
+    if len(task_ids) > TASK_STATUS_BATCH_MAX:
+        return None, f"单次最多查询 {TASK_STATUS_BATCH_MAX} 个任务"
+    return list(dict.fromkeys(task_ids)), None
 
 def _create_task_entry(task_type, task_name, alias=None):
     db = get_db()
@@ -143,9 +191,67 @@ def load_profiles():
             return data
     except (IOError, json.JSONDecodeError): return {"profiles": {}, "profile_order": []}
 
+# --- 抢占任务恢复 ---
+# worker 重启后不再一次性派发所有任务：按账号交错排序后分批派发，批次之间按配置速率加随机抖动，
+# 任务保存的 attempt_count / next_attempt_at 原样保留，进度写入 Redis 供前端查询。
+RECOVERY_DISPATCH_RATE = float(os.environ.get('RECOVERY_DISPATCH_RATE', 2))   # 每秒派发的任务数
+RECOVERY_BATCH_SIZE = int(os.environ.get('RECOVERY_BATCH_SIZE', 5))
+RECOVERY_PROGRESS_KEY = "oci:snatch:recovery"
+
+def _spread_by_account(units):
+    """同一账号内按下次尝试时间排序，账号之间轮流取，避免连续派发同一租户的任务。"""
+    by_alias = {}
+    for unit in sorted(units, key=lambda u: u['next_attempt_at']):
+        by_alias.setdefault(unit['alias'], []).append(unit)
+    queues = list(by_alias.values())
+    ordered = []
+    while queues:
+        for alias_queue in list(queues):
+            ordered.append(alias_queue.pop(0))
+            if not alias_queue:
+                queues.remove(alias_queue)
+    return ordered
+
+def _report_recovery_progress(progress):
+    logging.info(f"抢占任务恢复进度: {progress['dispatched']}/{progress['total']}")
+    if not redis_client:
+        return
+    try:
+        redis_client.set(RECOVERY_PROGRESS_KEY, json.dumps(progress), ex=86400)
+    except Exception as e:
+        logging.warning(f"写入恢复进度失败: {e}")
+
+def get_recovery_progress():
+    if not redis_client:
+        return None
+    try:
+        raw = redis_client.get(RECOVERY_PROGRESS_KEY)
+        return json.loads(raw) if raw else None
+    except Exception:
+        return None
+
+def _dispatch_recovery_units(units):
+    progress = {"total": len(units), "dispatched": 0, "started_at": time.time(), "finished_at": None}
+    _report_recovery_progress(progress)
+    batch_interval = RECOVERY_BATCH_SIZE / max(RECOVERY_DISPATCH_RATE, 0.01)
+    for start in range(0, len(units), RECOVERY_BATCH_SIZE):
+        if start:
+            time.sleep(batch_interval + random.uniform(0, batch_interval * 0.5))
+        for unit in units[start:start + RECOVERY_BATCH_SIZE]:
+            try:
+                unit['task'].delay(*unit['args'])
+            except Exception as e:
+                logging.error(f"派发恢复任务 {unit['label']} 失败: {e}")
+            progress['dispatched'] += 1
+        _report_recovery_progress(progress)
+    progress['finished_at'] = time.time()
+    _report_recovery_progress(progress)
+    logging.info("--- 抢占任务恢复派发完成 ---")
+
 def recover_snatching_tasks():
     logging.info("--- 检查并恢复被中断的抢占任务 ---")
     db = get_db_connection()
+    units = []
     try:
         orphaned_tasks = db.execute(
             "SELECT id, result, account_alias FROM tasks WHERE status = 'running' AND type = 'snatch'"
@@ -157,11 +263,14 @@ def recover_snatching_tasks():
 
         logging.info(f"发现 {len(orphaned_tasks)} 个需要自动恢复的抢占任务。")
         profiles = load_profiles().get("profiles", {})
+        recovered_groups = {}
+        pending_updates = []
+        failed_ids = []
 
         for task in orphaned_tasks:
             task_id = task['id']
             alias = task['account_alias']
-            
+
             profile_config = profiles.get(alias)
             if not profile_config:
                 logging.warning(f"任务 {task_id} 对应的账号 '{alias}' 配置已不存在，无法恢复。")
@@ -169,7 +278,7 @@ def recover_snatching_tasks():
                     "UPDATE tasks SET status = ?, result = ? WHERE id = ?",
                     ('failure', '任务因关联的账号配置被删除而恢复失败。', task_id)
                 )
-                db.commit()
+                failed_ids.append(task_id)
                 continue
 
             try:
@@ -177,21 +286,32 @@ def recover_snatching_tasks():
                 original_details = result_json.get('details')
                 if not original_details:
                     raise ValueError("在任务 result 中未找到 'details' 字段。")
-                
-                result_json['last_message'] = "服务重启，任务已自动恢复并继续执行..."
+
+                if result_json.get('launch'):
+                    # 实例已创建成功，只需继续置备流程，不能重新抢占
+                    units.append({"alias": alias, "next_attempt_at": 0, "label": task_id,
+                                  "task": _snatch_post_launch_task, "args": (task_id, profile_config, alias, original_details, result_json)})
+                    continue
+
                 new_run_id = str(uuid.uuid4())
                 result_json['run_id'] = new_run_id
-                
-                db.execute(
-                    "UPDATE tasks SET result = ? WHERE id = ?",
-                    (json.dumps(result_json), task_id)
-                )
-                db.commit()
-                
-                auto_bind_domain = original_details.get('auto_bind_domain', False)
-                _snatch_instance_task.delay(task_id, profile_config, alias, original_details, new_run_id, auto_bind_domain)
+                pending_updates.append((task_id, result_json))
 
-                logging.info(f"已成功重新派发任务 {task_id} (账号: {alias})。")
+                auto_bind_domain = original_details.get('auto_bind_domain', False)
+                next_attempt_at = result_json.get('next_attempt_at') or 0
+                group_id = original_details.get('group_id')
+                if group_id:
+                    # 同组槽位收集后统一交给一个协调器
+                    group_unit = recovered_groups.get(group_id)
+                    if group_unit is None:
+                        group_unit = recovered_groups[group_id] = {"alias": alias, "next_attempt_at": next_attempt_at, "label": f"group {group_id}",
+                                                                   "task": _snatch_group_task, "args": (group_id, profile_config, alias, [], auto_bind_domain)}
+                        units.append(group_unit)
+                    group_unit['args'][3].append([task_id, original_details, new_run_id])
+                    group_unit['next_attempt_at'] = min(group_unit['next_attempt_at'], next_attempt_at)
+                    continue
+                units.append({"alias": alias, "next_attempt_at": next_attempt_at, "label": task_id,
+                              "task": _snatch_instance_task, "args": (task_id, profile_config, alias, original_details, new_run_id, auto_bind_domain)})
 
             except (json.JSONDecodeError, ValueError, KeyError) as e:
                 logging.error(f"解析或恢复任务 {task_id} 失败: {e}。")
@@ -199,14 +319,32 @@ def recover_snatching_tasks():
                     "UPDATE tasks SET status = ?, result = ? WHERE id = ?",
                     ('failure', f'任务恢复失败，原因: 无法解析任务参数 ({e})', task_id)
                 )
-                db.commit()
+                failed_ids.append(task_id)
+
+        units = _spread_by_account(units)
+        positions = {}
+        for index, unit in enumerate(units, start=1):
+            slots = unit['args'][3] if unit['task'] is _snatch_group_task else [unit['args']]
+            for slot in slots:
+                positions[slot[0]] = index
+        for task_id, result_json in pending_updates:
+            result_json['last_message'] = f"服务重启，任务排队恢复中 ({positions.get(task_id, '?')}/{len(units)})..."
+            db.execute("UPDATE tasks SET result = ? WHERE id = ?", (json.dumps(result_json), task_id))
+        db.commit()
+        for task_id in failed_ids + [task_id for task_id, _ in pending_updates]:
+            publish_task_event('oci', task_id)
 
     except Exception as e:
         logging.error(f"在恢复抢占任务过程中发生未知错误: {e}")
+        units = []
     finally:
         db.close()
         logging.info("--- 抢占任务恢复检查完成 ---")
 
+    if units:
+        # 派发可能持续数分钟，放到后台线程，不阻塞 worker 启动
+        threading.Thread(target=_dispatch_recovery_units, args=(units,), name="snatch-recovery", daemon=True).start()
+
 def _format_timedelta(duration: timedelta) -> str:
     seconds = duration.total_seconds()
     if seconds < 60:
@@ -260,10 +398,143 @@ def _internal_fetch_and_save_tenancy_date(alias):
         return False, str(e)
 
 
+# --- 共享缓存 ---
+class SharedTTLCache:
+    """进程内 + Redis 两级 TTL 缓存。同一进程内相同 key 并发未命中时只加载一次。
+    local=False 时有 Redis 就只读 Redis，适用于会被其他进程 (web) 主动失效的数据。"""
+    def __init__(self, namespace, ttl, local=True):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local = local
+        self._lock = threading.Lock()
+        self._local = {}
+        self._key_locks = {}
+
+    def _redis_key(self, key):
+        return f"oci:cache:{self.namespace}:{key}"
+
+    def get(self, key):
+        now = time.time()
+        if self.local or redis_client is None:
+            with self._lock:
+                entry = self._local.get(key)
+                if entry and entry[0] > now:
+                    return entry[1]
+        if redis_client is None:
+            return None
+        try:
+            raw = redis_client.get(self._redis_key(key))
+        except Exception as e:
+            logging.warning(f"读取缓存 {self.namespace}:{key} 失败: {e}")
+            return None
+        if not raw:
+            return None
+        try:
+            envelope = json.loads(raw)
+        except json.JSONDecodeError:
+            return None
+        if envelope.get('expires_at', 0) <= now:
+            return None
+        with self._lock:
+            self._local[key] = (envelope['expires_at'], envelope['value'])
+        return envelope['value']
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._local[key] = (expires_at, value)
+        if redis_client is None:
+            return
+        try:
+            redis_client.setex(self._redis_key(key), int(ttl) + 1, json.dumps({"expires_at": expires_at, "value": value}))
+        except Exception as e:
+            logging.warning(f"写入缓存 {self.namespace}:{key} 失败: {e}")
+
+    def invalidate(self, key):
+        with self._lock:
+            self._local.pop(key, None)
+        if redis_client is None:
+            return
+        try:
+            redis_client.delete(self._redis_key(key))
+        except Exception as e:
+            logging.warning(f"清除缓存 {self.namespace}:{key} 失败: {e}")
+
+    def get_or_load(self, key, loader, ttl=None):
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            # [锁, 等待者数量]，最后一个等待者退出时移除，避免 key 锁无限增长
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                value = self.get(key)
+                if value is None:
+                    value = loader()
+                    self.set(key, value, ttl)
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self._key_locks.pop(key, None)
+        return value
+
+# --- 子网防火墙开放状态缓存 ---
+# 子网确认已开放 (所有安全列表均含 0.0.0.0/0 全协议入站/出站规则) 后记录下来，
+# 之后的置备直接跳过 get_subnet / get_security_list。同时记录安全列表 -> 子网的反向索引，
+# 通过面板修改安全规则时据此使相关子网的缓存失效。
+# 失效发生在 web 进程，读取发生在 Celery worker，因此有 Redis 时不使用进程内缓存层；
+# 反向索引用 Redis 集合 (SADD) 维护，多个 worker 同时登记不会互相覆盖。
+FIREWALL_OPEN_CACHE_TTL = int(os.environ.get('FIREWALL_OPEN_CACHE_TTL', 6 * 3600))
+_firewall_open_cache = SharedTTLCache('firewall_open', FIREWALL_OPEN_CACHE_TTL, local=False)
+_firewall_sl_index = {}
+_firewall_sl_index_lock = threading.Lock()
+
+def _firewall_sl_key(sl_id):
+    return f"oci:cache:firewall_open:sl:{sl_id}"
+
+def _mark_subnet_firewall_open(subnet_id, security_list_ids):
+    _firewall_open_cache.set(f"subnet:{subnet_id}", {"security_list_ids": list(security_list_ids), "verified_at": time.time()})
+    if redis_client is None:
+        with _firewall_sl_index_lock:
+            for sl_id in security_list_ids:
+                _firewall_sl_index.setdefault(sl_id, set()).add(subnet_id)
+        return
+    try:
+        pipe = redis_client.pipeline()
+        for sl_id in security_list_ids:
+            pipe.sadd(_firewall_sl_key(sl_id), subnet_id)
+            pipe.expire(_firewall_sl_key(sl_id), FIREWALL_OPEN_CACHE_TTL + 60)
+        pipe.execute()
+    except Exception as e:
+        logging.warning(f"写入安全列表反向索引失败: {e}")
+
+def _invalidate_security_list_firewall_state(security_list_id):
+    if redis_client is None:
+        with _firewall_sl_index_lock:
+            subnet_ids = _firewall_sl_index.pop(security_list_id, set())
+    else:
+        try:
+            pipe = redis_client.pipeline()
+            pipe.smembers(_firewall_sl_key(security_list_id))
+            pipe.delete(_firewall_sl_key(security_list_id))
+            subnet_ids = pipe.execute()[0]
+        except Exception as e:
+            logging.warning(f"读取安全列表反向索引失败: {e}")
+            subnet_ids = set()
+    for subnet_id in subnet_ids:
+        _firewall_open_cache.invalidate(f"subnet:{subnet_id}")
+
 def _auto_open_firewall(vnet_client, subnet_id, task_id=None):
     """
     检查指定子网的安全列表，如果没有允许所有流量的规则，则自动添加。
     """
+    if _firewall_open_cache.get(f"subnet:{subnet_id}"):
+        logging.info(f"子网 {subnet_id} 的防火墙已确认开放，跳过检查。")
+        return "✅ 防火墙已自动开放 (入站/出站)"
     try:
         subnet = vnet_client.get_subnet(subnet_id).data
         # 遍历该子网关联的所有安全列表（通常只有一个默认的）
@@ -283,14 +554,14 @@ def _auto_open_firewall(vnet_client, subnet_id, task_id=None):
             # 准备更新列表
             new_ingress_rules = list(sl.ingress_security_rules)
             if not ingress_exists:
-                if task_id: _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('正在自动添加防火墙入站规则...', task_id))
+                if task_id: _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('正在自动添加防火墙入站规则...', task_id), task_id=task_id)
                 new_ingress_rules.append(IngressSecurityRule(
                     source="0.0.0.0/0", protocol="all", is_stateless=False, source_type="CIDR_BLOCK"
                 ))
             
             new_egress_rules = list(sl.egress_security_rules)
             if not egress_exists:
-                if task_id: _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('正在自动添加防火墙出站规则...', task_id))
+                if task_id: _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('正在自动添加防火墙出站规则...', task_id), task_id=task_id)
                 new_egress_rules.append(EgressSecurityRule(
                     destination="0.0.0.0/0", protocol="all", is_stateless=False, destination_type="CIDR_BLOCK"
                 ))
@@ -305,17 +576,169 @@ def _auto_open_firewall(vnet_client, subnet_id, task_id=None):
             )
             logging.info(f"已自动更新安全列表 {sl.display_name} 的防火墙规则。")
             
+        _mark_subnet_firewall_open(subnet_id, subnet.security_list_ids)
         return "✅ 防火墙已自动开放 (入站/出站)"
     except Exception as e:
         logging.error(f"自动开放防火墙失败: {e}")
         return f"⚠️ 防火墙自动开放失败: {str(e)[:50]}"
 
-def load_tg_config():
-    if not os.path.exists(TG_CONFIG_FILE): return {}
+_json_file_cache = {}
+_json_file_cache_lock = threading.Lock()
+
+def _load_json_file_cached(path):
+    """按文件 mtime 缓存 JSON 配置文件，文件被保存后自动失效。返回副本，调用方可自由修改。"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _json_file_cache_lock:
+        cached = _json_file_cache.get(path)
+    if cached and cached[0] == signature:
+        return json.loads(cached[1])
     try:
-        with open(TG_CONFIG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (IOError, json.JSONDecodeError): return {}
+        with open(path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        data = json.loads(content)
+    except (IOError, json.JSONDecodeError):
+        return {}
+    with _json_file_cache_lock:
+        _json_file_cache[path] = (signature, content)
+    return data
+
+# --- 资源生命周期批量监视 ---
+# 替代逐个资源的 oci.wait_until：等待者按 (区域端点, 区间, 资源类型) 分组，
+# 监视线程每个周期对每组只调用一次 list_* 接口，再唤醒所有达到目标状态的等待者。
+# 轮询间隔自适应：有新等待者或状态变化时回到最短间隔，否则逐步放宽。
+LIFECYCLE_POLL_MIN = float(os.environ.get('LIFECYCLE_POLL_MIN', 2))
+LIFECYCLE_POLL_MAX = float(os.environ.get('LIFECYCLE_POLL_MAX', 15))
+LIFECYCLE_POLL_BACKOFF = 1.5
+# 等待者自身的兜底超时余量：监视线程异常退出或列表接口持续失败时，等待者也不会永久阻塞
+LIFECYCLE_WAIT_MARGIN = LIFECYCLE_POLL_MAX * 2
+
+_LIFECYCLE_LISTERS = {
+    'instance': lambda client, compartment_id: oci.pagination.list_call_get_all_results(client.list_instances, compartment_id=compartment_id).data,
+    'vcn': lambda client, compartment_id: oci.pagination.list_call_get_all_results(client.list_vcns, compartment_id=compartment_id).data,
+    'subnet': lambda client, compartment_id: oci.pagination.list_call_get_all_results(client.list_subnets, compartment_id=compartment_id).data,
+}
+
+class _LifecycleWaiter:
+    def __init__(self, resource_id, target_states, deadline, succeed_on_not_found):
+        self.resource_id = resource_id
+        self.target_states = target_states
+        self.deadline = deadline
+        self.succeed_on_not_found = succeed_on_not_found
+        self.event = threading.Event()
+        self.resource = None
+        self.last_state = None
+        self.timed_out = False
+        self.registered_at = time.time()
+
+class _LifecycleGroup:
+    def __init__(self, client, compartment_id, kind):
+        self.client = client
+        self.compartment_id = compartment_id
+        self.kind = kind
+        self.waiters = []
+        self.interval = LIFECYCLE_POLL_MIN
+        self.next_poll = time.time()
+
+class LifecycleWatcher:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._groups = {}
+        self._thread = None
+
+    def wait_for(self, client, compartment_id, kind, resource_id, target_states, max_wait_seconds=300, succeed_on_not_found=False):
+        """阻塞直到资源进入目标状态，返回最后一次列出的资源对象；超时抛出 MaximumWaitTimeExceeded。"""
+        if isinstance(target_states, str):
+            target_states = (target_states,)
+        waiter = _LifecycleWaiter(resource_id, set(target_states), time.time() + max_wait_seconds, succeed_on_not_found)
+        key = (client.base_client.endpoint, compartment_id, kind)
+        with self._cond:
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = _LifecycleGroup(client, compartment_id, kind)
+            group.client = client
+            waiter.registered_at = time.time()
+            group.waiters.append(waiter)
+            # 新等待者尽快得到第一次结果
+            group.interval = LIFECYCLE_POLL_MIN
+            group.next_poll = min(group.next_poll, time.time() + LIFECYCLE_POLL_MIN)
+            self._ensure_started()
+            self._cond.notify()
+        if not waiter.event.wait(max_wait_seconds + LIFECYCLE_WAIT_MARGIN):
+            with self._cond:
+                if waiter in group.waiters:
+                    group.waiters.remove(waiter)
+            waiter.timed_out = True
+        if waiter.timed_out:
+            raise oci.exceptions.MaximumWaitTimeExceeded(
+                f"等待 {kind} {resource_id} 进入 {'/'.join(sorted(waiter.target_states))} 超时 (当前状态: {waiter.last_state})")
+        return waiter.resource
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="oci-lifecycle-watcher", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._groups:
+                    self._cond.wait()
+                now = time.time()
+                due = [g for g in self._groups.values() if g.next_poll <= now]
+                if not due:
+                    self._cond.wait(min(g.next_poll for g in self._groups.values()) - now)
+                    continue
+            for group in due:
+                self._poll(group)
+
+    def _poll(self, group):
+        # 在发起列表请求前记录时间：之后才登记的等待者不采用本次结果，避免操作前的旧状态误判为已完成
+        fetched_at = time.time()
+        try:
+            resources = {r.id: r for r in _LIFECYCLE_LISTERS[group.kind](group.client, group.compartment_id)}
+        except Exception as e:
+            logging.warning(f"生命周期监视: 列出 {group.kind} ({group.compartment_id}) 失败: {e}")
+            resources = None
+
+        changed = False
+        now = time.time()
+        with self._cond:
+            remaining = []
+            for waiter in group.waiters:
+                if waiter.registered_at > fetched_at:
+                    changed = True
+                    remaining.append(waiter)
+                    continue
+                if resources is not None:
+                    resource = resources.get(waiter.resource_id)
+                    state = resource.lifecycle_state if resource else None
+                    if state != waiter.last_state:
+                        changed = True
+                    waiter.last_state, waiter.resource = state, resource
+                    if (resource and state in waiter.target_states) or (resource is None and waiter.succeed_on_not_found):
+                        waiter.event.set()
+                        continue
+                if now >= waiter.deadline:
+                    waiter.timed_out = True
+                    waiter.event.set()
+                    continue
+                remaining.append(waiter)
+            group.waiters = remaining
+            if not remaining:
+                self._groups.pop((group.client.base_client.endpoint, group.compartment_id, group.kind), None)
+                return
+            group.interval = LIFECYCLE_POLL_MIN if changed else min(group.interval * LIFECYCLE_POLL_BACKOFF, LIFECYCLE_POLL_MAX)
+            group.next_poll = time.time() + group.interval
+
+_lifecycle_watcher = LifecycleWatcher()
+
+def load_tg_config():
+    return _load_json_file_cached(TG_CONFIG_FILE)
 
 def save_tg_config(config):
     try:
@@ -326,13 +749,7 @@ def save_tg_config(config):
         logging.error(f"Failed to save Telegram config to {TG_CONFIG_FILE}: {e}")
 
 def load_cloudflare_config():
-    if not os.path.exists(CLOUDFLARE_CONFIG_FILE):
-        return {}
-    try:
-        with open(CLOUDFLARE_CONFIG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (IOError, json.JSONDecodeError):
-        return {}
+    return _load_json_file_cached(CLOUDFLARE_CONFIG_FILE)
 
 def save_cloudflare_config(config):
     try:
@@ -343,11 +760,7 @@ def save_cloudflare_config(config):
         logging.error(f"Failed to save Cloudflare config: {e}")
 
 def load_xui_config():
-    if not os.path.exists(XUI_CONFIG_FILE): return {}
-    try:
-        with open(XUI_CONFIG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except: return {}
+    return _load_json_file_cached(XUI_CONFIG_FILE)
 
 def save_xui_config(config):
     try:
@@ -357,60 +770,182 @@ def save_xui_config(config):
     except Exception as e:
         logging.error(f"Failed to save X-UI config: {e}")
 
-def _update_cloudflare_dns(subdomain, ip_address, record_type='A'):
+# --- Cloudflare DNS 客户端 ---
+# 每个进程按配置 (token, zone) 复用一个客户端：持久 Session 复用连接，内存中维护 zone 记录索引
+# (名称+类型 -> 记录ID/内容)。索引首次使用时整页拉取，之后由本进程的写入直接更新，
+# 未命中的名称单独查询一次补入索引，超过 CF_INDEX_TTL 后整体重建。索引命中时 upsert 只需一次请求。
+CF_API_BASE = "https://api.cloudflare.com/client/v4"
+CF_INDEX_TTL = int(os.environ.get('CF_INDEX_TTL', 600))
+CF_BATCH_SIZE = 100
+
+class CloudflareDnsClient:
+    def __init__(self, api_token, zone_id, domain):
+        self.zone_id = zone_id
+        self.domain = domain
+        self.records_url = f"{CF_API_BASE}/zones/{zone_id}/dns_records"
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {api_token}", "Content-Type": "application/json"})
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._index = {}
+        self._index_loaded_at = 0
+
+    def full_name(self, subdomain):
+        # Cloudflare 返回的记录名总是小写，索引键统一用小写
+        return f"{subdomain}.{self.domain}".lower()
+
+    def _request(self, method, url, **kwargs):
+        response = self.session.request(method, url, timeout=15, **kwargs)
+        try:
+            body = response.json()
+        except ValueError:
+            response.raise_for_status()
+            raise
+        if not body.get('success'):
+            errors = body.get('errors') or [{'message': f'HTTP {response.status_code}'}]
+            raise requests.HTTPError(', '.join(str(e.get('message')) for e in errors), response=response)
+        return body
+
+    def _remember(self, record):
+        entry = {"id": record['id'], "content": record['content']}
+        self._index[(record['name'].lower(), record['type'])] = entry
+        return entry
+
+    def _index_fresh(self):
+        with self._lock:
+            return self._index_loaded_at and time.time() - self._index_loaded_at < CF_INDEX_TTL
+
+    def _ensure_index(self):
+        if self._index_fresh():
+            return
+        with self._refresh_lock:
+            if not self._index_fresh():
+                self._load_index()
+
+    def _load_index(self):
+        index, page = {}, 1
+        while True:
+            body = self._request("GET", self.records_url, params={"page": page, "per_page": 1000})
+            for record in body['result']:
+                index[(record['name'].lower(), record['type'])] = {"id": record['id'], "content": record['content']}
+            info = body.get('result_info') or {}
+            if page >= info.get('total_pages', 1):
+                break
+            page += 1
+        with self._lock:
+            self._index = index
+            self._index_loaded_at = time.time()
+        logging.info(f"Cloudflare 记录索引已刷新: {len(index)} 条记录")
+
+    def _lookup(self, name, record_type):
+        self._ensure_index()
+        with self._lock:
+            entry = self._index.get((name, record_type))
+        if entry is not None:
+            return entry
+        # 索引之后在别处创建的记录：单独查询一次
+        body = self._request("GET", self.records_url, params={"type": record_type, "name": name})
+        if not body['result']:
+            return None
+        with self._lock:
+            return self._remember(body['result'][0])
+
+    def upsert(self, subdomain, ip_address, record_type='A'):
+        """创建或更新记录，返回 ('创建'|'更新'|'未变化')。"""
+        name = self.full_name(subdomain)
+        payload = {'type': record_type, 'name': name, 'content': ip_address, 'ttl': 60, 'proxied': False}
+        entry = self._lookup(name, record_type)
+        if entry and entry['content'] == ip_address:
+            return "未变化"
+        if entry:
+            try:
+                record = self._request("PUT", f"{self.records_url}/{entry['id']}", json=payload)['result']
+                action = "更新"
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 404: raise
+                # 记录已在别处被删除
+                record = self._request("POST", self.records_url, json=payload)['result']
+                action = "创建"
+        else:
+            record = self._request("POST", self.records_url, json=payload)['result']
+            action = "创建"
+        with self._lock:
+            self._remember(record)
+        return action
+
+    def upsert_many(self, entries):
+        """entries: [(subdomain, ip_address, record_type)]。通过批量接口提交，返回与 entries 对应的结果消息列表。"""
+        results = [None] * len(entries)
+        for start in range(0, len(entries), CF_BATCH_SIZE):
+            chunk = list(enumerate(entries[start:start + CF_BATCH_SIZE], start=start))
+            posts, puts, pending = [], [], []
+            for index, (subdomain, ip_address, record_type) in chunk:
+                name = self.full_name(subdomain)
+                try:
+                    entry = self._lookup(name, record_type)
+                except Exception as e:
+                    results[index] = f"❌ 查询 Cloudflare DNS 记录失败: {e}"
+                    continue
+                if entry and entry['content'] == ip_address:
+                    results[index] = f"✅ Cloudflare DNS 记录: {name} -> {ip_address}"
+                    continue
+                payload = {'type': record_type, 'name': name, 'content': ip_address, 'ttl': 60, 'proxied': False}
+                if entry:
+                    puts.append(dict(payload, id=entry['id']))
+                else:
+                    posts.append(payload)
+                pending.append(index)
+            if not pending:
+                continue
+            try:
+                body = self._request("POST", f"{self.records_url}/batch", json={"posts": posts, "puts": puts})
+                with self._lock:
+                    for record in (body['result'].get('posts') or []) + (body['result'].get('puts') or []):
+                        self._remember(record)
+                for index in pending:
+                    subdomain, ip_address, _ = entries[index]
+                    results[index] = f"✅ Cloudflare DNS 记录: {self.full_name(subdomain)} -> {ip_address}"
+            except Exception as e:
+                # 批量请求是原子的，失败时逐条提交，避免一条坏记录拖累整批
+                logging.warning(f"Cloudflare 批量提交失败，改为逐条提交: {e}")
+                for index in pending:
+                    results[index] = _update_cloudflare_dns(*entries[index])
+        return results
+
+_cloudflare_clients = {}
+_cloudflare_clients_lock = threading.Lock()
+
+def _get_cloudflare_client():
+    """返回当前配置对应的客户端；未配置时返回 None。配置变更后自动换用新客户端。"""
     cf_config = load_cloudflare_config()
-    api_token = cf_config.get('api_token')
-    zone_id = cf_config.get('zone_id')
-    domain = cf_config.get('domain')
-
+    api_token, zone_id, domain = cf_config.get('api_token'), cf_config.get('zone_id'), cf_config.get('domain')
     if not all([api_token, zone_id, domain]):
+        return None
+    key = (api_token, zone_id, domain)
+    with _cloudflare_clients_lock:
+        client = _cloudflare_clients.get(key)
+        if client is None:
+            _cloudflare_clients.clear()
+            client = _cloudflare_clients[key] = CloudflareDnsClient(api_token, zone_id, domain)
+        return client
+
+def _update_cloudflare_dns(subdomain, ip_address, record_type='A'):
+    client = _get_cloudflare_client()
+    if client is None:
         logging.warning("Cloudflare 未配置，跳过 DNS 更新。")
         return "Cloudflare 未配置，跳过 DNS 更新。"
 
-    full_domain = f"{subdomain}.{domain}"
-    api_url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records"
-    headers = {
-        "Authorization": f"Bearer {api_token}",
-        "Content-Type": "application/json"
-    }
-
+    full_domain = client.full_name(subdomain)
     try:
-        search_params = {'type': record_type, 'name': full_domain}
-        response = requests.get(api_url, headers=headers, params=search_params, timeout=15)
-        response.raise_for_status()
-        search_result = response.json()
-
-        dns_payload = {
-            'type': record_type,
-            'name': full_domain,
-            'content': ip_address,
-            'ttl': 60,
-            'proxied': False
-        }
-
-        if search_result['result']:
-            record_id = search_result['result'][0]['id']
-            update_url = f"{api_url}/{record_id}"
-            response = requests.put(update_url, headers=headers, json=dns_payload, timeout=15)
-            action_log = "更新"
-        else:
-            response = requests.post(api_url, headers=headers, json=dns_payload, timeout=15)
-            action_log = "创建"
-
-        response.raise_for_status()
-        result_data = response.json()
-
-        if result_data['success']:
-            msg = f"✅ Cloudflare DNS 记录: {full_domain} -> {ip_address}"
-            logging.info(f"成功 {action_log} Cloudflare DNS 记录: {full_domain} -> {ip_address}")
-            return msg
-        else:
-            errors = result_data.get('errors', [{'message': '未知错误'}])
-            error_msg = ', '.join([e['message'] for e in errors])
-            msg = f"❌ {action_log} Cloudflare DNS 记录失败: {error_msg}"
-            logging.error(msg)
-            return msg
-
+        action_log = client.upsert(subdomain, ip_address, record_type)
+        logging.info(f"成功 {action_log} Cloudflare DNS 记录: {full_domain} -> {ip_address}")
+        return f"✅ Cloudflare DNS 记录: {full_domain} -> {ip_address}"
+    except requests.HTTPError as e:
+        msg = f"❌ 更新 Cloudflare DNS 记录失败: {e}"
+        logging.error(msg)
+        return msg
     except requests.RequestException as e:
         msg = f"❌ 更新 Cloudflare DNS 时发生网络错误: {e}"
         logging.error(msg)
@@ -420,6 +955,432 @@ def _update_cloudflare_dns(subdomain, ip_address, record_type='A'):
         logging.error(msg)
         return msg
 
+def _update_cloudflare_dns_batch(entries):
+    """批量更新 [(subdomain, ip_address, record_type)]，返回对应的结果消息列表。"""
+    if not entries:
+        return []
+    client = _get_cloudflare_client()
+    if client is None:
+        logging.warning("Cloudflare 未配置，跳过 DNS 更新。")
+        return ["Cloudflare 未配置，跳过 DNS 更新。"] * len(entries)
+    try:
+        return client.upsert_many(entries)
+    except Exception as e:
+        logging.error(f"批量更新 Cloudflare DNS 失败: {e}")
+        return [f"❌ 批量更新 Cloudflare DNS 失败: {e}"] * len(entries)
+
+# --- DNS 更新发件箱 ---
+# 需要变更的 DNS 记录先写入 dns_outbox 表，调用方立即返回；由单个消费任务批量提交到 Cloudflare。
+# 同一名称+类型只保留最新一条 (旧的标记为 superseded)，失败按指数退避重试，
+# 最终结果写回发起任务：JSON 结果写入 writeback_path，文本结果替换其中的排队占位文字。
+DNS_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('DNS_OUTBOX_MAX_ATTEMPTS', 6))
+DNS_OUTBOX_BACKOFF_BASE = 5
+DNS_OUTBOX_BACKOFF_MAX = 300
+DNS_OUTBOX_LOCK_KEY = "oci:lock:dns_outbox"
+# 已投递、尚未开始运行的唤醒标记：标记存在时新登记的记录不再重复投递消费任务
+DNS_OUTBOX_WAKEUP_KEY = "oci:dns_outbox:wakeup"
+DNS_OUTBOX_WAKEUP_TTL = 60
+_dns_outbox_local_lock = threading.Lock()
+
+def _init_dns_outbox_table(cursor):
+    cursor.executescript("""
+    CREATE TABLE IF NOT EXISTS dns_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, record_type TEXT NOT NULL, content TEXT NOT NULL,
+        status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL,
+        last_error TEXT, message TEXT, task_id TEXT, writeback_path TEXT, placeholder TEXT, created_at TEXT, updated_at TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_dns_outbox_pending ON dns_outbox (status, next_attempt_at);
+    """)
+
+def _dns_outbox_writeback(row, status, message):
+    if not row['task_id']:
+        return
+    # 任务仍在运行时 result 为 JSON，在指定路径写入 {status, message}；已结束的任务 result 为文本，替换占位文字
+    state = json.dumps({"status": status, "message": message, "updated_at": datetime.datetime.now(timezone.utc).isoformat()})
+    _db_execute_celery("UPDATE tasks SET result = CASE "
+                       "WHEN ? IS NOT NULL AND json_valid(result) THEN json_set(result, ?, json(?)) "
+                       "WHEN ? IS NOT NULL THEN replace(result, ?, ?) ELSE result END WHERE id = ?",
+                       (row['writeback_path'], row['writeback_path'], state,
+                        row['placeholder'], row['placeholder'], message, row['task_id']), task_id=row['task_id'])
+
+def _flush_dns_writebacks(task_id):
+    """任务写入最终结果后调用：补写在此之前已完成的 DNS 更新，避免占位文字被最终结果覆盖后无人替换。"""
+    for row in query_db("SELECT * FROM dns_outbox WHERE task_id = ? AND status != 'pending'", [task_id]):
+        _dns_outbox_writeback(row, row['status'], row['message'] or '')
+
+def _enqueue_dns_update(subdomain, ip_address, record_type='A', task_id=None, writeback_path=None):
+    """登记一条 DNS 更新并唤醒消费任务，返回可直接放入任务结果的占位文字。"""
+    now = datetime.datetime.now(timezone.utc).isoformat()
+    placeholder = f"⏳ DNS 记录排队更新中: {subdomain} -> {ip_address} ({uuid.uuid4().hex[:6]})"
+    db = get_db_connection(timeout=20)
+    try:
+        # 读取、取代与插入在同一个写事务中完成，并发登记同一名称时不会留下两条 pending 记录
+        db.execute("BEGIN IMMEDIATE")
+        superseded = db.execute("SELECT * FROM dns_outbox WHERE name = ? AND record_type = ? AND status = 'pending'",
+                                (subdomain, record_type)).fetchall()
+        db.execute("UPDATE dns_outbox SET status = 'superseded', message = ?, updated_at = ? WHERE name = ? AND record_type = ? AND status = 'pending'",
+                   (f"↪️ DNS 更新已被更新的记录取代: {subdomain} -> {ip_address}", now, subdomain, record_type))
+        db.execute("INSERT INTO dns_outbox (name, record_type, content, status, next_attempt_at, task_id, writeback_path, placeholder, created_at, updated_at) "
+                   "VALUES (?, ?, ?, 'pending', ?, ?, ?, ?, ?, ?)",
+                   (subdomain, record_type, ip_address, time.time(), task_id, writeback_path, placeholder, now, now))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    for row in superseded:
+        _dns_outbox_writeback(row, 'superseded', f"↪️ DNS 更新已被更新的记录取代: {subdomain} -> {ip_address}")
+    _wake_dns_outbox()
+    return placeholder
+
+def _wake_dns_outbox():
+    """投递一次消费任务；已有尚未开始运行的唤醒时跳过，连续登记只产生一次投递。"""
+    if redis_client is not None:
+        try:
+            if not redis_client.set(DNS_OUTBOX_WAKEUP_KEY, 1, nx=True, ex=DNS_OUTBOX_WAKEUP_TTL):
+                return
+        except Exception as e:
+            logging.warning(f"设置 DNS 发件箱唤醒标记失败: {e}")
+    _dns_outbox_task.delay()
+
+def _dns_outbox_lock():
+    if redis_client is None:
+        return _dns_outbox_local_lock if _dns_outbox_local_lock.acquire(blocking=False) else None
+    lock = redis_client.lock(DNS_OUTBOX_LOCK_KEY, timeout=300)
+    return lock if lock.acquire(blocking=False) else None
+
+def _process_dns_outbox_batch():
+    """处理一批到期记录，返回处理条数。"""
+    rows = query_db("SELECT * FROM dns_outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                    (time.time(), CF_BATCH_SIZE))
+    if not rows:
+        return 0
+    # 登记时已合并同名记录，这里再兜底一次：同名只提交最新一条
+    latest = {}
+    for row in rows:
+        latest[(row['name'], row['record_type'])] = row
+    now = datetime.datetime.now(timezone.utc).isoformat()
+    for row in rows:
+        if latest[(row['name'], row['record_type'])]['id'] != row['id']:
+            newer = latest[(row['name'], row['record_type'])]
+            message = f"↪️ DNS 更新已被更新的记录取代: {newer['name']} -> {newer['content']}"
+            _db_execute_celery("UPDATE dns_outbox SET status = 'superseded', message = ?, updated_at = ? WHERE id = ?", (message, now, row['id']))
+            _dns_outbox_writeback(row, 'superseded', message)
+
+    batch = list(latest.values())
+    messages = _update_cloudflare_dns_batch([(row['name'], row['content'], row['record_type']) for row in batch])
+    for row, message in zip(batch, messages):
+        attempts = row['attempts'] + 1
+        if message.startswith("✅") or message.startswith("Cloudflare 未配置"):
+            _db_execute_celery("UPDATE dns_outbox SET status = 'done', attempts = ?, last_error = NULL, message = ?, updated_at = ? WHERE id = ?",
+                               (attempts, message, now, row['id']))
+            _dns_outbox_writeback(row, 'done', message)
+        elif attempts >= DNS_OUTBOX_MAX_ATTEMPTS:
+            message = f"{message} (已重试 {attempts} 次)"
+            _db_execute_celery("UPDATE dns_outbox SET status = 'failed', attempts = ?, last_error = ?, message = ?, updated_at = ? WHERE id = ?",
+                               (attempts, message, message, now, row['id']))
+            _dns_outbox_writeback(row, 'failed', message)
+        else:
+            delay = min(DNS_OUTBOX_BACKOFF_BASE * (2 ** (attempts - 1)), DNS_OUTBOX_BACKOFF_MAX)
+            _db_execute_celery("UPDATE dns_outbox SET attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ? AND status = 'pending'",
+                               (attempts, time.time() + delay, message, now, row['id']))
+            logging.warning(f"DNS 更新 {row['name']} -> {row['content']} 失败 (第 {attempts} 次)，{delay} 秒后重试: {message}")
+    return len(rows)
+
+@celery.task
+def _dns_outbox_task():
+    # 先清除唤醒标记：此后登记的记录会重新投递，或由本次运行在释放锁后的检查中处理
+    if redis_client is not None:
+        try: redis_client.delete(DNS_OUTBOX_WAKEUP_KEY)
+        except Exception: pass
+    lock = _dns_outbox_lock()
+    if lock is None:
+        # 已有消费者在运行，它会处理新登记的记录
+        return
+    try:
+        while _process_dns_outbox_batch():
+            pass
+    except Exception as e:
+        logging.error(f"处理 DNS 发件箱失败: {e}")
+    finally:
+        try: lock.release()
+        except Exception: pass
+    # 释放锁之后再检查一次，避免错过持锁期间登记的记录；未到期的重试按最早时间延后唤醒
+    row = query_db("SELECT MIN(next_attempt_at) AS next_at FROM dns_outbox WHERE status = 'pending'", one=True)
+    if row and row['next_at'] is not None:
+        _dns_outbox_task.apply_async(countdown=max(0, row['next_at'] - time.time()))
+
+def resume_dns_outbox():
+    """worker 启动时继续处理重启前未完成的 DNS 更新。"""
+    row = query_db("SELECT COUNT(*) AS pending FROM dns_outbox WHERE status = 'pending'", one=True)
+    if row and row['pending']:
+        logging.info(f"DNS 发件箱中有 {row['pending']} 条待处理记录，继续处理。")
+        _wake_dns_outbox()
+
+# --- Telegram 通知队列 ---
+# send_tg_notification 把消息写入 Redis 列表 (没有 Redis 时为进程内队列)，进程重启或崩溃不会丢失待发消息。
+# 各进程的发送线程通过 Redis 锁选出唯一的发送者，由它通过持久 Session 发出；消息发出后才从队列移除
+# (发送中途崩溃时可能重复发送一次，但不会丢失)。同一聊天在 TG_COALESCE_WINDOW 秒内到达的消息合并为一条；
+# 每个聊天与全局的发送间隔通过 Redis 协调；遇到 429 按 retry_after 等待后重试。
+# 合并后的 Markdown 消息被拒绝 (400) 时逐条重发，单条仍被拒绝则改为纯文本发送。
+TG_API_BASE = "https://api.telegram.org"
+TG_COALESCE_WINDOW = float(os.environ.get('TG_COALESCE_WINDOW', 1.5))
+TG_PER_CHAT_INTERVAL = 1.0         # 私聊: 每秒 1 条
+TG_GROUP_CHAT_INTERVAL = 3.0       # 群组: 每分钟 20 条
+TG_GLOBAL_INTERVAL = 1.0 / 30      # 全局: 每秒 30 条
+TG_MAX_MESSAGE_LENGTH = 4000
+TG_MAX_ATTEMPTS = 5
+TG_MESSAGE_SEPARATOR = "\n\n────────\n\n"
+TG_QUEUE_KEY = "oci:tg:queue"
+TG_QUEUE_PEEK = 100
+TG_SENDER_LOCK_KEY = "oci:tg:sender"
+TG_SENDER_LOCK_TTL = 60
+TG_SENDER_POLL = 5.0               # 空闲或未拿到发送锁时检查队列的间隔 (秒)
+
+# 仅当锁仍属于本发送者时续期 / 释放，避免锁过期后被其他进程取得时误操作
+_TG_SENDER_RENEW_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_TG_SENDER_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class TelegramNotifier:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = []          # Redis 不可用时的进程内队列
+        self._sending = 0
+        self._thread = None
+        self._local_next_send = {}
+        self._lock_token = uuid.uuid4().hex
+        self._renew_script = None
+        self._release_script = None
+        self.session = requests.Session()
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+    def enqueue(self, chat_id, message):
+        # 队列中不保存 bot_token，发送时再从配置读取
+        entry = {"chat_id": str(chat_id), "message": message, "queued_at": time.time()}
+        stored = False
+        if redis_client is not None:
+            try:
+                redis_client.rpush(TG_QUEUE_KEY, json.dumps(entry))
+                stored = True
+            except Exception as e:
+                logging.warning(f"Telegram 消息写入 Redis 队列失败，改用进程内队列: {e}")
+        with self._cond:
+            if not stored:
+                self._pending.append(entry)
+            self._ensure_started()
+            self._cond.notify()
+
+    def start(self):
+        """worker 启动时调用，继续发送重启前留在 Redis 队列中的消息。"""
+        with self._cond:
+            self._ensure_started()
+
+    def _ensure_started(self):
+        if not (self._thread and self._thread.is_alive()):
+            self._thread = threading.Thread(target=self._run, name="tg-notifier", daemon=True)
+            self._thread.start()
+
+    def flush(self, timeout=10):
+        """等待进程内队列与正在发送的批次完成 (进程退出前调用)。Redis 队列中的消息由其他进程或重启后继续发送。"""
+        deadline = time.time() + timeout
+        with self._cond:
+            while (self._pending or self._sending) and time.time() < deadline:
+                self._cond.wait(0.2)
+
+    def _scripts(self):
+        if self._renew_script is None:
+            self._renew_script = redis_client.register_script(_TG_SENDER_RENEW_LUA)
+            self._release_script = redis_client.register_script(_TG_SENDER_RELEASE_LUA)
+        return self._renew_script, self._release_script
+
+    def _hold_sender_lock(self):
+        """获取或续期发送锁；其他进程正在发送时返回 False。"""
+        if redis_client is None:
+            return True
+        try:
+            if redis_client.set(TG_SENDER_LOCK_KEY, self._lock_token, nx=True, px=TG_SENDER_LOCK_TTL * 1000):
+                return True
+            renew_script, _ = self._scripts()
+            return bool(renew_script(keys=[TG_SENDER_LOCK_KEY], args=[self._lock_token, TG_SENDER_LOCK_TTL * 1000]))
+        except Exception as e:
+            logging.warning(f"获取 Telegram 发送锁失败: {e}")
+            return True
+
+    def _release_sender_lock(self):
+        if redis_client is None:
+            return
+        try:
+            _, release_script = self._scripts()
+            release_script(keys=[TG_SENDER_LOCK_KEY], args=[self._lock_token])
+        except Exception:
+            pass
+
+    def _peek(self):
+        """返回队首的待发送消息 [(entry, raw)]，raw 为 Redis 中的原始字符串 (进程内队列为 None)。"""
+        entries = []
+        if redis_client is not None:
+            try:
+                for raw in redis_client.lrange(TG_QUEUE_KEY, 0, TG_QUEUE_PEEK - 1):
+                    try:
+                        entries.append((json.loads(raw), raw))
+                    except json.JSONDecodeError:
+                        redis_client.lrem(TG_QUEUE_KEY, 1, raw)
+            except Exception as e:
+                logging.warning(f"读取 Telegram 队列失败: {e}")
+        with self._cond:
+            entries += [(entry, None) for entry in self._pending]
+        return entries
+
+    def _ack(self, batch):
+        for entry, raw in batch:
+            if raw is None:
+                with self._cond:
+                    self._pending = [e for e in self._pending if e is not entry]
+                continue
+            try:
+                redis_client.lrem(TG_QUEUE_KEY, 1, raw)
+            except Exception as e:
+                logging.warning(f"从 Telegram 队列移除已发送消息失败: {e}")
+
+    def _take_batch(self):
+        """取出队首聊天的一批消息 (等满合并窗口)，队列为空时返回 None。"""
+        entries = self._peek()
+        if not entries:
+            return None
+        wait = entries[0][0]['queued_at'] + TG_COALESCE_WINDOW - time.time()
+        if wait > 0:
+            time.sleep(wait)
+            entries = self._peek()
+        first = entries[0][0]
+        batch, length = [], 0
+        for entry, raw in entries:
+            if entry['chat_id'] != first['chat_id']:
+                continue
+            if batch and length + len(entry['message']) + len(TG_MESSAGE_SEPARATOR) > TG_MAX_MESSAGE_LENGTH:
+                break
+            batch.append((entry, raw))
+            length += len(entry['message']) + len(TG_MESSAGE_SEPARATOR)
+        return batch
+
+    def _idle_wait(self):
+        # 本进程有新消息时由 enqueue 提前唤醒
+        with self._cond:
+            self._cond.wait(TG_SENDER_POLL)
+
+    def _run(self):
+        while True:
+            if not self._hold_sender_lock():
+                self._idle_wait()
+                continue
+            batch = self._take_batch()
+            if not batch:
+                self._release_sender_lock()
+                self._idle_wait()
+                continue
+            with self._cond:
+                self._sending += 1
+            try:
+                self._deliver(batch)
+            except Exception as e:
+                logging.error(f"发送Telegram消息时发生未知错误: {e}")
+            finally:
+                self._ack(batch)
+                with self._cond:
+                    self._sending -= 1
+                    self._cond.notify_all()
+
+    def _deliver(self, batch):
+        chat_id = batch[0][0]['chat_id']
+        bot_token = load_tg_config().get('bot_token')
+        if not bot_token:
+            logging.warning(f"Telegram bot_token 未配置，丢弃 {len(batch)} 条待发送消息。")
+            return
+        texts = [entry['message'] for entry, _ in batch]
+        status = self._send(bot_token, chat_id, TG_MESSAGE_SEPARATOR.join(texts), len(texts))
+        if status != 400:
+            return
+        if len(texts) > 1:
+            # 一条格式错误的消息会让整批被拒绝，逐条重发把影响限制在它自己
+            logging.warning(f"合并的 Telegram 消息被拒绝，逐条重发 {len(texts)} 条消息。")
+            results = [(text, self._send(bot_token, chat_id, text, 1)) for text in texts]
+        else:
+            results = [(texts[0], status)]
+        for text, result in results:
+            if result == 400:
+                self._send(bot_token, chat_id, text, 1, parse_mode=None)
+
+    def _wait_for_slot(self, key, interval):
+        """按 key 限速：同一时刻只有一个发送者能拿到间隔内的发送名额。"""
+        if redis_client is not None:
+            try:
+                while not redis_client.set(f"oci:tg:rate:{key}", 1, nx=True, px=max(1, int(interval * 1000))):
+                    ttl = redis_client.pttl(f"oci:tg:rate:{key}")
+                    time.sleep(max(ttl, 10) / 1000)
+                return
+            except Exception as e:
+                logging.warning(f"Telegram 限速使用 Redis 失败，改用进程内限速: {e}")
+        wait = self._local_next_send.get(key, 0) - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self._local_next_send[key] = time.time() + interval
+
+    def _send(self, bot_token, chat_id, text, count, parse_mode='Markdown'):
+        """发送一条消息，返回最终的 HTTP 状态码；重试用尽时返回 None。"""
+        url = f"{TG_API_BASE}/bot{bot_token}/sendMessage"
+        payload = {'chat_id': chat_id, 'text': text}
+        if parse_mode:
+            payload['parse_mode'] = parse_mode
+        chat_interval = TG_GROUP_CHAT_INTERVAL if chat_id.startswith('-') else TG_PER_CHAT_INTERVAL
+        for attempt in range(1, TG_MAX_ATTEMPTS + 1):
+            # 长时间的重试等待期间续期发送锁，避免其他进程重复发送同一批消息
+            self._hold_sender_lock()
+            self._wait_for_slot(f"chat:{chat_id}", chat_interval)
+            self._wait_for_slot("global", TG_GLOBAL_INTERVAL)
+            try:
+                response = self.session.post(url, json=payload, timeout=10)
+            except requests.RequestException as e:
+                logging.error(f"发送Telegram消息时发生网络错误 (第 {attempt} 次): {e}")
+                time.sleep(min(2 ** attempt, 30))
+                continue
+            if response.status_code == 200:
+                logging.info(f"Telegram消息已成功发送至 Chat ID: {chat_id} (合并 {count} 条)")
+                return 200
+            if response.status_code == 429:
+                try:
+                    retry_after = response.json().get('parameters', {}).get('retry_after', 5)
+                except ValueError:
+                    retry_after = 5
+                logging.warning(f"Telegram 限流，{retry_after} 秒后重试。")
+                time.sleep(retry_after)
+                continue
+            if response.status_code >= 500:
+                logging.error(f"发送Telegram消息失败 (第 {attempt} 次): {response.status_code} - {response.text}")
+                time.sleep(min(2 ** attempt, 30))
+                continue
+            logging.error(f"发送Telegram消息失败: {response.status_code} - {response.text}")
+            return response.status_code
+        logging.error(f"发送Telegram消息失败: 已重试 {TG_MAX_ATTEMPTS} 次，放弃 ({count} 条消息)")
+        return None
+
+_tg_notifier = TelegramNotifier()
+atexit.register(_tg_notifier.flush)
+
+def resume_tg_notifications():
+    """worker 启动时继续发送重启前未发出的 Telegram 通知。"""
+    _tg_notifier.start()
+
 def send_tg_notification(message):
     tg_config = load_tg_config()
     bot_token = tg_config.get('bot_token')
@@ -427,23 +1388,42 @@ def send_tg_notification(message):
     if not bot_token or not chat_id:
         logging.info("Telegram bot_token或chat_id未配置，跳过发送。")
         return
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    payload = {'chat_id': chat_id, 'text': message, 'parse_mode': 'Markdown'}
-    try:
-        response = requests.post(url, json=payload, timeout=10)
-        if response.status_code == 200:
-            logging.info(f"Telegram消息已成功发送至 Chat ID: {chat_id}")
-        else:
-            logging.error(f"发送Telegram消息失败: {response.status_code} - {response.text}")
-    except requests.RequestException as e:
-        logging.error(f"发送Telegram消息时发生网络错误: {e}")
-    except Exception as e:
-        logging.error(f"发送Telegram消息时发生未知错误: {e}")
+    _tg_notifier.enqueue(chat_id, message)
 
 def generate_oci_password(length=16):
     chars = string.ascii_letters + string.digits
     return ''.join(random.choice(chars) for _ in range(length))
 
+# --- OCI SDK 调用计时 ---
+# 所有 OCI 客户端的请求最终都经过 BaseClient.call_api，在此统一记录耗时与错误码
+def _instrument_oci_sdk():
+    base_client_cls = oci.base_client.BaseClient
+    if getattr(base_client_cls.call_api, '_metrics_wrapped', False):
+        return
+    original_call_api = base_client_cls.call_api
+
+    @wraps(original_call_api)
+    def call_api(self, *args, **kwargs):
+        operation = kwargs.get('operation_name') or kwargs.get('method') or 'unknown'
+        service = getattr(self, 'service', 'unknown')
+        start = time.perf_counter()
+        try:
+            return original_call_api(self, *args, **kwargs)
+        except ServiceError as e:
+            metrics.inc('cloud_sdk_errors_total', provider='oci', service=service, operation=operation, status=e.status)
+            raise
+        except Exception:
+            metrics.inc('cloud_sdk_errors_total', provider='oci', service=service, operation=operation, status='client_error')
+            raise
+        finally:
+            metrics.observe('cloud_sdk_request_duration_seconds', time.perf_counter() - start,
+                            provider='oci', service=service, operation=operation)
+
+    call_api._metrics_wrapped = True
+    base_client_cls.call_api = call_api
+
+_instrument_oci_sdk()
+
 def get_oci_clients(profile_config, validate=True):
     key_file_path = None
     try:
@@ -515,16 +1495,16 @@ def _ensure_subnet_in_profile(task_id, alias, vnet_client, tenancy_ocid):
                 return default_subnet.id
     except Exception as e:
         logging.error(f"An error occurred during auto-discovery: {e}. Falling back to creation.")
-    if task_id: _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('首次运行，正在自动创建网络资源 (VCN, 子网等)，预计需要2-3分钟...', task_id))
+    if task_id: _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('首次运行，正在自动创建网络资源 (VCN, 子网等)，预计需要2-3分钟...', task_id), task_id=task_id)
     vcn_name = f"vcn-autocreated-{alias}-{random.randint(100, 999)}"
     vcn_details = CreateVcnDetails(cidr_block="10.0.0.0/16", display_name=vcn_name, compartment_id=tenancy_ocid)
     vcn = vnet_client.create_vcn(vcn_details).data
-    if task_id: _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(1/3) VCN 已创建，正在等待其生效...', task_id))
-    oci.wait_until(vnet_client, vnet_client.get_vcn(vcn.id), 'lifecycle_state', 'AVAILABLE')
+    if task_id: _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(1/3) VCN 已创建，正在等待其生效...', task_id), task_id=task_id)
+    _lifecycle_watcher.wait_for(vnet_client, tenancy_ocid, 'vcn', vcn.id, 'AVAILABLE')
     ig_name = f"ig-autocreated-{alias}-{random.randint(100, 999)}"
     ig_details = CreateInternetGatewayDetails(display_name=ig_name, compartment_id=tenancy_ocid, is_enabled=True, vcn_id=vcn.id)
     ig = vnet_client.create_internet_gateway(ig_details).data
-    if task_id: _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(2/3) 互联网网关已创建并添加路由...', task_id))
+    if task_id: _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(2/3) 互联网网关已创建并添加路由...', task_id), task_id=task_id)
     oci.wait_until(vnet_client, vnet_client.get_internet_gateway(ig.id), 'lifecycle_state', 'AVAILABLE')
     route_table_id = vcn.default_route_table_id
     rt_rules = vnet_client.get_route_table(route_table_id).data.route_rules
@@ -533,8 +1513,8 @@ def _ensure_subnet_in_profile(task_id, alias, vnet_client, tenancy_ocid):
     subnet_name = f"subnet-autocreated-{alias}-{random.randint(100, 999)}"
     subnet_details = CreateSubnetDetails(compartment_id=tenancy_ocid, vcn_id=vcn.id, cidr_block="10.0.1.0/24", display_name=subnet_name)
     subnet = vnet_client.create_subnet(subnet_details).data
-    if task_id: _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(3/3) 子网已创建，网络设置完成！', task_id))
-    oci.wait_until(vnet_client, vnet_client.get_subnet(subnet.id), 'lifecycle_state', 'AVAILABLE')
+    if task_id: _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(3/3) 子网已创建，网络设置完成！', task_id), task_id=task_id)
+    _lifecycle_watcher.wait_for(vnet_client, tenancy_ocid, 'subnet', subnet.id, 'AVAILABLE')
     all_data["profiles"][alias]['default_subnet_ocid'] = subnet.id
     save_profiles(all_data)
     return subnet.id
@@ -598,87 +1578,289 @@ done
     script = "\n".join(script_parts)
     return base64.b64encode(script.encode('utf-8')).decode('utf-8')
 
+# --- IPv6 网络就绪缓存 ---
+# VCN 级 (IPv6 地址段、默认路由、安全规则) 与子网级 (IPv6 地址段) 的检查结果分别缓存，
+# 同一网络内后续的 ASSIGNIPV6 直接跳到 create_ipv6。VNIC 所属子网/VCN 不会改变，长期缓存。
+# 首次配置时按 VCN 加锁 (进程内锁 + Redis 锁)，并发的分配请求不会重复执行配置步骤。
+IPV6_READY_TTL = int(os.environ.get('IPV6_READY_TTL', 6 * 3600))
+_ipv6_ready_cache = SharedTTLCache('ipv6_ready', IPV6_READY_TTL)
+_vnic_location_cache = SharedTTLCache('vnic_location', 7 * 86400)
+_ipv6_setup_locks = {}
+_ipv6_setup_locks_guard = threading.Lock()
+
+@contextmanager
+def _ipv6_setup_lock(vcn_id):
+    # 锁条目带引用计数，最后一个使用者退出时移除，字典大小只与正在配置的 VCN 数量有关
+    with _ipv6_setup_locks_guard:
+        entry = _ipv6_setup_locks.setdefault(vcn_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            redis_lock = None
+            if redis_client is not None:
+                try:
+                    redis_lock = redis_client.lock(f"oci:lock:ipv6_setup:{vcn_id}", timeout=600, blocking_timeout=600)
+                    if not redis_lock.acquire():
+                        redis_lock = None
+                except Exception as e:
+                    logging.warning(f"获取 VCN {vcn_id} 的 IPv6 配置锁失败，仅使用进程内锁: {e}")
+                    redis_lock = None
+            try:
+                yield
+            finally:
+                if redis_lock is not None:
+                    try: redis_lock.release()
+                    except Exception: pass
+    finally:
+        with _ipv6_setup_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                _ipv6_setup_locks.pop(vcn_id, None)
+
+def _vnic_location(vnet_client, vnic_id):
+    """返回 {'subnet_id', 'vcn_id'}。"""
+    def load():
+        subnet_id = vnet_client.get_vnic(vnic_id).data.subnet_id
+        return {"subnet_id": subnet_id, "vcn_id": vnet_client.get_subnet(subnet_id).data.vcn_id}
+    return _vnic_location_cache.get_or_load(vnic_id, load)
+
+def _invalidate_ipv6_readiness(vnet_client, vnic_id):
+    location = _vnic_location(vnet_client, vnic_id)
+    _ipv6_ready_cache.invalidate(f"vcn:{location['vcn_id']}")
+    _ipv6_ready_cache.invalidate(f"subnet:{location['subnet_id']}")
+
 def _enable_ipv6_networking(task_id, vnet_client, vnic_id):
-    _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(1/5) 正在获取网络资源...', task_id))
-    vnic = vnet_client.get_vnic(vnic_id).data
-    subnet = vnet_client.get_subnet(vnic.subnet_id).data
-    vcn = vnet_client.get_vcn(subnet.vcn_id).data
-    
-    # --- 1. 检查并开启 VCN IPv6 ---
-    if not vcn.ipv6_cidr_blocks:
-        _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(2/5) 正在为VCN开启IPv6...', task_id))
-        details = AddVcnIpv6CidrDetails(is_oracle_gua_allocation_enabled=True)
-        vnet_client.add_ipv6_vcn_cidr(vcn_id=vcn.id, add_vcn_ipv6_cidr_details=details)
-        oci.wait_until(vnet_client, vnet_client.get_vcn(vcn.id), 'lifecycle_state', 'AVAILABLE', max_wait_seconds=300)
-        vcn = vnet_client.get_vcn(vcn.id).data
-        logging.info(f"VCN {vcn.id} 已成功开启IPv6，地址段: {vcn.ipv6_cidr_blocks}")
-    
-    # --- 2. 检查并分配 Subnet IPv6 ---
-    if not subnet.ipv6_cidr_block:
-        _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(3/5) 正在为子网分配IPv6地址段...', task_id))
-        vcn_ipv6_cidr = vcn.ipv6_cidr_blocks[0]
-        # 通常将 /56 的 VCN CIDR 分割给子网使用，这里简单替换为 /64
-        subnet_ipv6_cidr = vcn_ipv6_cidr.replace('/56', '/64')
-        details = UpdateSubnetDetails(ipv6_cidr_block=subnet_ipv6_cidr)
-        vnet_client.update_subnet(subnet.id, details)
-        oci.wait_until(vnet_client, vnet_client.get_subnet(subnet.id), 'lifecycle_state', 'AVAILABLE', max_wait_seconds=300)
-        logging.info(f"Subnet {subnet.id} 已成功分配IPv6地址段: {subnet_ipv6_cidr}")
-
-    # --- 3. 更新路由表 (Route Table) ---
-    _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(4/5) 正在更新路由表以支持IPv6...', task_id))
-    route_table = vnet_client.get_route_table(vcn.default_route_table_id).data
-    igws = vnet_client.list_internet_gateways(compartment_id=vcn.compartment_id, vcn_id=vcn.id).data
-    if not igws:
-        raise Exception("未找到互联网网关，无法为IPv6添加路由规则。")
-    igw_id = igws[0].id
-    
-    ipv6_route_exists = any(rule.destination == '::/0' for rule in route_table.route_rules)
-    if not ipv6_route_exists:
-        new_rules = list(route_table.route_rules)
-        new_rules.append(RouteRule(destination='::/0', network_entity_id=igw_id))
-        vnet_client.update_route_table(route_table.id, UpdateRouteTableDetails(route_rules=new_rules))
-        logging.info(f"已为路由表 {route_table.id} 添加IPv6默认路由。")
-
-    # --- 4. 更新安全列表 (Security List) - 包含入站和出站 ---
-    _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(5/5) 正在更新安全规则(入站/出站)以支持IPv6...', task_id))
-    security_list = vnet_client.get_security_list(vcn.default_security_list_id).data
-    
-    current_egress = list(security_list.egress_security_rules)
-    current_ingress = list(security_list.ingress_security_rules)
-    has_changes = False
-
-    # 4.1 检查出站 (Egress) ::/0
-    if not any(rule.destination == '::/0' for rule in current_egress):
-        current_egress.append(EgressSecurityRule(
-            destination='::/0', 
-            protocol='all', 
-            is_stateless=False,
-            destination_type='CIDR_BLOCK'
-        ))
-        has_changes = True
-        logging.info("准备添加 IPv6 出站规则")
-
-    # 4.2 检查入站 (Ingress) ::/0  <-- 这里是你缺失的部分
-    if not any(rule.source == '::/0' for rule in current_ingress):
-        current_ingress.append(IngressSecurityRule(
-            source='::/0', 
-            protocol='all', 
-            is_stateless=False, 
-            source_type='CIDR_BLOCK'
-        ))
-        has_changes = True
-        logging.info("准备添加 IPv6 入站规则")
-
-    # 4.3 提交更新
-    if has_changes:
-        update_details = UpdateSecurityListDetails(
-            egress_security_rules=current_egress,
-            ingress_security_rules=current_ingress
-        )
-        vnet_client.update_security_list(security_list.id, update_details)
-        logging.info(f"已成功为安全列表 {security_list.id} 更新 IPv6 规则。")
-    else:
-        logging.info("IPv6 安全规则已存在，无需更新。")
+    _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(1/5) 正在获取网络资源...', task_id), task_id=task_id)
+    location = _vnic_location(vnet_client, vnic_id)
+    vcn_key, subnet_key = f"vcn:{location['vcn_id']}", f"subnet:{location['subnet_id']}"
+    if _ipv6_ready_cache.get(vcn_key) and _ipv6_ready_cache.get(subnet_key):
+        logging.info(f"VCN {location['vcn_id']} / 子网 {location['subnet_id']} 的 IPv6 配置已验证，跳过配置步骤。")
+        return
+
+    with _ipv6_setup_lock(location['vcn_id']):
+        # 等锁期间其他任务可能已完成配置
+        vcn_ready = _ipv6_ready_cache.get(vcn_key)
+        subnet_ready = _ipv6_ready_cache.get(subnet_key)
+        if vcn_ready and subnet_ready:
+            return
+        subnet = vnet_client.get_subnet(location['subnet_id']).data
+        vcn = vnet_client.get_vcn(location['vcn_id']).data
+
+        # --- 1. 检查并开启 VCN IPv6 ---
+        if not vcn.ipv6_cidr_blocks:
+            _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(2/5) 正在为VCN开启IPv6...', task_id), task_id=task_id)
+            details = AddVcnIpv6CidrDetails(is_oracle_gua_allocation_enabled=True)
+            vnet_client.add_ipv6_vcn_cidr(vcn_id=vcn.id, add_vcn_ipv6_cidr_details=details)
+            _lifecycle_watcher.wait_for(vnet_client, vcn.compartment_id, 'vcn', vcn.id, 'AVAILABLE', max_wait_seconds=300)
+            vcn = vnet_client.get_vcn(vcn.id).data
+            logging.info(f"VCN {vcn.id} 已成功开启IPv6，地址段: {vcn.ipv6_cidr_blocks}")
+
+        # --- 2. 检查并分配 Subnet IPv6 ---
+        if not subnet.ipv6_cidr_block:
+            _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(3/5) 正在为子网分配IPv6地址段...', task_id), task_id=task_id)
+            vcn_ipv6_cidr = vcn.ipv6_cidr_blocks[0]
+            # 通常将 /56 的 VCN CIDR 分割给子网使用，这里简单替换为 /64
+            subnet_ipv6_cidr = vcn_ipv6_cidr.replace('/56', '/64')
+            details = UpdateSubnetDetails(ipv6_cidr_block=subnet_ipv6_cidr)
+            vnet_client.update_subnet(subnet.id, details)
+            _lifecycle_watcher.wait_for(vnet_client, subnet.compartment_id, 'subnet', subnet.id, 'AVAILABLE', max_wait_seconds=300)
+            logging.info(f"Subnet {subnet.id} 已成功分配IPv6地址段: {subnet_ipv6_cidr}")
+        _ipv6_ready_cache.set(subnet_key, {"verified_at": time.time()})
+
+        if vcn_ready:
+            return
+
+        # --- 3. 更新路由表 (Route Table) ---
+        _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(4/5) 正在更新路由表以支持IPv6...', task_id), task_id=task_id)
+        route_table = vnet_client.get_route_table(vcn.default_route_table_id).data
+        igws = vnet_client.list_internet_gateways(compartment_id=vcn.compartment_id, vcn_id=vcn.id).data
+        if not igws:
+            raise Exception("未找到互联网网关，无法为IPv6添加路由规则。")
+        igw_id = igws[0].id
+
+        ipv6_route_exists = any(rule.destination == '::/0' for rule in route_table.route_rules)
+        if not ipv6_route_exists:
+            new_rules = list(route_table.route_rules)
+            new_rules.append(RouteRule(destination='::/0', network_entity_id=igw_id))
+            vnet_client.update_route_table(route_table.id, UpdateRouteTableDetails(route_rules=new_rules))
+            logging.info(f"已为路由表 {route_table.id} 添加IPv6默认路由。")
+
+        # --- 4. 更新安全列表 (Security List) - 包含入站和出站 ---
+        _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('(5/5) 正在更新安全规则(入站/出站)以支持IPv6...', task_id), task_id=task_id)
+        security_list = vnet_client.get_security_list(vcn.default_security_list_id).data
+
+        current_egress = list(security_list.egress_security_rules)
+        current_ingress = list(security_list.ingress_security_rules)
+        has_changes = False
+
+        # 4.1 检查出站 (Egress) ::/0
+        if not any(rule.destination == '::/0' for rule in current_egress):
+            current_egress.append(EgressSecurityRule(
+                destination='::/0',
+                protocol='all',
+                is_stateless=False,
+                destination_type='CIDR_BLOCK'
+            ))
+            has_changes = True
+            logging.info("准备添加 IPv6 出站规则")
+
+        # 4.2 检查入站 (Ingress) ::/0  <-- 这里是你缺失的部分
+        if not any(rule.source == '::/0' for rule in current_ingress):
+            current_ingress.append(IngressSecurityRule(
+                source='::/0',
+                protocol='all',
+                is_stateless=False,
+                source_type='CIDR_BLOCK'
+            ))
+            has_changes = True
+            logging.info("准备添加 IPv6 入站规则")
+
+        # 4.3 提交更新
+        if has_changes:
+            update_details = UpdateSecurityListDetails(
+                egress_security_rules=current_egress,
+                ingress_security_rules=current_ingress
+            )
+            vnet_client.update_security_list(security_list.id, update_details)
+            logging.info(f"已成功为安全列表 {security_list.id} 更新 IPv6 规则。")
+        else:
+            logging.info("IPv6 安全规则已存在，无需更新。")
+        _ipv6_ready_cache.set(vcn_key, {"verified_at": time.time()})
+
+# --- 抢占任务控制通道 (Redis Pub/Sub) ---
+# 网页端 / API 发布 stop、pause、supersede 指令，worker 进程内由一个监听线程统一订阅，
+# 再分发给本进程内正在运行的抢占循环，取代每轮两次的数据库轮询。
+SNATCH_CONTROL_CHANNEL = "oci:snatch:control"
+
+class SnatchControlHandle:
+    """单个抢占循环的控制句柄。收到指令后 wait() 会被立即唤醒。"""
+    def __init__(self, task_id, run_id):
+        self.task_id = task_id
+        self.run_id = run_id
+        self.reason = None
+        # 任务行写入 running 与 run_id 之前为 False，数据库核对跳过未启动的句柄
+        self.started = False
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    def wait(self, seconds):
+        """可中断的 sleep，返回 True 表示任务已被取消。"""
+        return self._event.wait(seconds)
+
+class SnatchControlRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handles = {}
+        self._listener = None
+        self._connected = threading.Event()
+
+    def register(self, task_id, run_id):
+        handle = SnatchControlHandle(task_id, run_id)
+        with self._lock:
+            # 同一进程内的新 run_id 直接取代旧循环，无需等待 Redis 消息
+            for old in self._handles.get(task_id, set()):
+                if old.run_id != run_id:
+                    old.cancel('superseded')
+            self._handles.setdefault(task_id, set()).add(handle)
+        self._ensure_listener()
+        return handle
+
+    def unregister(self, handle):
+        with self._lock:
+            handles = self._handles.get(handle.task_id)
+            if handles:
+                handles.discard(handle)
+                if not handles:
+                    del self._handles[handle.task_id]
+
+    def is_live(self):
+        """监听线程是否已订阅成功；未订阅时调用方需回退到数据库检查。"""
+        return self._connected.is_set()
+
+    def dispatch(self, message):
+        task_id = message.get('task_id')
+        command = message.get('command')
+        with self._lock:
+            handles = list(self._handles.get(task_id, ()))
+        for handle in handles:
+            if command in ('stop', 'pause'):
+                handle.cancel(command)
+            elif command == 'supersede' and handle.run_id != message.get('run_id'):
+                handle.cancel('superseded')
+
+    def _ensure_listener(self):
+        if redis_client is None:
+            return
+        with self._lock:
+            if self._listener and self._listener.is_alive():
+                return
+            self._listener = threading.Thread(target=self._listen, name="snatch-control-listener", daemon=True)
+            self._listener.start()
+
+    def _listen(self):
+        backoff = 1
+        while True:
+            pubsub = None
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(SNATCH_CONTROL_CHANNEL)
+                # 订阅生效前 (首次连接前或断线期间) 发布的指令会丢失，每次订阅后都对所有已登记的循环做一次数据库核对
+                self._resync()
+                self._connected.set()
+                backoff = 1
+                for message in pubsub.listen():
+                    try:
+                        self.dispatch(json.loads(message['data']))
+                    except (json.JSONDecodeError, TypeError, KeyError):
+                        logging.warning(f"忽略无效的抢占控制消息: {message}")
+            except Exception as e:
+                logging.warning(f"抢占控制通道连接中断: {e}，{backoff} 秒后重连。")
+            finally:
+                self._connected.clear()
+                if pubsub is not None:
+                    try: pubsub.close()
+                    except Exception: pass
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    def _resync(self):
+        # 刚登记、尚未写入 running 的句柄此时任务行仍是 pending，不能据此取消
+        with self._lock:
+            handles = [h for hs in self._handles.values() for h in hs if h.started]
+        for handle in handles:
+            if not _snatch_run_is_current(handle.task_id, handle.run_id):
+                handle.cancel('resync')
+
+_snatch_control = SnatchControlRegistry()
+
+def publish_snatch_control(task_id, command, run_id=None):
+    """发布抢占任务控制指令: stop (删除) / pause (暂停) / supersede (新 run_id 接管)。"""
+    message = {"task_id": task_id, "command": command, "run_id": run_id}
+    _snatch_control.dispatch(message)
+    if redis_client is None:
+        return
+    try:
+        redis_client.publish(SNATCH_CONTROL_CHANNEL, json.dumps(message))
+    except Exception as e:
+        logging.warning(f"发布抢占控制指令失败 ({command} -> {task_id}): {e}")
+
+def _snatch_run_is_current(task_id, run_id):
+    """数据库兜底检查：任务仍在运行且 run_id 未被替换。"""
+    task = query_db('SELECT result, status FROM tasks WHERE id = ?', [task_id], one=True)
+    if not task or task['status'] != 'running':
+        return False
+    try:
+        return json.loads(task['result']).get('run_id') == run_id
+    except (json.JSONDecodeError, TypeError, AttributeError):
+        return False
 
 # --- Decorators ---
 def login_required(f):
@@ -721,7 +1903,7 @@ def oci_clients_required(f):
 @oci_bp.route("/")
 @login_required
 def oci_index():
-    return render_template("oci.html")
+    return render_template("oci.html", capacity_probe_default=SNATCH_CAPACITY_PROBE)
 
 # --- API Routes ---
 @oci_bp.route('/api/default-ssh-key', methods=['GET', 'POST'])
@@ -959,6 +2141,20 @@ def get_running_snatching_tasks():
         return jsonify(tasks_list)
     except Exception as e: return jsonify({"error": str(e)}), 500
 
+@oci_bp.route('/api/tasks/snatching/recovery-status', methods=['GET'])
+@login_required
+def get_snatch_recovery_status():
+    try:
+        return jsonify(get_recovery_progress() or {})
+    except Exception as e: return jsonify({"error": str(e)}), 500
+
+@oci_bp.route('/api/tasks/snatching/ad-stats', methods=['GET'])
+@login_required
+def get_snatch_ad_stats():
+    try:
+        return jsonify(_ad_bandit.snapshot())
+    except Exception as e: return jsonify({"error": str(e)}), 500
+
 @oci_bp.route('/api/tasks/snatching/completed', methods=['GET'])
 @login_required
 def get_completed_snatching_tasks():
@@ -971,7 +2167,7 @@ def delete_task_record(task_id):
     db = get_db()
     task = db.execute("SELECT status FROM tasks WHERE id = ?", [task_id]).fetchone()
     if task and task['status'] in ['success', 'failure', 'paused']:
-        celery.control.revoke(task_id, terminate=True, signal='SIGKILL')
+        publish_snatch_control(task_id, 'stop')
         db.execute('DELETE FROM tasks WHERE id = ?', (task_id,))
         db.commit()
         return jsonify({"success": True, "message": "任务记录已删除。"})
@@ -980,8 +2176,6 @@ def delete_task_record(task_id):
 @oci_bp.route('/api/tasks/<task_id>/stop', methods=['POST'])
 @login_required
 def stop_task(task_id):
-    celery.control.revoke(task_id, terminate=True, signal='SIGKILL')
-    
     task_data = query_db('SELECT result FROM tasks WHERE id = ?', [task_id], one=True)
     if task_data and task_data['result']:
         try:
@@ -995,7 +2189,8 @@ def stop_task(task_id):
     else:
         new_result = '{"last_message": "任务已被用户手动暂停。"}'
         
-    _db_execute_celery('UPDATE tasks SET status = ?, result = ? WHERE id = ?', ('paused', new_result, task_id))
+    _db_execute_celery('UPDATE tasks SET status = ?, result = ? WHERE id = ?', ('paused', new_result, task_id), task_id=task_id)
+    publish_snatch_control(task_id, 'pause')
     return jsonify({"success": True, "message": f"任务 {task_id} 已被暂停。"})
 
 @oci_bp.route('/api/tasks/resume', methods=['POST'])
@@ -1021,7 +2216,7 @@ def resume_tasks():
 
         if not profile_config:
             failed_tasks.append(task_id)
-            _db_execute_celery("UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?", ('failure', '任务因关联的账号配置被删除而恢复失败。', datetime.datetime.now(timezone.utc).isoformat(), task_id))
+            _db_execute_celery("UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?", ('failure', '任务因关联的账号配置被删除而恢复失败。', datetime.datetime.now(timezone.utc).isoformat(), task_id), task_id=task_id)
             continue
 
         try:
@@ -1034,7 +2229,8 @@ def resume_tasks():
             new_run_id = str(uuid.uuid4())
             result_json['run_id'] = new_run_id
 
-            _db_execute_celery('UPDATE tasks SET status = ?, result = ? WHERE id = ?', ('running', json.dumps(result_json), task_id))
+            _db_execute_celery('UPDATE tasks SET status = ?, result = ? WHERE id = ?', ('running', json.dumps(result_json), task_id), task_id=task_id)
+            publish_snatch_control(task_id, 'supersede', new_run_id)
             
             auto_bind_domain = original_details.get('auto_bind_domain', False)
             _snatch_instance_task.delay(task_id, profile_config, alias, original_details, new_run_id, auto_bind_domain)
@@ -1043,7 +2239,7 @@ def resume_tasks():
         except Exception as e:
             logging.error(f"恢复任务 {task_id} 失败: {e}")
             failed_tasks.append(task_id)
-            _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?', ('failure', f'手动恢复任务失败: {e}', datetime.datetime.now(timezone.utc).isoformat(), task_id))
+            _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?', ('failure', f'手动恢复任务失败: {e}', datetime.datetime.now(timezone.utc).isoformat(), task_id), task_id=task_id)
 
     message = f"成功恢复 {resumed_count} 个任务。"
     if failed_tasks:
@@ -1607,6 +2803,42 @@ def instance_action(alias):
     except Exception as e:
         return jsonify({"error": f"提交实例操作失败: {e}"}), 500
 
+@oci_bp.route('/api/bulk-instance-action', methods=['POST'])
+@login_required
+@timeout(10)
+def bulk_instance_action():
+    try:
+        data = request.json or {}
+        items, error = _validate_bulk_actions(data.get('actions'), load_profiles().get("profiles", {}))
+        if error:
+            return jsonify({"error": error}), 400
+        task_id = _create_bulk_action_task(items, 'web')
+        return jsonify({"message": f"已提交 {len(items)} 个实例操作...", "task_id": task_id})
+    except (sqlite3.OperationalError, TimeoutException) as e:
+        if isinstance(e, TimeoutException) or "database is locked" in str(e):
+            return jsonify({"error": "请求超时或数据库繁忙，请稍后重试。"}), 503
+        raise
+    except Exception as e:
+        return jsonify({"error": f"提交批量操作失败: {e}"}), 500
+
+@oci_bp.route('/api/bulk-rotate-ip', methods=['POST'])
+@login_required
+@timeout(10)
+def bulk_rotate_ip():
+    try:
+        data = request.json or {}
+        items, error = _validate_ip_rotation(data.get('instances'), load_profiles().get("profiles", {}))
+        if error:
+            return jsonify({"error": error}), 400
+        task_id = _create_ip_rotation_task(items, 'web', data.get('update_dns', True))
+        return jsonify({"message": f"已提交 {len(items)} 个实例的IP更换...", "task_id": task_id})
+    except (sqlite3.OperationalError, TimeoutException) as e:
+        if isinstance(e, TimeoutException) or "database is locked" in str(e):
+            return jsonify({"error": "请求超时或数据库繁忙，请稍后重试。"}), 503
+        raise
+    except Exception as e:
+        return jsonify({"error": f"提交批量换IP失败: {e}"}), 500
+
 @oci_bp.route('/api/network/resources')
 @login_required
 @oci_clients_required
@@ -1717,6 +2949,7 @@ def update_security_rules():
         )
 
         vnet_client.update_security_list(security_list_id, update_details)
+        _invalidate_security_list_firewall_state(security_list_id)
         return jsonify({"success": True, "message": "安全规则已成功更新！"})
     except TimeoutException:
         return jsonify({"error": "更新安全规则超时，请稍后重试。"}), 504
@@ -1787,6 +3020,11 @@ def launch_instance(alias, endpoint):
             logging.error(f"检查配额时发生严重错误: {e}")
             return jsonify({"error": f"检查配额时出错，请稍后重试: {e}"}), 500
 
+        # 多实例默认使用组抢占：一个协调器共享准备与尝试循环，每个实例仍保留独立的任务记录
+        group_snatch = instance_count > 1 and data.get('group_snatch', True)
+        group_id = str(uuid.uuid4()) if group_snatch else None
+        group_slots = []
+
         task_ids = []
         for i in range(instance_count):
             task_name = f"{display_name}-{i+1}" if instance_count > 1 else display_name
@@ -1797,8 +3035,15 @@ def launch_instance(alias, endpoint):
             task_data['auto_bind_domain'] = auto_bind_domain
             
             run_id = str(uuid.uuid4())
-            _snatch_instance_task.delay(task_id, profile_config, alias, task_data, run_id, auto_bind_domain)
+            if group_snatch:
+                task_data['group_id'] = group_id
+                group_slots.append([task_id, task_data, run_id])
+            else:
+                _snatch_instance_task.delay(task_id, profile_config, alias, task_data, run_id, auto_bind_domain)
             task_ids.append(task_id)
+
+        if group_snatch:
+            _snatch_group_task.delay(group_id, profile_config, alias, group_slots, auto_bind_domain)
             
         return jsonify({"message": f"已提交 {instance_count} 个抢占实例任务...", "task_ids": task_ids})
 
@@ -1810,6 +3055,14 @@ def launch_instance(alias, endpoint):
         logging.error(f"提交抢占任务失败: {e}")
         return jsonify({"error": f"提交抢占任务失败: {e}"}), 500
 
+@oci_bp.route('/api/task_status/batch', methods=['POST'])
+@login_required
+def batch_task_status():
+    task_ids, error = _parse_task_ids(request.json)
+    if error:
+        return jsonify({"error": error}), 400
+    return jsonify(_batch_task_statuses(task_ids))
+
 @oci_bp.route('/api/task_status/<task_id>')
 @login_required
 def task_status(task_id):
@@ -1821,7 +3074,7 @@ def task_status(task_id):
 # --- Celery Tasks ---
 @celery.task
 def _update_instance_details_task(task_id, profile_config, data):
-    _db_execute_celery('UPDATE tasks SET status = ?, result = ? WHERE id = ?', ('running', '正在更新实例...', task_id))
+    _db_execute_celery('UPDATE tasks SET status = ?, result = ? WHERE id = ?', ('running', '正在更新实例...', task_id), task_id=task_id)
     try:
         clients, error = get_oci_clients(profile_config, validate=False)
         if error: raise Exception(error)
@@ -1851,96 +3104,149 @@ def _update_instance_details_task(task_id, profile_config, data):
             result_message = "✅ 引导卷更新成功！"
         else: raise Exception(f"未知的更新操作: {action}")
         
-        _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?', ('success', result_message, datetime.datetime.now(timezone.utc).isoformat(), task_id))
+        _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?', ('success', result_message, datetime.datetime.now(timezone.utc).isoformat(), task_id), task_id=task_id)
     except Exception as e:
-        _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?', ('failure', f"❌ 操作失败: {e}", datetime.datetime.now(timezone.utc).isoformat(), task_id))
+        _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?', ('failure', f"❌ 操作失败: {e}", datetime.datetime.now(timezone.utc).isoformat(), task_id), task_id=task_id)
 
-@celery.task
-def _instance_action_task(task_id, profile_config, action, instance_id, data):
-    _db_execute_celery('UPDATE tasks SET status = ?, result = ? WHERE id = ?', ('running', '正在执行操作...', task_id))
+# --- 公网 IP 更换 ---
+# 删除临时公网 IP 后轮询其状态直到真正释放 (而不是固定 sleep)，轮询间隔指数退避。
+IP_RELEASE_POLL_MIN = 0.5
+IP_RELEASE_POLL_MAX = 4
+IP_RELEASE_TIMEOUT = int(os.environ.get('IP_RELEASE_TIMEOUT', 60))
+
+def _wait_public_ip_released(vnet_client, public_ip_id, timeout=IP_RELEASE_TIMEOUT):
+    deadline = time.time() + timeout
+    interval = IP_RELEASE_POLL_MIN
+    while True:
+        try:
+            state = vnet_client.get_public_ip(public_ip_id).data.lifecycle_state
+        except ServiceError as e:
+            if e.status == 404: return
+            raise
+        if state in ('TERMINATED', 'UNASSIGNED'):
+            return
+        if time.time() + interval > deadline:
+            raise Exception(f"等待旧公网IP释放超时 (当前状态: {state})")
+        time.sleep(interval)
+        interval = min(interval * 2, IP_RELEASE_POLL_MAX)
+
+def _primary_private_ip(vnet_client, vnic_id):
+    private_ips = oci.pagination.list_call_get_all_results(vnet_client.list_private_ips, vnic_id=vnic_id).data
+    primary_private_ip = next((p for p in private_ips if p.is_primary), None)
+    if not primary_private_ip: raise Exception("未找到主私有IP")
+    return primary_private_ip
+
+def _rotate_public_ip(vnet_client, compartment_id, vnic_id, report=None):
+    """为 VNIC 的主私有 IP 更换临时公网 IP，返回 (旧IP或None, 新IP)。"""
+    report = report or (lambda msg: None)
+    primary_private_ip = _primary_private_ip(vnet_client, vnic_id)
+    old_ip = None
     try:
-        clients, error = get_oci_clients(profile_config, validate=False)
-        if error: raise Exception(error)
-        compute_client, vnet_client = clients['compute'], clients['vnet']
+        pub_ip_details = oci.core.models.GetPublicIpByPrivateIpIdDetails(private_ip_id=primary_private_ip.id)
+        existing_pub_ip = vnet_client.get_public_ip_by_private_ip_id(pub_ip_details).data
+        if existing_pub_ip.lifetime == "EPHEMERAL":
+            old_ip = existing_pub_ip.ip_address
+            report(f'正在释放旧IP {old_ip}...')
+            vnet_client.delete_public_ip(existing_pub_ip.id)
+            _wait_public_ip_released(vnet_client, existing_pub_ip.id)
+    except ServiceError as e:
+        if e.status != 404: raise
+    report('正在分配新IP...')
+    new_pub_ip = vnet_client.create_public_ip(CreatePublicIpDetails(compartment_id=compartment_id, lifetime="EPHEMERAL", private_ip_id=primary_private_ip.id)).data
+    return old_ip, new_pub_ip.ip_address
+
+def _perform_instance_action(profile_config, action, instance_id, data, report=None, task_id=None, dns_writeback=None):
+    """执行单个实例操作并返回结果消息；失败时抛出异常。report(msg) 用于汇报中间进度。
+    dns_writeback=(task_id, json_path) 指定 DNS 更新完成后结果写回的位置，默认写回 task_id 的文本结果。"""
+    dns_task_id, dns_path = dns_writeback or (task_id, None)
+    report = report or (lambda msg: None)
+    clients, error = get_oci_clients(profile_config, validate=False)
+    if error: raise Exception(error)
+    compute_client, vnet_client = clients['compute'], clients['vnet']
+    
+    instance = compute_client.get_instance(instance_id).data
+    instance_name = instance.display_name
+
+    action_map = {"START": ("START", "RUNNING"), "STOP": ("STOP", "STOPPED"), "RESTART": ("SOFTRESET", "RUNNING")}
+    action_upper = action.upper()
+    result_message = ""
+
+    if action_upper in action_map:
+        oci_action, target_state = action_map[action_upper]
+        compute_client.instance_action(instance_id=instance_id, action=oci_action)
+        report(f'等待实例进入 {target_state} 状态...')
+        _lifecycle_watcher.wait_for(compute_client, instance.compartment_id, 'instance', instance_id, target_state, max_wait_seconds=300)
+        result_message = f"✅ 实例已成功 {action}!"
+    elif action_upper == "TERMINATE":
+        compute_client.terminate_instance(instance_id, preserve_boot_volume=data.get('preserve_boot_volume', True))
+        report('等待实例进入 TERMINATED 状态...')
+        _lifecycle_watcher.wait_for(compute_client, instance.compartment_id, 'instance', instance_id, 'TERMINATED', max_wait_seconds=300, succeed_on_not_found=True)
+        result_message = "✅ 实例已成功终止!"
+    elif action_upper == "CHANGEIP":
+        vnic_id = data.get('vnic_id')
+        if not vnic_id: raise Exception("缺少 vnic_id")
+        _, new_ip = _rotate_public_ip(vnet_client, profile_config['tenancy'], vnic_id, report)
         
-        instance = compute_client.get_instance(instance_id).data
-        instance_name = instance.display_name
+        result_message = f"✅ 更换IP成功，新IP: {new_ip}"
         
-        alias = profile_config.get('alias', '未知账户')
+        dns_update_msg = _enqueue_dns_update(instance_name, new_ip, 'A', dns_task_id, dns_path)
+        result_message += f"\n{dns_update_msg}"
 
-        action_map = {"START": ("START", "RUNNING"), "STOP": ("STOP", "STOPPED"), "RESTART": ("SOFTRESET", "RUNNING")}
-        action_upper = action.upper()
-        result_message = ""
-        task_title = f"{action_upper} on {instance_name}"
-
-        if action_upper in action_map:
-            oci_action, target_state = action_map[action_upper]
-            compute_client.instance_action(instance_id=instance_id, action=oci_action)
-            _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', (f'等待实例进入 {target_state} 状态...', task_id))
-            oci.wait_until(compute_client, compute_client.get_instance(instance_id), 'lifecycle_state', target_state, max_wait_seconds=300)
-            result_message = f"✅ 实例已成功 {action}!"
-        elif action_upper == "TERMINATE":
-            compute_client.terminate_instance(instance_id, preserve_boot_volume=data.get('preserve_boot_volume', True))
-            _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('等待实例进入 TERMINATED 状态...', task_id))
-            oci.wait_until(compute_client, compute_client.get_instance(instance_id), 'lifecycle_state', 'TERMINATED', max_wait_seconds=300, succeed_on_not_found=True)
-            result_message = "✅ 实例已成功终止!"
-        elif action_upper == "CHANGEIP":
-            vnic_id = data.get('vnic_id')
-            if not vnic_id: raise Exception("缺少 vnic_id")
-            private_ips = oci.pagination.list_call_get_all_results(vnet_client.list_private_ips, vnic_id=vnic_id).data
-            primary_private_ip = next((p for p in private_ips if p.is_primary), None)
-            if not primary_private_ip: raise Exception("未找到主私有IP")
-            try:
-                pub_ip_details = oci.core.models.GetPublicIpByPrivateIpIdDetails(private_ip_id=primary_private_ip.id)
-                existing_pub_ip = vnet_client.get_public_ip_by_private_ip_id(pub_ip_details).data
-                if existing_pub_ip.lifetime == "EPHEMERAL":
-                    vnet_client.delete_public_ip(existing_pub_ip.id)
-                    time.sleep(5)
-            except ServiceError as e:
-                if e.status != 404: raise
-            new_pub_ip = vnet_client.create_public_ip(CreatePublicIpDetails(compartment_id=profile_config['tenancy'], lifetime="EPHEMERAL", private_ip_id=primary_private_ip.id)).data
+    elif action_upper == "ASSIGNIPV6":
+        vnic_id = data.get('vnic_id')
+        if not vnic_id: raise Exception("缺少 vnic_id")
+        
+        _enable_ipv6_networking(task_id, vnet_client, vnic_id)
+        
+        # --- ✨✨✨ 修改开始：检测并删除已有 IPv6 以实现“更换”逻辑 ✨✨✨ ---
+        report('正在检查现有 IPv6 地址...')
+        existing_ipv6s = vnet_client.list_ipv6s(vnic_id=vnic_id).data
+        
+        if existing_ipv6s:
+            ipv6_to_remove = [ip.id for ip in existing_ipv6s]
+            report(f'检测到 {len(ipv6_to_remove)} 个旧 IPv6，正在删除以执行更换...')
+            logging.info(f"Replacing IPv6 for instance {instance_name}: Deleting {len(ipv6_to_remove)} existing addresses.")
             
-            result_message = f"✅ 更换IP成功，新IP: {new_pub_ip.ip_address}"
+            for ipv6_id in ipv6_to_remove:
+                try:
+                    vnet_client.delete_ipv6(ipv6_id)
+                except Exception as e:
+                    logging.warning(f"删除旧 IPv6 {ipv6_id} 失败: {e}")
             
-            dns_update_msg = _update_cloudflare_dns(instance_name, new_pub_ip.ip_address, 'A')
-            result_message += f"\n{dns_update_msg}"
+            # 稍微等待删除生效，避免并发冲突
+            time.sleep(5)
+        # --- ✨✨✨ 修改结束 ✨✨✨ ---
+        
+        report('网络配置完成，正在为实例分配IPv6地址...')
 
-        elif action_upper == "ASSIGNIPV6":
-            vnic_id = data.get('vnic_id')
-            if not vnic_id: raise Exception("缺少 vnic_id")
-            
+        try:
+            new_ipv6 = vnet_client.create_ipv6(CreateIpv6Details(vnic_id=vnic_id)).data
+        except ServiceError as e:
+            if e.status not in (400, 404, 409): raise
+            # 缓存的就绪状态可能已过时 (网络被手动修改)，清除后完整检查一次再重试
+            logging.warning(f"分配 IPv6 失败 ({e.code})，重新检查网络配置后重试。")
+            _invalidate_ipv6_readiness(vnet_client, vnic_id)
             _enable_ipv6_networking(task_id, vnet_client, vnic_id)
-            
-            # --- ✨✨✨ 修改开始：检测并删除已有 IPv6 以实现“更换”逻辑 ✨✨✨ ---
-            _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('正在检查现有 IPv6 地址...', task_id))
-            existing_ipv6s = vnet_client.list_ipv6s(vnic_id=vnic_id).data
-            
-            if existing_ipv6s:
-                ipv6_to_remove = [ip.id for ip in existing_ipv6s]
-                _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', (f'检测到 {len(ipv6_to_remove)} 个旧 IPv6，正在删除以执行更换...', task_id))
-                logging.info(f"Replacing IPv6 for instance {instance_name}: Deleting {len(ipv6_to_remove)} existing addresses.")
-                
-                for ipv6_id in ipv6_to_remove:
-                    try:
-                        vnet_client.delete_ipv6(ipv6_id)
-                    except Exception as e:
-                        logging.warning(f"删除旧 IPv6 {ipv6_id} 失败: {e}")
-                
-                # 稍微等待删除生效，避免并发冲突
-                time.sleep(5)
-            # --- ✨✨✨ 修改结束 ✨✨✨ ---
-            
-            _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', ('网络配置完成，正在为实例分配IPv6地址...', task_id))
-
             new_ipv6 = vnet_client.create_ipv6(CreateIpv6Details(vnic_id=vnic_id)).data
-            result_message = f"✅ 已成功分配IPv6地址: {new_ipv6.ip_address}"
+        result_message = f"✅ 已成功分配IPv6地址: {new_ipv6.ip_address}"
 
-            dns_update_msg = _update_cloudflare_dns(instance_name, new_ipv6.ip_address, 'AAAA')
-            result_message += f"\n{dns_update_msg}"
+        dns_update_msg = _enqueue_dns_update(instance_name, new_ipv6.ip_address, 'AAAA', dns_task_id, dns_path)
+        result_message += f"\n{dns_update_msg}"
 
-        else: raise Exception(f"未知的操作: {action}")
+    else: raise Exception(f"未知的操作: {action}")
+    return instance_name, result_message
+
+@celery.task
+def _instance_action_task(task_id, profile_config, action, instance_id, data):
+    _db_execute_celery('UPDATE tasks SET status = ?, result = ? WHERE id = ?', ('running', '正在执行操作...', task_id), task_id=task_id)
+    try:
+        alias = profile_config.get('alias', '未知账户')
+        report = lambda msg: _db_execute_celery('UPDATE tasks SET result=? WHERE id=?', (msg, task_id), task_id=task_id)
+        instance_name, result_message = _perform_instance_action(profile_config, action, instance_id, data, report, task_id)
+        task_title = f"{action.upper()} on {instance_name}"
         
-        _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?', ('success', result_message, datetime.datetime.now(timezone.utc).isoformat(), task_id))
+        _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?', ('success', result_message, datetime.datetime.now(timezone.utc).isoformat(), task_id), task_id=task_id)
+        _flush_dns_writebacks(task_id)
         
         if data.get('_source') != 'web':
             tg_msg = (f"🔔 *任务完成通知*\n\n"
@@ -1953,7 +3259,7 @@ def _instance_action_task(task_id, profile_config, action, instance_id, data):
         alias = profile_config.get('alias', '未知账户')
         task_title = f"{action.upper()} on instance"
         error_message = f"❌ 操作失败: {e}"
-        _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?', ('failure', error_message, datetime.datetime.now(timezone.utc).isoformat(), task_id))
+        _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?', ('failure', error_message, datetime.datetime.now(timezone.utc).isoformat(), task_id), task_id=task_id)
         
         if data.get('_source') != 'web':
             tg_msg = (f"🔔 *任务失败通知*\n\n"
@@ -1962,9 +3268,213 @@ def _instance_action_task(task_id, profile_config, action, instance_id, data):
                       f"*原因*:\n`{e}`")
             send_tg_notification(tg_msg)
 
+# --- 批量实例操作 ---
+# 一个父任务记录所有子操作的进度 (result JSON 的 items 数组)，子操作在线程池中并发执行，
+# 每个租户同时进行的操作数受 per_account_limit 限制 (多个账号指向同一租户时共用名额)，避免单个租户被限流。
+BULK_ACTION_MAX_WORKERS = int(os.environ.get('BULK_ACTION_MAX_WORKERS', 16))
+BULK_ACTION_PER_ACCOUNT = int(os.environ.get('BULK_ACTION_PER_ACCOUNT', 4))
+BULK_ACTION_MAX_ITEMS = 200
+
+def _validate_bulk_actions(raw_items, profiles):
+    """校验批量操作列表，返回 (items, error)。"""
+    if not isinstance(raw_items, list) or not raw_items:
+        return None, "actions 必须是非空列表"
+    if len(raw_items) > BULK_ACTION_MAX_ITEMS:
+        return None, f"单次最多提交 {BULK_ACTION_MAX_ITEMS} 个操作"
+    items = []
+    for raw in raw_items:
+        if not isinstance(raw, dict):
+            return None, "actions 中的每一项都必须是对象"
+        alias, instance_id, action = raw.get('alias'), raw.get('instance_id'), raw.get('action')
+        if not all(isinstance(v, str) and v for v in (alias, instance_id, action)):
+            return None, "每个操作都需要 alias、instance_id 和 action"
+        if alias not in profiles:
+            return None, f"账号 '{alias}' 未找到"
+        items.append(dict(raw, status='pending', message=''))
+    return items, None
+
+def _tenancy_slots(items, profiles, per_account_limit):
+    """按租户 OCID 分配并发名额，返回 {alias: Semaphore}；同一租户的账号共用一个信号量。"""
+    by_tenancy, slots = {}, {}
+    for alias in {item['alias'] for item in items}:
+        tenancy = (profiles.get(alias) or {}).get('tenancy') or alias
+        slots[alias] = by_tenancy.setdefault(tenancy, threading.Semaphore(per_account_limit))
+    return slots
+
+def _create_bulk_action_task(items, source):
+    """创建父任务记录并派发批量操作，返回父任务 ID。"""
+    accounts = sorted({item['alias'] for item in items})
+    task_name = f"批量操作 {len(items)} 个实例 ({len(accounts)} 个账号)"
+    task_id = _create_task_entry('bulk_action', task_name, ','.join(accounts) if len(accounts) <= 3 else f"{len(accounts)} 个账号")
+    status_data = {"total": len(items), "done": 0, "succeeded": 0, "failed": 0, "items": items, "source": source}
+    _db_execute_celery('UPDATE tasks SET status = ?, result = ? WHERE id = ?', ('running', json.dumps(status_data), task_id), task_id=task_id)
+    _bulk_instance_action_task.delay(task_id, items, source)
+    return task_id
+
+def _update_bulk_item(task_id, index, status, message, finished=False, extra=None):
+    prefix = f"$.items[{index}]"
+    if extra:
+        # 附加字段 (如旧IP/新IP) 与状态分开写入，键名由调用方固定，不来自用户输入
+        paths = ", ".join(f"'{prefix}.{key}', ?" for key in extra)
+        _db_execute_celery(f"UPDATE tasks SET result = json_set(result, {paths}) WHERE id = ?", (*extra.values(), task_id), task_id=task_id)
+    if finished:
+        counter = '$.succeeded' if status == 'success' else '$.failed'
+        _db_execute_celery(f"UPDATE tasks SET result = json_set(result, '{prefix}.status', ?, '{prefix}.message', ?, "
+                           f"'$.done', json_extract(result, '$.done') + 1, '{counter}', json_extract(result, '{counter}') + 1) WHERE id = ?",
+                           (status, message, task_id), task_id=task_id)
+    else:
+        _db_execute_celery(f"UPDATE tasks SET result = json_set(result, '{prefix}.status', ?, '{prefix}.message', ?) WHERE id = ?",
+                           (status, message, task_id), task_id=task_id)
+
+@celery.task
+def _bulk_instance_action_task(task_id, items, source='web', per_account_limit=None):
+    profiles = load_profiles().get("profiles", {})
+    per_account_limit = per_account_limit or BULK_ACTION_PER_ACCOUNT
+    account_slots = _tenancy_slots(items, profiles, per_account_limit)
+
+    def run_item(index, item):
+        alias = item['alias']
+        with account_slots[alias]:
+            profile_config = profiles.get(alias)
+            if not profile_config:
+                _update_bulk_item(task_id, index, 'failure', f"账号 '{alias}' 配置已不存在", finished=True)
+                return False
+            config_with_alias = dict(profile_config, alias=alias)
+            _update_bulk_item(task_id, index, 'running', '正在执行操作...')
+            try:
+                report = lambda msg: _update_bulk_item(task_id, index, 'running', msg)
+                _, result_message = _perform_instance_action(config_with_alias, item['action'], item['instance_id'], item, report,
+                                                             dns_writeback=(task_id, f"$.items[{index}].dns"))
+                _update_bulk_item(task_id, index, 'success', result_message, finished=True)
+                return True
+            except Exception as e:
+                _update_bulk_item(task_id, index, 'failure', f"❌ 操作失败: {e}", finished=True)
+                return False
+
+    with ThreadPoolExecutor(max_workers=min(BULK_ACTION_MAX_WORKERS, len(items)), thread_name_prefix="bulk-action") as executor:
+        outcomes = list(executor.map(lambda pair: run_item(*pair), enumerate(items)))
+
+    succeeded = sum(1 for ok in outcomes if ok)
+    failed = len(outcomes) - succeeded
+    _db_execute_celery("UPDATE tasks SET status = ?, completed_at = ? WHERE id = ?",
+                       ('success' if failed == 0 else 'failure', datetime.datetime.now(timezone.utc).isoformat(), task_id), task_id=task_id)
+
+    if source != 'web':
+        lines = [f"{'✅' if ok else '❌'} `{item['alias']}` {item['action'].upper()} {item.get('instance_name', item['instance_id'][-12:])}"
+                 for item, ok in zip(items, outcomes)]
+        tg_msg = (f"🔔 *批量操作完成*\n\n"
+                  f"*成功*: {succeeded}  *失败*: {failed}\n\n" + "\n".join(lines[:50]))
+        send_tg_notification(tg_msg)
+
+# --- 批量更换公网 IP ---
+# 跨账号一次更换多台实例的 IP：查询私有IP / 删除 / 创建在每个账号的并发上限内执行，
+# DNS 更新不占用账号名额。父任务的 items 中记录每台实例的旧IP、新IP 与 DNS 结果，完成后汇总成一份报告。
+def _validate_ip_rotation(raw_items, profiles):
+    """校验批量换IP列表，返回 (items, error)。每项需要 alias 与 instance_id，vnic_id 可选。"""
+    if not isinstance(raw_items, list) or not raw_items:
+        return None, "instances 必须是非空列表"
+    if len(raw_items) > BULK_ACTION_MAX_ITEMS:
+        return None, f"单次最多提交 {BULK_ACTION_MAX_ITEMS} 个实例"
+    items = []
+    for raw in raw_items:
+        if not isinstance(raw, dict):
+            return None, "instances 中的每一项都必须是对象"
+        alias, instance_id = raw.get('alias'), raw.get('instance_id')
+        if not (isinstance(alias, str) and alias and isinstance(instance_id, str) and instance_id):
+            return None, "每个实例都需要 alias 和 instance_id"
+        if alias not in profiles:
+            return None, f"账号 '{alias}' 未找到"
+        items.append(dict(raw, action='CHANGEIP', status='pending', message='', old_ip=None, new_ip=None))
+    return items, None
+
+def _create_ip_rotation_task(items, source, update_dns=True):
+    accounts = sorted({item['alias'] for item in items})
+    task_name = f"批量更换IP {len(items)} 个实例 ({len(accounts)} 个账号)"
+    task_id = _create_task_entry('bulk_action', task_name, ','.join(accounts) if len(accounts) <= 3 else f"{len(accounts)} 个账号")
+    status_data = {"total": len(items), "done": 0, "succeeded": 0, "failed": 0, "items": items, "source": source}
+    _db_execute_celery('UPDATE tasks SET status = ?, result = ? WHERE id = ?', ('running', json.dumps(status_data), task_id), task_id=task_id)
+    _bulk_rotate_ip_task.delay(task_id, items, source, update_dns)
+    return task_id
+
+def _primary_vnic_id(compute_client, compartment_id, instance_id):
+    attachments = compute_client.list_vnic_attachments(compartment_id=compartment_id, instance_id=instance_id).data
+    attached = [a for a in attachments if a.lifecycle_state == 'ATTACHED']
+    if not attached: raise Exception("实例没有已挂载的 VNIC")
+    return attached[0].vnic_id
+
+@celery.task
+def _bulk_rotate_ip_task(task_id, items, source='web', update_dns=True, per_account_limit=None):
+    profiles = load_profiles().get("profiles", {})
+    per_account_limit = per_account_limit or BULK_ACTION_PER_ACCOUNT
+    account_slots = _tenancy_slots(items, profiles, per_account_limit)
+    clients_by_alias, clients_lock = {}, threading.Lock()
+
+    def clients_for(alias):
+        with clients_lock:
+            if alias not in clients_by_alias:
+                clients, error = get_oci_clients(profiles[alias], validate=False)
+                if error: raise Exception(error)
+                clients_by_alias[alias] = clients
+            return clients_by_alias[alias]
+
+    def run_item(index, item):
+        alias = item['alias']
+        profile_config = profiles.get(alias)
+        if not profile_config:
+            _update_bulk_item(task_id, index, 'failure', f"账号 '{alias}' 配置已不存在", finished=True)
+            return None
+        report = lambda msg: _update_bulk_item(task_id, index, 'running', msg)
+        try:
+            with account_slots[alias]:
+                report('正在查询实例网络...')
+                clients = clients_for(alias)
+                instance_name = item.get('instance_name')
+                vnic_id = item.get('vnic_id')
+                if not instance_name or not vnic_id:
+                    instance = clients['compute'].get_instance(item['instance_id']).data
+                    instance_name = instance_name or instance.display_name
+                    vnic_id = vnic_id or _primary_vnic_id(clients['compute'], instance.compartment_id, instance.id)
+                old_ip, new_ip = _rotate_public_ip(clients['vnet'], profile_config['tenancy'], vnic_id, report)
+            message = f"✅ {old_ip or '无'} -> {new_ip}"
+            if update_dns:
+                # 经 DNS 发件箱提交：换 IP 后立即落库，由消费任务合并为批量请求，结果写回该项的 dns 字段
+                message += "\n" + _enqueue_dns_update(instance_name, new_ip, 'A', task_id, f"$.items[{index}].dns")
+            _update_bulk_item(task_id, index, 'success', message, finished=True, extra={'old_ip': old_ip, 'new_ip': new_ip, 'instance_name': instance_name})
+            return {"index": index, "alias": alias, "instance_name": instance_name, "old_ip": old_ip, "new_ip": new_ip, "message": message}
+        except Exception as e:
+            logging.error(f"批量换IP: 实例 {item['instance_id']} ({alias}) 失败: {e}")
+            _update_bulk_item(task_id, index, 'failure', f"❌ 更换IP失败: {e}", finished=True)
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(BULK_ACTION_MAX_WORKERS, len(items)), thread_name_prefix="bulk-rotate-ip") as executor:
+        outcomes = list(executor.map(lambda pair: run_item(*pair), enumerate(items)))
+
+    rotated = [o for o in outcomes if o]
+    failed = len(outcomes) - len(rotated)
+    report_lines = [f"{o['alias']}/{o['instance_name']}: {o['old_ip'] or '-'} -> {o['new_ip']}" for o in rotated]
+    _db_execute_celery("UPDATE tasks SET status = ?, result = json_set(result, '$.report', ?), completed_at = ? WHERE id = ?",
+                       ('success' if failed == 0 else 'failure', "\n".join(report_lines), datetime.datetime.now(timezone.utc).isoformat(), task_id), task_id=task_id)
+
+    if source != 'web':
+        lines = [f"✅ `{o['alias']}` {o['instance_name']}: `{o['old_ip'] or '-'}` → `{o['new_ip']}`" for o in rotated]
+        lines += [f"❌ `{item['alias']}` {item.get('instance_name', item['instance_id'][-12:])}"
+                  for item, o in zip(items, outcomes) if not o]
+        tg_msg = (f"🔔 *批量更换IP完成*\n\n"
+                  f"*成功*: {len(rotated)}  *失败*: {failed}\n\n" + "\n".join(lines[:50]))
+        send_tg_notification(tg_msg)
+
 @celery.task
 def _snatch_instance_task(task_id, profile_config, alias, details, run_id, auto_bind_domain=False):
-    
+    # 先注册控制句柄再读取任务状态，避免错过启动期间发布的暂停/停止指令
+    control = _snatch_control.register(task_id, run_id)
+    job = _prepare_snatch_job(control, task_id, profile_config, alias, details, run_id, auto_bind_domain)
+    if job is None:
+        _snatch_control.unregister(control)
+        return
+    # 准备完成后交给调度器，Celery 线程立即释放；等待期间只占用内存
+    _snatch_scheduler.submit(job, job.initial_delay())
+
+def _prepare_snatch_job(control, task_id, profile_config, alias, details, run_id, auto_bind_domain):
     task_data = query_db('SELECT result FROM tasks WHERE id = ?', [task_id], one=True)
     try:
         status_data = json.loads(task_data['result']) if task_data and task_data['result'] else {}
@@ -1987,12 +3497,13 @@ def _snatch_instance_task(task_id, profile_config, alias, details, run_id, auto_
     status_data['details']['account_alias'] = alias
     status_data['run_id'] = run_id
     
-    _db_execute_celery('UPDATE tasks SET status = ?, result = ? WHERE id = ?', ('running', json.dumps(status_data), task_id))
+    _db_execute_celery('UPDATE tasks SET status = ?, result = ? WHERE id = ?', ('running', json.dumps(status_data), task_id), task_id=task_id)
+    control.started = True
     
     try:
         clients, error = get_oci_clients(profile_config, validate=False)
         if error: raise Exception(error)
-        compute_client, identity_client, vnet_client = clients['compute'], clients['identity'], clients['vnet']
+        compute_client = clients['compute']
         
         tenancy_ocid = profile_config.get('tenancy')
         
@@ -2004,21 +3515,8 @@ def _snatch_instance_task(task_id, profile_config, alias, details, run_id, auto_
         if not ssh_key:
              raise Exception("未提供 SSH 公钥 (既无自定义公钥，账号也无默认公钥)")
 
-        ad_objects = identity_client.list_availability_domains(tenancy_ocid).data
-        if not ad_objects:
-            raise Exception("无法获取可用性域列表。")
-        availability_domains = [ad.name for ad in ad_objects]
-        
-        subnet_id = _ensure_subnet_in_profile(task_id, alias, vnet_client, tenancy_ocid)
-        
-        os_name, os_version = details['os_name_version'].split('-')
         shape = details['shape']
-        
-        status_data['last_message'] = '正在查找兼容的系统镜像...'
-        _db_execute_celery('UPDATE tasks SET result = ? WHERE id = ?', (json.dumps(status_data), task_id))
-        
-        images = oci.pagination.list_call_get_all_results(compute_client.list_images, tenancy_ocid, operating_system=os_name, operating_system_version=os_version, shape=shape, sort_by="TIMECREATED", sort_order="DESC").data
-        if not images: raise Exception(f"未找到适用于 {os_name} {os_version} 的兼容镜像")
+        availability_domains, subnet_id, image_id = _resolve_snatch_target(task_id, alias, profile_config, clients, details, status_data)
         
         enable_password_auth = details.get('enable_password_auth', False)
         instance_password = None
@@ -2077,156 +3575,901 @@ export AUTO_REG_SECRET="{manager_secret}"
             "display_name": details.get('display_name_prefix', 'snatch-instance'),
             "create_vnic_details": CreateVnicDetails(subnet_id=subnet_id, assign_public_ip=True),
             "metadata": {"ssh_authorized_keys": ssh_key, "user_data": user_data_encoded},
-            "source_details": InstanceSourceViaImageDetails(image_id=images[0].id, boot_volume_size_in_gbs=details['boot_volume_size']),
+            "source_details": InstanceSourceViaImageDetails(image_id=image_id, boot_volume_size_in_gbs=details['boot_volume_size']),
             "shape_config": LaunchInstanceShapeConfigDetails(ocpus=details.get('ocpus'), memory_in_gbs=details.get('memory_in_gbs')) if "Flex" in shape else None,
             "agent_config": agent_config_details
         }
 
     except Exception as e:
-        _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?', ('failure', f"❌ 抢占任务准备阶段失败: {e}", datetime.datetime.now(timezone.utc).isoformat(), task_id))
-        return
+        _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?', ('failure', f"❌ 抢占任务准备阶段失败: {e}", datetime.datetime.now(timezone.utc).isoformat(), task_id), task_id=task_id)
+        return None
+
+    launch_context = {
+        "subnet_id": subnet_id,
+        "enable_password_auth": enable_password_auth,
+        "instance_password": instance_password,
+        "auto_bind_domain": auto_bind_domain,
+    }
+    return SnatchJob(control, task_id, profile_config, alias, details, run_id, status_data,
+                     clients, availability_domains, base_launch_details, launch_context)
+
+# --- 抢占准备缓存 ---
+# 可用性域与子网按 (租户, 区域) 缓存，镜像按 (租户, 区域, 系统, 版本, 规格) 缓存。
+# 批量恢复/手动恢复大量任务时只有第一个任务真正调用 API，其余直接命中缓存。
+SNATCH_PREP_CACHE_TTL = int(os.environ.get('SNATCH_PREP_CACHE_TTL', 1800))
+_snatch_network_cache = SharedTTLCache('snatch_network', SNATCH_PREP_CACHE_TTL)
+_snatch_image_cache = SharedTTLCache('snatch_image', SNATCH_PREP_CACHE_TTL)
+
+def _snatch_cache_keys(alias, profile_config, details):
+    tenancy, region = profile_config.get('tenancy'), profile_config.get('region')
+    os_name, os_version = details['os_name_version'].split('-')
+    # 子网取决于各账号配置中的 default_subnet_ocid，网络缓存按账号及其子网区分；镜像只与租户/区域相关
+    network_key = f"{tenancy}:{region}:{alias}:{profile_config.get('default_subnet_ocid') or 'auto'}"
+    return network_key, f"{tenancy}:{region}:{os_name}:{os_version}:{details['shape']}"
+
+def _resolve_snatch_target(task_id, alias, profile_config, clients, details, status_data=None):
+    """返回 (可用性域列表, 子网ID, 镜像ID)，优先读取准备缓存。"""
+    tenancy_ocid = profile_config.get('tenancy')
+    network_key, image_key = _snatch_cache_keys(alias, profile_config, details)
+    os_name, os_version = details['os_name_version'].split('-')
+    shape = details['shape']
+
+    def load_network():
+        ad_objects = clients['identity'].list_availability_domains(tenancy_ocid).data
+        if not ad_objects:
+            raise Exception("无法获取可用性域列表。")
+        subnet_id = _ensure_subnet_in_profile(task_id, alias, clients['vnet'], tenancy_ocid)
+        return {"availability_domains": [ad.name for ad in ad_objects], "subnet_id": subnet_id}
+
+    def load_image():
+        if status_data is not None:
+            status_data['last_message'] = '正在查找兼容的系统镜像...'
+            _db_execute_celery('UPDATE tasks SET result = ? WHERE id = ?', (json.dumps(status_data), task_id), task_id=task_id)
+        images = oci.pagination.list_call_get_all_results(clients['compute'].list_images, tenancy_ocid, operating_system=os_name, operating_system_version=os_version, shape=shape, sort_by="TIMECREATED", sort_order="DESC").data
+        if not images: raise Exception(f"未找到适用于 {os_name} {os_version} 的兼容镜像")
+        return {"image_id": images[0].id}
+
+    network = _snatch_network_cache.get_or_load(network_key, load_network)
+    image = _snatch_image_cache.get_or_load(image_key, load_image)
+    return network['availability_domains'], network['subnet_id'], image['image_id']
+
+def _invalidate_snatch_target(alias, profile_config, details):
+    network_key, image_key = _snatch_cache_keys(alias, profile_config, details)
+    _snatch_network_cache.invalidate(network_key)
+    _snatch_image_cache.invalidate(image_key)
+
+# --- OCI 启动请求自适应限流 (按租户 + 区域共享的令牌桶) ---
+# 同一租户同一区域的所有抢占任务共用一个 Redis 令牌桶，速率按 AIMD 调整：
+# 收到 429 / LimitExceeded 时乘性下降，容量不足或成功时加性上探。
+OCI_LAUNCH_RATE = float(os.environ.get('OCI_LAUNCH_RATE', 0.5))          # 初始速率 (次/秒)
+OCI_LAUNCH_RATE_MIN = float(os.environ.get('OCI_LAUNCH_RATE_MIN', 0.02))
+OCI_LAUNCH_RATE_MAX = float(os.environ.get('OCI_LAUNCH_RATE_MAX', 2.0))
+OCI_LAUNCH_BURST = float(os.environ.get('OCI_LAUNCH_BURST', 3))
+OCI_LAUNCH_DECREASE_FACTOR = 0.5
+OCI_LAUNCH_INCREASE_STEP = 0.02
+OCI_LAUNCH_DECREASE_COOLDOWN = 5  # 秒，避免同一波 429 把速率连续砍到底
+
+_TOKEN_BUCKET_ACQUIRE_LUA = """
+local now = tonumber(ARGV[1])
+local default_rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'rate')
+local rate = tonumber(b[3]) or default_rate
+local tokens = tonumber(b[1]) or burst
+local ts = tonumber(b[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now), 'rate', tostring(rate))
+redis.call('EXPIRE', KEYS[1], 86400)
+return tostring(wait)
+"""
 
-    last_update_time = time.time()
-    attempt_count = status_data.get('attempt_count', 0)
+_TOKEN_BUCKET_FEEDBACK_LUA = """
+local now = tonumber(ARGV[1])
+local kind = ARGV[2]
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate')) or tonumber(ARGV[3])
+local min_rate, max_rate = tonumber(ARGV[4]), tonumber(ARGV[5])
+if kind == 'throttled' then
+    local last = tonumber(redis.call('HGET', KEYS[1], 'last_decrease')) or 0
+    if now - last >= tonumber(ARGV[8]) then
+        rate = math.max(min_rate, rate * tonumber(ARGV[6]))
+        redis.call('HSET', KEYS[1], 'last_decrease', tostring(now), 'tokens', '0', 'ts', tostring(now))
+    end
+else
+    rate = math.min(max_rate, rate + tonumber(ARGV[7]))
+end
+redis.call('HSET', KEYS[1], 'rate', tostring(rate))
+redis.call('EXPIRE', KEYS[1], 86400)
+return tostring(rate)
+"""
 
-    while True:
-        current_task_data = query_db('SELECT result, status FROM tasks WHERE id = ?', [task_id], one=True)
-        if not current_task_data:
-            logging.warning(f"Task {task_id} not found in DB. Worker will exit.")
-            return
+class AdaptiveLaunchLimiter:
+    """租户 + 区域维度的 AIMD 令牌桶。Redis 不可用时退化为进程内令牌桶。"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = {}
+        self._acquire_script = None
+        self._feedback_script = None
+
+    @staticmethod
+    def _key(tenancy, region):
+        return f"oci:launch_bucket:{tenancy}:{region}"
+
+    def _scripts(self):
+        if self._acquire_script is None:
+            self._acquire_script = redis_client.register_script(_TOKEN_BUCKET_ACQUIRE_LUA)
+            self._feedback_script = redis_client.register_script(_TOKEN_BUCKET_FEEDBACK_LUA)
+        return self._acquire_script, self._feedback_script
+
+    def acquire(self, tenancy, region):
+        """尝试取得一个令牌。返回 0 表示可以立即发起请求，否则返回需要等待的秒数。"""
+        key = self._key(tenancy, region)
+        if redis_client is not None:
+            try:
+                acquire_script, _ = self._scripts()
+                return float(acquire_script(keys=[key], args=[time.time(), OCI_LAUNCH_RATE, OCI_LAUNCH_BURST]))
+            except Exception as e:
+                logging.warning(f"Redis 令牌桶不可用，改用进程内限流: {e}")
+        with self._lock:
+            now = time.time()
+            bucket = self._local.setdefault(key, {"tokens": OCI_LAUNCH_BURST, "ts": now, "rate": OCI_LAUNCH_RATE, "last_decrease": 0})
+            bucket['tokens'] = min(OCI_LAUNCH_BURST, bucket['tokens'] + max(0, now - bucket['ts']) * bucket['rate'])
+            bucket['ts'] = now
+            if bucket['tokens'] >= 1:
+                bucket['tokens'] -= 1
+                return 0
+            return (1 - bucket['tokens']) / bucket['rate']
+
+    def feedback(self, tenancy, region, kind):
+        """kind: 'throttled' (429/LimitExceeded) 乘性下降；'probe' (容量不足/成功) 加性上探。"""
+        key = self._key(tenancy, region)
+        if redis_client is not None:
+            try:
+                _, feedback_script = self._scripts()
+                feedback_script(keys=[key], args=[time.time(), kind, OCI_LAUNCH_RATE, OCI_LAUNCH_RATE_MIN, OCI_LAUNCH_RATE_MAX,
+                                                  OCI_LAUNCH_DECREASE_FACTOR, OCI_LAUNCH_INCREASE_STEP, OCI_LAUNCH_DECREASE_COOLDOWN])
+                return
+            except Exception as e:
+                logging.warning(f"Redis 令牌桶反馈失败，改用进程内限流: {e}")
+        with self._lock:
+            now = time.time()
+            bucket = self._local.setdefault(key, {"tokens": OCI_LAUNCH_BURST, "ts": now, "rate": OCI_LAUNCH_RATE, "last_decrease": 0})
+            if kind == 'throttled':
+                if now - bucket['last_decrease'] >= OCI_LAUNCH_DECREASE_COOLDOWN:
+                    bucket['rate'] = max(OCI_LAUNCH_RATE_MIN, bucket['rate'] * OCI_LAUNCH_DECREASE_FACTOR)
+                    bucket['last_decrease'] = now
+                    bucket['tokens'] = 0
+                    bucket['ts'] = now
+            else:
+                bucket['rate'] = min(OCI_LAUNCH_RATE_MAX, bucket['rate'] + OCI_LAUNCH_INCREASE_STEP)
+
+_launch_limiter = AdaptiveLaunchLimiter()
+
+# --- 可用性域容量学习 (按 区域 + 规格 + AD 统计历史尝试结果) ---
+# 每个 AD 维护随时间指数衰减的 "正面/负面" 计数：成功与非容量类错误记为正面，
+# "Out of host capacity" 记为负面；选择时对每个 AD 做 Beta 分布的 Thompson 采样。
+# AD 名称带租户前缀 (如 "Uocm:PHX-AD-1")，统计时去掉前缀，以便同区域的不同账号共享。
+AD_STATS_HALF_LIFE = float(os.environ.get('AD_STATS_HALF_LIFE', 1800))
+AD_STATS_TTL = 7 * 86400
+AD_OUTCOME_WEIGHTS = {
+    "success": (3.0, 0.0),
+    "other_error": (0.5, 0.0),
+    "capacity": (0.0, 1.0),
+}
+
+_AD_STATS_RECORD_LUA = """
+local now = tonumber(ARGV[2])
+local half_life = tonumber(ARGV[3])
+local good = tonumber(redis.call('HGET', KEYS[1], ARGV[1] .. ':good')) or 0
+local bad = tonumber(redis.call('HGET', KEYS[1], ARGV[1] .. ':bad')) or 0
+local ts = tonumber(redis.call('HGET', KEYS[1], ARGV[1] .. ':ts')) or now
+local decay = 0.5 ^ (math.max(0, now - ts) / half_life)
+good = good * decay + tonumber(ARGV[4])
+bad = bad * decay + tonumber(ARGV[5])
+redis.call('HSET', KEYS[1], ARGV[1] .. ':good', tostring(good), ARGV[1] .. ':bad', tostring(bad), ARGV[1] .. ':ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[6]))
+return 1
+"""
 
-        if current_task_data['status'] != 'running':
-            logging.info(f"Task {task_id} status is '{current_task_data['status']}', not 'running'. Worker will exit.")
-            return
-            
-        try:
-            current_result_json = json.loads(current_task_data['result'])
-            db_run_id = current_result_json.get('run_id')
-            if db_run_id != run_id:
-                logging.info(f"Task {task_id} has a new run_id ({db_run_id}). This worker ({run_id}) will exit.")
+def _normalize_ad_name(ad_name):
+    return ad_name.split(':', 1)[-1]
+
+class AdCapacityBandit:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = {}
+        self._record_script = None
+
+    @staticmethod
+    def _key(region, shape):
+        return f"oci:ad_stats:{region}:{shape}"
+
+    @staticmethod
+    def _decayed(entry, now):
+        decay = 0.5 ** (max(0.0, now - entry.get('ts', now)) / AD_STATS_HALF_LIFE)
+        return entry.get('good', 0.0) * decay, entry.get('bad', 0.0) * decay
+
+    def _load(self, region, shape):
+        """返回 {AD(去前缀): {'good':, 'bad':, 'ts':}}。"""
+        key = self._key(region, shape)
+        if redis_client is not None:
+            try:
+                raw = redis_client.hgetall(key)
+                stats = {}
+                for field, value in raw.items():
+                    ad, _, metric = field.rpartition(':')
+                    stats.setdefault(ad, {})[metric] = float(value)
+                return stats
+            except Exception as e:
+                logging.warning(f"读取 AD 统计失败，使用进程内统计: {e}")
+        with self._lock:
+            return {ad: dict(entry) for ad, entry in self._local.get(key, {}).items()}
+
+    def choose(self, region, shape, availability_domains):
+        if len(availability_domains) == 1:
+            return availability_domains[0]
+        stats = self._load(region, shape)
+        now = time.time()
+        best_ad, best_sample = None, -1.0
+        for ad_name in availability_domains:
+            good, bad = self._decayed(stats.get(_normalize_ad_name(ad_name), {}), now)
+            sample = random.betavariate(1.0 + good, 1.0 + bad)
+            if sample > best_sample:
+                best_ad, best_sample = ad_name, sample
+        return best_ad
+
+    def record(self, region, shape, ad_name, outcome):
+        good_inc, bad_inc = AD_OUTCOME_WEIGHTS[outcome]
+        key, ad = self._key(region, shape), _normalize_ad_name(ad_name)
+        now = time.time()
+        if redis_client is not None:
+            try:
+                if self._record_script is None:
+                    self._record_script = redis_client.register_script(_AD_STATS_RECORD_LUA)
+                self._record_script(keys=[key], args=[ad, now, AD_STATS_HALF_LIFE, good_inc, bad_inc, AD_STATS_TTL])
                 return
-        except (json.JSONDecodeError, TypeError, KeyError):
-            logging.error(f"Could not verify run_id for task {task_id}. Data might be corrupt. Exiting.")
-            _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?', ('failure', "任务数据损坏，无法继续执行。", datetime.datetime.now(timezone.utc).isoformat(), task_id))
-            return
+            except Exception as e:
+                logging.warning(f"写入 AD 统计失败，使用进程内统计: {e}")
+        with self._lock:
+            entry = self._local.setdefault(key, {}).setdefault(ad, {})
+            good, bad = self._decayed(entry, now)
+            entry.update(good=good + good_inc, bad=bad + bad_inc, ts=now)
+
+    def snapshot(self):
+        """所有区域/规格下每个 AD 的当前(衰减后)计数与选择权重 (Beta 后验均值)。"""
+        keys = []
+        if redis_client is not None:
+            try:
+                keys = list(redis_client.scan_iter(match="oci:ad_stats:*", count=200))
+            except Exception as e:
+                logging.warning(f"扫描 AD 统计失败: {e}")
+        with self._lock:
+            keys = sorted(set(keys) | set(self._local.keys()))
+        now = time.time()
+        result = []
+        for key in keys:
+            _, _, region, shape = key.split(':', 3)
+            for ad, entry in sorted(self._load(region, shape).items()):
+                good, bad = self._decayed(entry, now)
+                result.append({
+                    "region": region, "shape": shape, "ad": ad,
+                    "good": round(good, 3), "bad": round(bad, 3),
+                    "weight": round((1.0 + good) / (2.0 + good + bad), 4),
+                    "updated_at": datetime.datetime.fromtimestamp(entry.get('ts', now), timezone.utc).isoformat()
+                })
+        return result
+
+_ad_bandit = AdCapacityBandit()
+
+# --- 启动前容量探测 (Compute Capacity Report) ---
+# 可选阶段：先用容量报告 API 询问各 AD 是否有所需规格/配置的容量，只在报告可用的 AD 发起 launch。
+# 探测结果按 (区域, 规格, OCPU, 内存, AD) 短暂缓存，并在所有任务间共享。
+SNATCH_CAPACITY_PROBE = os.environ.get('SNATCH_CAPACITY_PROBE', 'false').lower() in ['true', '1', 't']
+SNATCH_PROBE_CACHE_TTL = int(os.environ.get('SNATCH_PROBE_CACHE_TTL', 20))
+_capacity_probe_cache = SharedTTLCache('capacity_probe', SNATCH_PROBE_CACHE_TTL)
+
+def _probe_ad_capacity(compute_client, tenancy_ocid, region, ad_name, shape, ocpus=None, memory_in_gbs=None):
+    """返回 AVAILABLE / OUT_OF_HOST_CAPACITY / HARDWARE_NOT_SUPPORTED 等状态；探测失败返回 UNKNOWN。"""
+    key = f"{region}:{shape}:{ocpus}:{memory_in_gbs}:{_normalize_ad_name(ad_name)}"
+
+    def load():
+        shape_config = CapacityReportInstanceShapeConfig(ocpus=ocpus, memory_in_gbs=memory_in_gbs) if "Flex" in shape else None
+        report = compute_client.create_compute_capacity_report(CreateComputeCapacityReportDetails(
+            compartment_id=tenancy_ocid,
+            availability_domain=ad_name,
+            shape_availabilities=[CreateCapacityReportShapeAvailabilityDetails(instance_shape=shape, instance_shape_config=shape_config)]
+        )).data
+        statuses = [sa.availability_status for sa in (report.shape_availabilities or [])]
+        return {"status": statuses[0] if statuses else "UNKNOWN"}
+
+    try:
+        return _capacity_probe_cache.get_or_load(key, load)['status']
+    except Exception as e:
+        logging.warning(f"容量探测失败 ({region} {shape} {ad_name}): {e}")
+        return "UNKNOWN"
+
+class SnatchJob:
+    """一个抢占任务的全部运行状态。每次到期时由调度器在线程池中执行一次 attempt()。"""
+    def __init__(self, control, task_id, profile_config, alias, details, run_id, status_data,
+                 clients, availability_domains, base_launch_details, launch_context):
+        self.control = control
+        self.task_id = task_id
+        self.profile_config = profile_config
+        self.alias = alias
+        self.details = details
+        self.run_id = run_id
+        self.status_data = status_data
+        self.clients = clients
+        self.compute_client = clients['compute']
+        self.availability_domains = availability_domains
+        self.base_launch_details = base_launch_details
+        self.launch_context = launch_context
+        self.attempt_count = status_data.get('attempt_count', 0)
+        self._needs_refresh = False
+
+    def refresh_target(self):
+        """镜像/子网失效后重新解析启动目标，并更新启动参数。"""
+        availability_domains, subnet_id, image_id = _resolve_snatch_target(self.task_id, self.alias, self.profile_config, self.clients, self.details)
+        self.availability_domains = availability_domains
+        self.base_launch_details['create_vnic_details'] = CreateVnicDetails(subnet_id=subnet_id, assign_public_ip=True)
+        self.base_launch_details['source_details'] = InstanceSourceViaImageDetails(image_id=image_id, boot_volume_size_in_gbs=self.details['boot_volume_size'])
+        self.launch_context['subnet_id'] = subnet_id
+        self._needs_refresh = False
+
+    def initial_delay(self):
+        """恢复任务时沿用上次保存的下一次尝试时间。"""
+        next_attempt_at = self.status_data.get('next_attempt_at')
+        if not next_attempt_at:
+            return 0
+        return max(0, next_attempt_at - time.time())
+
+    def next_delay(self):
+        return random.randint(self.details.get('min_delay', 30), self.details.get('max_delay', 90))
+
+    def is_current(self):
+        """任务仍归属本次运行时返回 True；已被暂停/停止/取代时返回 False。"""
+        if self.control.cancelled:
+            logging.info(f"Task {self.task_id} received '{self.control.reason}' command. Job ({self.run_id}) will exit.")
+            return False
+        # 控制通道未连接时才回退到数据库检查
+        if not _snatch_control.is_live() and not _snatch_run_is_current(self.task_id, self.run_id):
+            logging.info(f"Task {self.task_id} is no longer running under run_id {self.run_id}. Job will exit.")
+            return False
+        return True
+
+    def ensure_target(self):
+        """镜像/子网被标记失效时重新解析。失败返回 False 并写入 last_message。"""
+        if not self._needs_refresh:
+            return True
+        try:
+            self.refresh_target()
+            return True
+        except Exception as e:
+            self.status_data['last_message'] = f"重新解析镜像/子网失败 ({str(e)[:50]})"
+            return False
+
+    def count_attempt(self):
+        self.attempt_count += 1
+        self.status_data['attempt_count'] = self.attempt_count
+
+    def choose_ad(self):
+        """选出本次尝试的可用性域；开启容量探测且所有 AD 均无容量时返回 None。"""
+        region, shape = self.profile_config.get('region'), self.details['shape']
+        candidate_ads = self.availability_domains
+        # 未指定时使用环境变量默认值；表单只在用户改动了默认勾选状态时才提交该字段
+        capacity_probe = self.details.get('capacity_probe')
+        if SNATCH_CAPACITY_PROBE if capacity_probe is None else capacity_probe:
+            # 探测失败 (UNKNOWN) 的 AD 不排除，退化为直接尝试
+            candidate_ads = [ad for ad in self.availability_domains
+                             if _probe_ad_capacity(self.compute_client, self.profile_config.get('tenancy'), region, ad, shape,
+                                                   self.details.get('ocpus'), self.details.get('memory_in_gbs')) in ('AVAILABLE', 'UNKNOWN')]
+            if not candidate_ads:
+                self.status_data['last_message'] = "容量探测: 所有可用性域均无可用容量，本次跳过启动"
+                return None
+        return _ad_bandit.choose(region, shape, candidate_ads)
+
+    def launch(self, current_ad_name):
+        """在指定可用性域发起一次 launch。成功时转交置备任务并返回 True，失败返回 False。"""
+        task_id, status_data = self.task_id, self.status_data
+        tenancy, region = self.profile_config.get('tenancy'), self.profile_config.get('region')
+        shape = self.details['shape']
 
-        attempt_count += 1
-        status_data['attempt_count'] = attempt_count
-        force_update = False
-        
-        current_ad_index = (attempt_count - 1) % len(availability_domains)
-        current_ad_name = availability_domains[current_ad_index]
-        
         if 'details' not in status_data: status_data['details'] = {}
         status_data['details']['ad'] = current_ad_name
         
         try:
-            launch_details_dict = base_launch_details.copy()
+            launch_details_dict = self.base_launch_details.copy()
             launch_details_dict['availability_domain'] = current_ad_name
             launch_details = LaunchInstanceDetails(**launch_details_dict)
             
-            status_data['last_message'] = f"正在 {current_ad_name} 中尝试..."
-            _db_execute_celery('UPDATE tasks SET result = ? WHERE id = ?', (json.dumps(status_data), task_id))
-            force_update = True 
-            
-            instance = compute_client.launch_instance(launch_details).data
-            
-            status_data['last_message'] = f"第 {status_data['attempt_count']} 次尝试成功！实例 {instance.display_name} 正在置备..."
-            _db_execute_celery('UPDATE tasks SET result = ? WHERE id = ?', (json.dumps(status_data), task_id))
-            oci.wait_until(compute_client, compute_client.get_instance(instance.id), 'lifecycle_state', 'RUNNING', max_wait_seconds=600)
-            
-            public_ip = "获取中..."
+            instance = self.compute_client.launch_instance(launch_details).data
+            _launch_limiter.feedback(tenancy, region, 'probe')
+            _ad_bandit.record(region, shape, current_ad_name, 'success')
+            metrics.inc('oci_snatch_attempts_total', account=self.alias, ad=_normalize_ad_name(current_ad_name), outcome='success', code='')
             try:
-                vnic_attachments = oci.pagination.list_call_get_all_results(compute_client.list_vnic_attachments, compartment_id=tenancy_ocid, instance_id=instance.id).data
-                if vnic_attachments:
-                    vnic = vnet_client.get_vnic(vnic_attachments[0].vnic_id).data
-                    public_ip = vnic.public_ip or "无"
-            except Exception as ip_e:
-                public_ip = "获取失败"
-
-            # ------------------------------------------------------------------
-            # 新增：自动开放防火墙逻辑
-            # ------------------------------------------------------------------
-            firewall_msg = ""
-            try:
-                # subnet_id 在任务开始时已获取
-                firewall_msg = _auto_open_firewall(vnet_client, subnet_id, task_id)
-            except Exception as fw_e:
-                logging.error(f"Task {task_id} firewall auto-open error: {fw_e}")
-                firewall_msg = f"⚠️ 防火墙自动开放异常: {str(fw_e)[:30]}"
-            # ------------------------------------------------------------------
-            
-            db_msg = f"🎉 抢占成功 (第 {status_data['attempt_count']} 次尝试)!\n- 实例名: {instance.display_name}\n- 可用区: {current_ad_name}\n- 公网IP: {public_ip}\n- 登陆用户名：root"
+                started = datetime.datetime.fromisoformat(status_data['start_time'])
+                metrics.observe('oci_snatch_time_to_success_seconds', (datetime.datetime.now(timezone.utc) - started).total_seconds(), account=self.alias)
+            except (KeyError, TypeError, ValueError):
+                pass
             
-            if firewall_msg:
-                db_msg += f"\n- {firewall_msg}"
-
-            if enable_password_auth and instance_password:
-                db_msg += f"\n- 密码：{instance_password}"
+            status_data['last_message'] = f"第 {status_data['attempt_count']} 次尝试成功！实例 {instance.display_name} 正在置备..."
+            status_data['launch'] = dict(self.launch_context, instance_id=instance.id, display_name=instance.display_name, ad=current_ad_name)
+            status_data.pop('next_attempt_at', None)
+            _db_execute_celery('UPDATE tasks SET result = ? WHERE id = ?', (json.dumps(status_data), task_id), task_id=task_id)
+            # 等待实例运行、获取IP、防火墙、DNS 与通知都转交给独立的 Celery 任务，不占用抢占线程池
+            _snatch_post_launch_task.delay(task_id, self.profile_config, self.alias, self.details, status_data)
+            return True
+        except ServiceError as e:
+            if e.status == 429 or "TooManyRequests" in e.code or "LimitExceeded" in e.code:
+                outcome = 'throttled'
+                _launch_limiter.feedback(tenancy, region, 'throttled')
+                status_data['last_message'] = f"在 {current_ad_name} 中资源不足 ({e.code})"
+            elif "Out of host capacity" in str(e.message):
+                outcome = 'capacity'
+                _launch_limiter.feedback(tenancy, region, 'probe')
+                _ad_bandit.record(region, shape, current_ad_name, 'capacity')
+                status_data['last_message'] = f"在 {current_ad_name} 中资源不足 ({e.code})"
             else:
-                db_msg += "\n- 登录方式: 仅 SSH 密钥"
+                outcome = 'api_error'
+                _ad_bandit.record(region, shape, current_ad_name, 'other_error')
+                if e.status == 404 or e.code == 'NotAuthorizedOrNotFound':
+                    # 镜像或子网可能已失效，清除准备缓存并在下一次尝试前重新解析
+                    _invalidate_snatch_target(self.alias, self.profile_config, self.details)
+                    self._needs_refresh = True
+                status_data['last_message'] = f"在 {current_ad_name} 中遇到API错误 ({e.code})"
+            metrics.inc('oci_snatch_attempts_total', account=self.alias, ad=_normalize_ad_name(current_ad_name), outcome=outcome, code=e.code)
+        except Exception as e:
+            metrics.inc('oci_snatch_attempts_total', account=self.alias, ad=_normalize_ad_name(current_ad_name), outcome='error', code=type(e).__name__)
+            status_data['last_message'] = f"在 {current_ad_name} 中遇到未知错误 ({str(e)[:50]}...)"
+        return False
 
-            dns_update_msg = ""
-            if auto_bind_domain and public_ip != "无" and public_ip != "获取失败":
-                dns_update_msg = _update_cloudflare_dns(instance.display_name, public_ip, 'A')
-                db_msg += f"\n{dns_update_msg}"
+    def attempt(self):
+        """执行一次抢占尝试。返回下一次尝试前的等待秒数，返回 None 表示任务结束。"""
+        if not self.is_current():
+            return None
 
-            _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ?', ('success', db_msg, datetime.datetime.now(timezone.utc).isoformat(), task_id))
-            
-            duration_str = "未知"
-            try:
-                start_time = datetime.datetime.fromisoformat(status_data['start_time'])
-                end_time = datetime.datetime.now(timezone.utc)
-                duration = end_time - start_time
-                duration_str = _format_timedelta(duration)
-            except (KeyError, TypeError):
-                logging.warning(f"无法为任务 {task_id} 计算总用时。")
-
-            result_for_tg = (f"🎉 抢占成功 (第 {status_data['attempt_count']} 次尝试)!\n"
-                             f"- 总用时: {duration_str}\n"
-                             f"- 实例名: {instance.display_name}\n"
-                             f"- 可用区: {current_ad_name}\n"
-                             f"- 公网IP: {public_ip}\n"
-                             f"- 登陆用户名: root")
-            
-            if enable_password_auth and instance_password:
-                result_for_tg += f"\n- 密码: {instance_password}"
-            else:
-                result_for_tg += "\n- 登录方式: 仅 SSH 密钥"
+        # 租户级限流：令牌不足时不计入尝试次数，等待令牌补充后重新排队
+        throttle_wait = _launch_limiter.acquire(self.profile_config.get('tenancy'), self.profile_config.get('region'))
+        if throttle_wait > 0:
+            return throttle_wait + random.uniform(0, 1)
 
-            if firewall_msg:
-                 result_for_tg += f"\n- {firewall_msg}"
+        if not self.ensure_target():
+            return self._schedule_retry()
 
-            if dns_update_msg:
-                result_for_tg += f"\n{dns_update_msg}"
+        self.count_attempt()
+        current_ad_name = self.choose_ad()
+        if current_ad_name is None:
+            return self._schedule_retry()
 
-            tg_msg = (f"🔔 *任务完成通知*\n\n"
-                      f"*账户*: `{alias}`\n"
-                      f"*任务名称*: `{details.get('display_name_prefix', 'snatch-instance')}`\n\n"
-                      f"*结果*:\n{result_for_tg}")
-            
-            send_tg_notification(tg_msg)
-            
-            return
-        except ServiceError as e:
-            force_update = True
-            if e.status == 429 or "TooManyRequests" in e.code or "Out of host capacity" in str(e.message) or "LimitExceeded" in e.code:
-                status_data['last_message'] = f"在 {current_ad_name} 中资源不足 ({e.code})"
+        if self.launch(current_ad_name):
+            return None
+        
+        if self.control.cancelled:
+            logging.info(f"Snatching task {self.task_id} has been {self.control.reason}. Exiting.")
+            return None
+
+        return self._schedule_retry()
+
+    def _schedule_retry(self, delay=None):
+        if delay is None:
+            delay = self.next_delay()
+        self.status_data['last_message'] += f"，将在 {delay} 秒后重试..."
+        self.status_data['next_attempt_at'] = time.time() + delay
+        _db_execute_celery('UPDATE tasks SET result = ? WHERE id = ?', (json.dumps(self.status_data), self.task_id), task_id=self.task_id)
+        return delay
+
+    def close(self):
+        _snatch_control.unregister(self.control)
+
+class SnatchGroupControl:
+    """组任务的控制视图：所有槽位都被取消后整组才视为取消。"""
+    def __init__(self, group):
+        self._group = group
+
+    @property
+    def cancelled(self):
+        return all(slot.control.cancelled for slot in self._group.slots)
+
+    @property
+    def reason(self):
+        return "all slots cancelled"
+
+class SnatchGroupJob:
+    """
+    多实例抢占协调器。各槽位 (每个实例一行任务记录) 共享同一次准备结果与尝试循环：
+    每轮只选一次可用性域，发现容量后在同一 AD 中连续为剩余槽位发起 launch，直到遇到失败为止。
+    """
+    def __init__(self, group_id, slots):
+        self.group_id = group_id
+        self.task_id = group_id
+        self.slots = list(slots)
+        self.control = SnatchGroupControl(self)
+
+    def initial_delay(self):
+        return min(slot.initial_delay() for slot in self.slots)
+
+    def next_delay(self):
+        return self.slots[0].next_delay()
+
+    def _active_slots(self):
+        active = []
+        for slot in self.slots:
+            if slot.is_current():
+                active.append(slot)
             else:
-                status_data['last_message'] = f"在 {current_ad_name} 中遇到API错误 ({e.code})"
+                slot.close()
+        self.slots = active
+        return active
+
+    def attempt(self):
+        pending = self._active_slots()
+        if not pending:
+            return None
+        lead = pending[0]
+        tenancy, region = lead.profile_config.get('tenancy'), lead.profile_config.get('region')
+
+        throttle_wait = _launch_limiter.acquire(tenancy, region)
+        if throttle_wait > 0:
+            return throttle_wait + random.uniform(0, 1)
+
+        if any(slot._needs_refresh for slot in pending):
+            # 同一租户/区域下的槽位共用准备缓存，逐个刷新只有第一个会真正调用 API
+            if not all(slot.ensure_target() for slot in pending):
+                return self._retry_all(pending, lead)
+
+        for slot in pending:
+            slot.count_attempt()
+        current_ad_name = lead.choose_ad()
+        if current_ad_name is None:
+            return self._retry_all(pending, lead)
+
+        while pending:
+            slot = pending[0]
+            if not slot.launch(current_ad_name):
+                break
+            pending.pop(0)
+            self.slots.remove(slot)
+            slot.close()
+            if not pending:
+                return None
+            # 容量出现后继续填充剩余槽位，但仍受租户令牌桶约束
+            throttle_wait = _launch_limiter.acquire(tenancy, region)
+            if throttle_wait > 0:
+                # 与单任务路径一样按整秒显示与排期 (向上取整，不早于令牌补充时间)
+                delay = int(throttle_wait) + 1
+                for waiting in pending:
+                    waiting.status_data['last_message'] = f"在 {current_ad_name} 中已抢到实例，等待限流令牌后继续填充"
+                    waiting._schedule_retry(delay)
+                return delay
+
+        return self._retry_all(pending, pending[0] if pending else lead)
+
+    def _retry_all(self, pending, source):
+        delay = self.next_delay()
+        message = source.status_data.get('last_message', '')
+        for slot in pending:
+            slot.status_data['last_message'] = message
+            slot._schedule_retry(delay)
+        return delay
+
+    def close(self):
+        for slot in self.slots:
+            slot.close()
+
+# --- 抢占调度器 ---
+# 所有等待中的抢占任务保存在一个按下次尝试时间排序的堆中，到期后仅把单次 launch 尝试
+# 派发到一个小线程池执行。成千上万个等待中的任务只消耗内存，不再各自占用一个 Celery 线程。
+# 下一次尝试时间同时写入任务 result (next_attempt_at)，worker 重启后由 recover_snatching_tasks 恢复。
+SNATCH_ATTEMPT_WORKERS = int(os.environ.get('SNATCH_ATTEMPT_WORKERS', 8))
+
+class SnatchScheduler:
+    def __init__(self, max_workers):
+        self._max_workers = max_workers
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = None
+        self._thread = None
+
+    def submit(self, job, delay=0):
+        with self._cond:
+            heapq.heappush(self._heap, (time.time() + delay, next(self._seq), job))
+            self._ensure_started()
+            self._cond.notify()
+
+    def wake(self):
+        with self._cond:
+            self._cond.notify()
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="snatch-attempt")
+        self._thread = threading.Thread(target=self._run, name="snatch-scheduler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                due_at, _, job = self._heap[0]
+                if not job.control.cancelled:
+                    wait_seconds = due_at - time.time()
+                    if wait_seconds > 0:
+                        self._cond.wait(wait_seconds)
+                        continue
+                heapq.heappop(self._heap)
+            if job.control.cancelled:
+                logging.info(f"Snatch job {job.task_id} dropped from scheduler ({job.control.reason}).")
+                job.close()
+                continue
+            self._executor.submit(self._execute, job)
+
+    def _execute(self, job):
+        try:
+            delay = job.attempt()
         except Exception as e:
-            force_update = True
-            status_data['last_message'] = f"在 {current_ad_name} 中遇到未知错误 ({str(e)[:50]}...)"
-        
-        task_record_check = query_db('SELECT status FROM tasks WHERE id = ?', [task_id], one=True)
-        if not task_record_check or task_record_check['status'] not in ['running', 'pending']:
-            logging.info(f"Snatching task {task_id} has been stopped or paused. Exiting loop.")
+            logging.error(f"Snatch job {job.task_id} crashed: {e}", exc_info=True)
+            delay = job.next_delay()
+        if delay is None or job.control.cancelled:
+            job.close()
             return
+        self.submit(job, delay)
+
+_snatch_scheduler = SnatchScheduler(SNATCH_ATTEMPT_WORKERS)
+
+@celery.task
+def _snatch_group_task(group_id, profile_config, alias, slots, auto_bind_domain=False):
+    """slots: [[task_id, details, run_id], ...]，每个槽位对应一行抢占任务记录。"""
+    jobs = []
+    for task_id, details, run_id in slots:
+        control = _snatch_control.register(task_id, run_id)
+        job = _prepare_snatch_job(control, task_id, profile_config, alias, details, run_id, auto_bind_domain)
+        if job is None:
+            _snatch_control.unregister(control)
+            continue
+        jobs.append(job)
+    if not jobs:
+        return
+    group_job = SnatchGroupJob(group_id, jobs)
+    _snatch_scheduler.submit(group_job, group_job.initial_delay())
+
+# --- 实例置备流水线 ---
+# launch 被接受后立即释放抢占线程，后续步骤拆成独立的 Celery 阶段：
+#   防火墙 ─────────────────────────────┐
+#   等待 RUNNING → 获取公网 IP → DNS 绑定 ┴→ 汇总 (写入结果 + TG 通知)
+# 每个阶段各自重试，状态写入任务 result 的 pipeline 字段；服务重启后已完成的阶段不会重复执行。
+PROVISION_STAGES = ('wait_running', 'public_ip', 'firewall', 'dns')
+PROVISION_RUNNING_POLL = 10
+PROVISION_RUNNING_TIMEOUT = 600
+
+def _load_task_result(task_id):
+    row = query_db('SELECT status, result FROM tasks WHERE id = ?', [task_id], one=True)
+    if not row:
+        return None, {}
+    try:
+        return row['status'], json.loads(row['result']) if row['result'] else {}
+    except (json.JSONDecodeError, TypeError):
+        return row['status'], {}
+
+def _set_provision_stage(task_id, stage, status, message=None, value=None, attempts=None):
+    """原子地更新单个阶段状态，并行阶段之间不会互相覆盖。"""
+    stage_data = {"status": status, "updated_at": datetime.datetime.now(timezone.utc).isoformat()}
+    if message is not None: stage_data['message'] = message
+    if value is not None: stage_data['value'] = value
+    if attempts is not None: stage_data['attempts'] = attempts
+    _db_execute_celery(f"UPDATE tasks SET result = json_set(result, '$.pipeline.{stage}', json(?)) WHERE id = ? AND status = 'running'",
+                       (json.dumps(stage_data), task_id), task_id=task_id)
+
+def _provision_stage_state(task_id, stage):
+    _, status_data = _load_task_result(task_id)
+    return status_data.get('pipeline', {}).get(stage, {}), status_data
+
+@celery.task
+def _snatch_post_launch_task(task_id, profile_config, alias, details, status_data):
+    """置备流水线入口：只负责编排，立即返回。"""
+    pipeline = status_data.get('pipeline') or {}
+    stage_seed = {stage: pipeline.get(stage) or {"status": "pending"} for stage in PROVISION_STAGES}
+    _db_execute_celery("UPDATE tasks SET result = json_set(result, '$.pipeline', json(?), '$.last_message', ?) WHERE id = ?",
+                       (json.dumps(stage_seed), f"实例 {status_data['launch'].get('display_name')} 已创建，正在置备...", task_id), task_id=task_id)
+    chord(
+        group(
+            _provision_firewall_stage.si(task_id, profile_config),
+            chain(_provision_wait_running_stage.si(task_id, profile_config),
+                  _provision_public_ip_stage.si(task_id, profile_config),
+                  _provision_dns_stage.si(task_id))
+        ),
+        # 任一阶段抛出未处理的异常 (如数据库锁定) 时汇总不会执行，由错误回调把任务标记为失败
+        _provision_finalize_stage.si(task_id, alias, details).on_error(_provision_failed_task.s(task_id))
+    ).delay()
+
+@celery.task
+def _provision_failed_task(request, exc, traceback, task_id):
+    """置备流水线的错误回调：任务仍为 running 时标记为失败，避免一直停留在运行中直到重启恢复。"""
+    logging.error(f"Task {task_id} provisioning pipeline aborted: {exc}")
+    _, status_data = _load_task_result(task_id)
+    display_name = status_data.get('launch', {}).get('display_name', '')
+    _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ? AND status = ?',
+                       ('failure', f"❌ 实例已创建 ({display_name})，但置备流程异常中断: {exc}",
+                        datetime.datetime.now(timezone.utc).isoformat(), task_id, 'running'), task_id=task_id)
+
+@celery.task(bind=True, max_retries=PROVISION_RUNNING_TIMEOUT // PROVISION_RUNNING_POLL)
+def _provision_wait_running_stage(self, task_id, profile_config):
+    state, status_data = _provision_stage_state(task_id, 'wait_running')
+    if state.get('status') in ('done', 'failed'):
+        return
+    instance_id = status_data['launch']['instance_id']
+    try:
+        clients, error = get_oci_clients(profile_config, validate=False)
+        if error: raise Exception(error)
+        # 与同区间的其他等待者共享一次 list_instances；最多等待一个轮询周期后交还 worker
+        instance = _lifecycle_watcher.wait_for(clients['compute'], profile_config.get('tenancy'), 'instance', instance_id,
+                                               ('RUNNING', 'TERMINATING', 'TERMINATED'), max_wait_seconds=PROVISION_RUNNING_POLL)
+        lifecycle_state = instance.lifecycle_state if instance else None
+    except oci.exceptions.MaximumWaitTimeExceeded:
+        lifecycle_state = None
+    except Exception as e:
+        lifecycle_state = None
+        logging.warning(f"Task {task_id} wait_running poll failed: {e}")
+    attempts = self.request.retries + 1
+    if lifecycle_state == 'RUNNING':
+        _set_provision_stage(task_id, 'wait_running', 'done', value=lifecycle_state, attempts=attempts)
+        return
+    if lifecycle_state in ('TERMINATING', 'TERMINATED'):
+        _set_provision_stage(task_id, 'wait_running', 'failed', message=f"实例已进入 {lifecycle_state} 状态", attempts=attempts)
+        return
+    if self.request.retries >= self.max_retries:
+        _set_provision_stage(task_id, 'wait_running', 'failed', message=f"等待实例运行超时 ({PROVISION_RUNNING_TIMEOUT} 秒)", attempts=attempts)
+        return
+    _set_provision_stage(task_id, 'wait_running', 'retrying', value=lifecycle_state, attempts=attempts)
+    raise self.retry(countdown=1)
+
+@celery.task(bind=True, max_retries=3)
+def _provision_public_ip_stage(self, task_id, profile_config):
+    state, status_data = _provision_stage_state(task_id, 'public_ip')
+    if state.get('status') in ('done', 'failed', 'skipped'):
+        return
+    if status_data.get('pipeline', {}).get('wait_running', {}).get('status') != 'done':
+        _set_provision_stage(task_id, 'public_ip', 'skipped', message="实例未进入运行状态")
+        return
+    attempts = self.request.retries + 1
+    try:
+        clients, error = get_oci_clients(profile_config, validate=False)
+        if error: raise Exception(error)
+        compute_client, vnet_client = clients['compute'], clients['vnet']
+        vnic_attachments = oci.pagination.list_call_get_all_results(compute_client.list_vnic_attachments, compartment_id=profile_config.get('tenancy'), instance_id=status_data['launch']['instance_id']).data
+        public_ip = "无"
+        if vnic_attachments:
+            public_ip = vnet_client.get_vnic(vnic_attachments[0].vnic_id).data.public_ip or "无"
+        _set_provision_stage(task_id, 'public_ip', 'done', value=public_ip, attempts=attempts)
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            _set_provision_stage(task_id, 'public_ip', 'retrying', message=str(e)[:100], attempts=attempts)
+            raise self.retry(countdown=5 * (2 ** self.request.retries))
+        _set_provision_stage(task_id, 'public_ip', 'failed', message=str(e)[:100], value="获取失败", attempts=attempts)
+
+@celery.task(bind=True, max_retries=3)
+def _provision_firewall_stage(self, task_id, profile_config):
+    state, status_data = _provision_stage_state(task_id, 'firewall')
+    if state.get('status') in ('done', 'failed'):
+        return
+    attempts = self.request.retries + 1
+    try:
+        clients, error = get_oci_clients(profile_config, validate=False)
+        if error: raise Exception(error)
+        firewall_msg = _auto_open_firewall(clients['vnet'], status_data['launch']['subnet_id'])
+        if firewall_msg.startswith("⚠️"):
+            raise Exception(firewall_msg)
+        _set_provision_stage(task_id, 'firewall', 'done', message=firewall_msg, attempts=attempts)
+    except Exception as e:
+        logging.error(f"Task {task_id} firewall auto-open error: {e}")
+        if self.request.retries < self.max_retries:
+            _set_provision_stage(task_id, 'firewall', 'retrying', message=str(e)[:100], attempts=attempts)
+            raise self.retry(countdown=5 * (2 ** self.request.retries))
+        message = str(e) if str(e).startswith("⚠️") else f"⚠️ 防火墙自动开放异常: {str(e)[:30]}"
+        _set_provision_stage(task_id, 'firewall', 'failed', message=message, attempts=attempts)
+
+@celery.task(bind=True, max_retries=3)
+def _provision_dns_stage(self, task_id):
+    state, status_data = _provision_stage_state(task_id, 'dns')
+    if state.get('status') in ('done', 'failed', 'skipped', 'queued', 'superseded'):
+        return
+    launch = status_data['launch']
+    public_ip = status_data.get('pipeline', {}).get('public_ip', {}).get('value')
+    if not launch.get('auto_bind_domain'):
+        _set_provision_stage(task_id, 'dns', 'skipped', message="未启用自动绑定域名")
+        return
+    if not public_ip or public_ip in ("无", "获取失败"):
+        _set_provision_stage(task_id, 'dns', 'skipped', message="没有可绑定的公网IP")
+        return
+    # 交给 DNS 发件箱，不阻塞汇总；重试与最终结果由发件箱写回 pipeline.dns (任务结束后替换结果中的占位文字)
+    placeholder = _enqueue_dns_update(launch['display_name'], public_ip, 'A', task_id, '$.pipeline.dns')
+    _set_provision_stage(task_id, 'dns', 'queued', message=placeholder, attempts=self.request.retries + 1)
+
+@celery.task
+def _provision_finalize_stage(task_id, alias, details):
+    task_status, status_data = _load_task_result(task_id)
+    if task_status != 'running' or 'launch' not in status_data:
+        return
+    launch = status_data['launch']
+    pipeline = status_data.get('pipeline', {})
+    current_ad_name = launch['ad']
+    display_name = launch.get('display_name')
+    enable_password_auth = launch.get('enable_password_auth')
+    instance_password = launch.get('instance_password')
+    now = datetime.datetime.now(timezone.utc).isoformat()
+
+    wait_running = pipeline.get('wait_running', {})
+    if wait_running.get('status') != 'done':
+        _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ? AND status = ?',
+                           ('failure', f"❌ 实例已创建 ({display_name})，但置备阶段失败: {wait_running.get('message', '未知错误')}", now, task_id, 'running'), task_id=task_id)
+        return
+
+    public_ip = pipeline.get('public_ip', {}).get('value') or "获取失败"
+    firewall_msg = pipeline.get('firewall', {}).get('message', '')
+    dns_stage = pipeline.get('dns', {})
+    dns_update_msg = dns_stage.get('message', '') if dns_stage.get('status') != 'skipped' else ''
+
+    db_msg = f"🎉 抢占成功 (第 {status_data['attempt_count']} 次尝试)!\n- 实例名: {display_name}\n- 可用区: {current_ad_name}\n- 公网IP: {public_ip}\n- 登陆用户名：root"
+
+    if firewall_msg:
+        db_msg += f"\n- {firewall_msg}"
+
+    if enable_password_auth and instance_password:
+        db_msg += f"\n- 密码：{instance_password}"
+    else:
+        db_msg += "\n- 登录方式: 仅 SSH 密钥"
+
+    if dns_update_msg:
+        db_msg += f"\n{dns_update_msg}"
+
+    # 仅第一次汇总生效，避免重复通知
+    if not _db_execute_celery('UPDATE tasks SET status = ?, result = ?, completed_at = ? WHERE id = ? AND status = ?',
+                              ('success', db_msg, now, task_id, 'running'), task_id=task_id):
+        return
+    _flush_dns_writebacks(task_id)
+
+    duration_str = "未知"
+    try:
+        start_time = datetime.datetime.fromisoformat(status_data['start_time'])
+        end_time = datetime.datetime.now(timezone.utc)
+        duration = end_time - start_time
+        duration_str = _format_timedelta(duration)
+    except (KeyError, TypeError):
+        logging.warning(f"无法为任务 {task_id} 计算总用时。")
+
+    result_for_tg = (f"🎉 抢占成功 (第 {status_data['attempt_count']} 次尝试)!\n"
+                     f"- 总用时: {duration_str}\n"
+                     f"- 实例名: {display_name}\n"
+                     f"- 可用区: {current_ad_name}\n"
+                     f"- 公网IP: {public_ip}\n"
+                     f"- 登陆用户名: root")
+
+    if enable_password_auth and instance_password:
+        result_for_tg += f"\n- 密码: {instance_password}"
+    else:
+        result_for_tg += "\n- 登录方式: 仅 SSH 密钥"
+
+    if firewall_msg:
+         result_for_tg += f"\n- {firewall_msg}"
+
+    if dns_update_msg:
+        result_for_tg += f"\n{dns_update_msg}"
+
+    tg_msg = (f"🔔 *任务完成通知*\n\n"
+              f"*账户*: `{alias}`\n"
+              f"*任务名称*: `{details.get('display_name_prefix', 'snatch-instance')}`\n\n"
+              f"*结果*:\n{result_for_tg}")
 
-        delay = random.randint(details.get('min_delay', 30), details.get('max_delay', 90))
-        status_data['last_message'] += f"，将在 {delay} 秒后重试..."
-        current_time = time.time()
-        if (current_time - last_update_time > 5) or force_update:
-            _db_execute_celery('UPDATE tasks SET result = ? WHERE id = ?', (json.dumps(status_data), task_id))
-            last_update_time = current_time
-        time.sleep(delay)
+    send_tg_notification(tg_msg)
@@ -0,0 +1,18 @@
+# /app/blueprints/task_events.py
+# 任务变化事件的发布端。Celery 任务 / 后台线程写入任务后调用 publish_task_event，
+# 独立的推送进程 (events_server.py) 订阅该频道，合并后读取任务最新状态推送给浏览器。
+
+import json, logging
+from app import redis_client
+
+# 与 events_server.py 中的 EVENTS_CHANNEL 保持一致
+EVENTS_CHANNEL = "events:tasks"
+
+def publish_task_event(provider, task_id, **payload):
+    """通知任务有变化。payload 中带 message 的事件 (如 AWS 日志) 原样转发，推送进程不再读取任务状态。"""
+    if redis_client is None:
+        return
+    try:
+        redis_client.publish(EVENTS_CHANNEL, json.dumps(dict(payload, provider=provider, task_id=task_id)))
+    except Exception as e:
+        logging.warning(f"发布任务事件失败: {e}")
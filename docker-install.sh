@@ -26,12 +26,26 @@ generate_docker_config() {
 
     if [ "$mode" == "ip" ]; then
         # === IP 模式 ===
+        # 由 Caddy 监听映射端口 (仅 HTTP)，/events 转发给推送服务，其余请求转发给 web
+        cat > Caddyfile.ip <<EOF
+:5000 {
+    reverse_proxy /events events:5001
+    reverse_proxy web:5000
+}
+EOF
         cat > docker-compose.override.yml <<EOF
 version: '3.8'
 services:
-  web:
+  caddy:
+    image: caddy:latest
+    restart: always
     ports:
       - "${port}:5000"
+    volumes:
+      - ./Caddyfile.ip:/etc/caddy/Caddyfile
+    depends_on:
+      - web
+      - events
 EOF
     else
         # === 域名模式 ===
@@ -45,9 +59,13 @@ EOF
              
              cat > Caddyfile <<EOF
 $DOMAIN {
+    reverse_proxy /events events:5001
     reverse_proxy web:5000
 }
 EOF
+        elif ! grep -q "events:5001" "Caddyfile"; then
+             # 旧版 Caddyfile 补上推送服务的转发规则
+             sed -i "s|^\(\s*\)reverse_proxy web:5000|\1reverse_proxy /events events:5001\n\1reverse_proxy web:5000|" Caddyfile
         fi
 
         cat > docker-compose.override.yml <<EOF
@@ -70,6 +88,7 @@ services:
       - DOMAIN_OR_IP=\${DOMAIN_OR_IP}
     depends_on:
       - web
+      - events
 EOF
     fi
 }
@@ -0,0 +1,173 @@
+# /app/events_server.py
+# 任务状态推送服务 (Server-Sent Events)，与 web 分开的独立进程：
+#   gunicorn --worker-class gevent --workers 1 --bind 0.0.0.0:5001 events_server:app
+# web 使用同步 gunicorn worker 且依赖 signal.alarm 实现超时，不能承载长连接；
+# 本进程不导入 app.py，只订阅 Redis 频道并读取任务表，一个 gevent worker 即可保持所有浏览器的连接。
+# Celery 任务 / 后台线程写入任务后发布事件 (blueprints/task_events.py)，这里把短时间内变化的任务合并，
+# 读取一次最新状态后广播给所有连接；没有浏览器连接时不读取数据库。
+# 反向代理需要把 /events 转发到本进程 (见 Caddyfile / docker-install.sh / install.sh)。
+
+import os, json, time, queue, sqlite3, logging, threading
+import redis
+from flask import Flask, Response, request, session
+
+app = Flask(__name__)
+# 与 app.py 相同的密钥，用于读取 web 写入的登录会话
+app.secret_key = os.getenv('SECRET_KEY', 'a_very_secret_key_for_the_3in1_panel')
+
+redis_conn_url = os.environ.get('REDIS_URL', 'redis://redis:6379/0')
+try:
+    redis_client = redis.from_url(redis_conn_url, decode_responses=True)
+except Exception as e:
+    print(f"Warning: Redis connection failed: {e}")
+    redis_client = None
+
+# 与 blueprints/task_events.py 中的 EVENTS_CHANNEL 保持一致
+EVENTS_CHANNEL = "events:tasks"
+SSE_BATCH_WINDOW = 0.5
+SSE_KEEPALIVE_SECONDS = 15
+SSE_RETRY_MS = 3000
+# 单个连接积压的消息超过该数量时断开，浏览器重连后补查
+SSE_CLIENT_BACKLOG = int(os.environ.get('SSE_CLIENT_BACKLOG', 500))
+
+# 各面板的任务表：provider -> (数据库文件, 查询列)
+TASK_DATABASES = {
+    'oci': ('oci_tasks.db', 'id, type, status, result'),
+    'azure': ('azure_tasks.db', 'id, status, result'),
+}
+
+def _format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _load_tasks(provider, task_ids):
+    database, columns = TASK_DATABASES[provider]
+    conn = sqlite3.connect(database, timeout=3)
+    conn.row_factory = sqlite3.Row
+    try:
+        placeholders = ','.join('?' * len(task_ids))
+        rows = conn.execute(f"SELECT {columns} FROM tasks WHERE id IN ({placeholders})", task_ids).fetchall()
+    finally:
+        conn.close()
+    tasks = []
+    for r in rows:
+        task = {key: r[key] for key in r.keys() if key != 'id'}
+        tasks.append(dict(task, task_id=r['id'], provider=provider))
+    return tasks
+
+# --- 连接管理与广播 ---
+class EventHub:
+    """一个监听线程订阅 Redis 频道，把事件广播到每个 SSE 连接的队列。"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = set()
+        self._listener = None
+
+    def connect(self):
+        client = queue.Queue()
+        with self._lock:
+            self._clients.add(client)
+            if not (self._listener and self._listener.is_alive()):
+                self._listener = threading.Thread(target=self._listen, name="sse-listener", daemon=True)
+                self._listener.start()
+        return client
+
+    def disconnect(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def has_clients(self):
+        with self._lock:
+            return bool(self._clients)
+
+    def broadcast(self, chunk):
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            if client.qsize() >= SSE_CLIENT_BACKLOG:
+                # 浏览器读取过慢，断开后由 EventSource 重连并补查
+                self.disconnect(client)
+                client.put(None)
+            else:
+                client.put(chunk)
+
+    def _flush(self, changed):
+        for provider, task_ids in changed.items():
+            try:
+                for task in _load_tasks(provider, sorted(task_ids)):
+                    self.broadcast(_format_sse('task', task))
+            except Exception as e:
+                logging.warning(f"读取 {provider} 任务状态失败: {e}")
+
+    def _listen(self):
+        backoff = 1
+        while True:
+            pubsub = None
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(EVENTS_CHANNEL)
+                # 订阅 (重新) 建立前发布的事件已丢失，通知页面补查一次
+                self.broadcast(_format_sse('resync', {}))
+                backoff = 1
+                changed, flush_at, last_sent = {}, None, time.time()
+                while True:
+                    wait = min(flush_at or float('inf'), last_sent + SSE_KEEPALIVE_SECONDS) - time.time()
+                    message = pubsub.get_message(timeout=max(0.05, wait))
+                    if message and message.get('type') == 'message':
+                        try:
+                            event = json.loads(message['data'])
+                        except (TypeError, json.JSONDecodeError):
+                            event = None
+                        if event and self.has_clients():
+                            if 'message' in event:
+                                self.broadcast(_format_sse('log', event))
+                                last_sent = time.time()
+                            elif event.get('provider') in TASK_DATABASES:
+                                changed.setdefault(event['provider'], set()).add(event['task_id'])
+                                flush_at = flush_at or time.time() + SSE_BATCH_WINDOW
+                    if flush_at and time.time() >= flush_at:
+                        self._flush(changed)
+                        changed, flush_at, last_sent = {}, None, time.time()
+                    elif time.time() - last_sent >= SSE_KEEPALIVE_SECONDS:
+                        # 保持代理连接，同时让已断开的连接在写入失败时退出
+                        self.broadcast(": keepalive\n\n")
+                        last_sent = time.time()
+            except Exception as e:
+                logging.warning(f"任务事件频道连接中断: {e}，{backoff} 秒后重连。")
+            finally:
+                if pubsub is not None:
+                    try: pubsub.close()
+                    except Exception: pass
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+_hub = EventHub()
+
+def get_real_ip():
+    if request.headers.getlist("X-Forwarded-For"):
+        return request.headers.getlist("X-Forwarded-For")[0]
+    return request.remote_addr
+
+@app.route('/events')
+def task_events():
+    # IP 变化后的会话校验 (指纹、地理围栏) 由 web 完成并更新 login_ip，这里只接受与登录 IP 一致的会话
+    if 'user_logged_in' not in session or session.get('login_ip') != get_real_ip():
+        return Response("Unauthorized\n", status=401, mimetype='text/plain')
+    if redis_client is None:
+        # 前端收到错误后退回定时轮询
+        return Response("Redis unavailable\n", status=503, mimetype='text/plain')
+
+    client = _hub.connect()
+
+    def stream():
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            while True:
+                chunk = client.get()
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            _hub.disconnect(client)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -12,6 +12,7 @@ INSTALL_DIR="/opt/cloud_manager"
 REPO_URL="https://github.com/SIJULY/cloud_manager.git"
 SERVICE_NAME="cloud_manager"
 CELERY_SERVICE_NAME="cloud_manager_celery"
+EVENTS_SERVICE_NAME="cloud_manager_events"
 CADDY_CONFIG_START="# Cloud Manager Panel Configuration Start"
 CADDY_CONFIG_END="# Cloud Manager Panel Configuration End"
 
@@ -40,13 +41,16 @@ uninstall_panel() {
     print_info "1. 停止并禁用后台服务..."
     systemctl stop ${SERVICE_NAME}.service || true
     systemctl stop ${CELERY_SERVICE_NAME}.service || true
+    systemctl stop ${EVENTS_SERVICE_NAME}.service || true
     systemctl disable ${SERVICE_NAME}.service || true
     systemctl disable ${CELERY_SERVICE_NAME}.service || true
+    systemctl disable ${EVENTS_SERVICE_NAME}.service || true
     print_success "服务已停止并禁用。"
 
     print_info "2. 移除 systemd 服务文件..."
     rm -f /etc/systemd/system/${SERVICE_NAME}.service
     rm -f /etc/systemd/system/${CELERY_SERVICE_NAME}.service
+    rm -f /etc/systemd/system/${EVENTS_SERVICE_NAME}.service
     systemctl daemon-reload
     print_success "服务文件已移除。"
 
@@ -146,11 +150,17 @@ install_or_update_panel() {
 ${CADDY_CONFIG_START}
 $ACCESS_ADDRESS {
     reverse_proxy unix//run/gunicorn/cloud_manager.sock
+    reverse_proxy /events unix//run/cloud_manager_events/events.sock
 }
 ${CADDY_CONFIG_END}
 EOF
     fi
 
+    if [ -f "/etc/caddy/Caddyfile" ] && ! grep -q "cloud_manager_events/events.sock" /etc/caddy/Caddyfile; then
+        # 旧版配置补上推送服务的转发规则
+        sed -i "s|^\(\s*\)reverse_proxy unix//run/gunicorn/cloud_manager.sock|&\n\1reverse_proxy /events unix//run/cloud_manager_events/events.sock|" /etc/caddy/Caddyfile
+    fi
+
     print_info "步骤 4: 更新 Python 依赖并设置权限..."
     cd "${INSTALL_DIR}"
     python3 -m venv venv
@@ -182,6 +192,25 @@ ExecStart=${INSTALL_DIR}/venv/bin/gunicorn --workers 3 --bind unix:/run/gunicorn
 Restart=always
 RestartSec=5
 
+[Install]
+WantedBy=multi-user.target
+EOF
+
+    # 任务状态推送 (SSE) 使用单独的 gevent 进程，长连接不占用 web 的同步 worker
+    cat > /etc/systemd/system/${EVENTS_SERVICE_NAME}.service << EOF
+[Unit]
+Description=Task event stream (SSE) for the Cloud Manager Panel
+After=network.target redis-server.service
+
+[Service]
+User=caddy
+Group=caddy
+RuntimeDirectory=cloud_manager_events
+WorkingDirectory=${INSTALL_DIR}
+ExecStart=${INSTALL_DIR}/venv/bin/gunicorn --worker-class gevent --workers 1 --bind unix:/run/cloud_manager_events/events.sock -m 007 events_server:app
+Restart=always
+RestartSec=5
+
 [Install]
 WantedBy=multi-user.target
 EOF
@@ -205,8 +234,8 @@ EOF
 
     print_info "步骤 6: 启动所有服务..."
     systemctl daemon-reload
-    systemctl enable redis-server ${SERVICE_NAME}.service ${CELERY_SERVICE_NAME}.service
-    systemctl restart redis-server ${SERVICE_NAME}.service ${CELERY_SERVICE_NAME}.service
+    systemctl enable redis-server ${SERVICE_NAME}.service ${CELERY_SERVICE_NAME}.service ${EVENTS_SERVICE_NAME}.service
+    systemctl restart redis-server ${SERVICE_NAME}.service ${CELERY_SERVICE_NAME}.service ${EVENTS_SERVICE_NAME}.service
     systemctl reload caddy
 
     echo ""
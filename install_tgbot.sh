@@ -69,22 +69,47 @@ logger = logging.getLogger(__name__)
 # --- 2. API 客户端 ---
 BASE_URL = f"{PANEL_URL}/api/v1/oci"
 HEADERS = {"Authorization": f"Bearer {PANEL_API_KEY}", "Content-Type": "application/json"}
+_http_client = None
+
+def get_http_client() -> httpx.AsyncClient:
+    # 整个进程共用一个连接池，避免每次请求重新建立 TCP/TLS 连接
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(headers=HEADERS, timeout=30.0,
+                                         limits=httpx.Limits(max_connections=10, max_keepalive_connections=5))
+    return _http_client
 
 async def api_request(method: str, endpoint: str, **kwargs):
-    async with httpx.AsyncClient() as client:
-        try:
-            url = f"{BASE_URL}/{endpoint}"
-            response = await client.request(method, url, headers=HEADERS, timeout=30.0, **kwargs)
-            response.raise_for_status()
-            if not response.content: return {}
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            logger.error(f"API Error calling {e.request.url}: {e.response.status_code} - {e.response.text}")
-            try: return {"error": e.response.json().get("error", "未知API错误")}
-            except: return {"error": f"API返回了非JSON错误: {e.response.status_code}"}
-        except Exception as e:
-            logger.error(f"Request failed for endpoint {endpoint}: {e}")
-            return {"error": str(e)}
+    client = get_http_client()
+    try:
+        url = f"{BASE_URL}/{endpoint}"
+        response = await client.request(method, url, **kwargs)
+        response.raise_for_status()
+        if not response.content: return {}
+        return response.json()
+    except httpx.HTTPStatusError as e:
+        logger.error(f"API Error calling {e.request.url}: {e.response.status_code} - {e.response.text}")
+        try: return {"error": e.response.json().get("error", "未知API错误")}
+        except: return {"error": f"API返回了非JSON错误: {e.response.status_code}"}
+    except Exception as e:
+        logger.error(f"Request failed for endpoint {endpoint}: {e}")
+        return {"error": str(e)}
+
+# --- 菜单数据短时缓存 (账户列表、实例列表)，连续点按按钮时不重复请求面板 ---
+MENU_CACHE_TTL = 30
+_menu_cache = {}
+
+async def cached_api_get(endpoint: str):
+    cached = _menu_cache.get(endpoint)
+    if cached and cached[0] > asyncio.get_running_loop().time():
+        return cached[1]
+    result = await api_request("GET", endpoint)
+    if result is not None and not (isinstance(result, dict) and "error" in result):
+        _menu_cache[endpoint] = (asyncio.get_running_loop().time() + MENU_CACHE_TTL, result)
+    return result
+
+def invalidate_menu_cache(endpoint: str):
+    _menu_cache.pop(endpoint, None)
 
 # --- 3. Telegram 机器人逻辑 (此处省略了完整的机器人代码，实际生成时会包含全部) ---
 # ... (完整的 bot.py 代码从这里开始) ...
@@ -138,20 +163,53 @@ async def build_param_selection_menu(form_data: dict, action_type: str):
     keyboard.append([InlineKeyboardButton("❌ 取消操作", callback_data="back:main")])
     return text, InlineKeyboardMarkup(keyboard)
 
-async def poll_task_status(chat_id: int, context: ContextTypes.DEFAULT_TYPE, task_id: str, task_name: str):
-    max_retries, retries = 120, 0
-    while retries < max_retries:
-        await asyncio.sleep(5)
-        result = await api_request("GET", f"task-status/{task_id}")
-        if result and result.get("status") in ["success", "failure"]:
-            final_message = f"🔔 *任务完成通知*\n\n*任务名称*: \`{task_name}\`\n\n*结果*:\n\`{result.get('result')}\`"
-            await context.bot.send_message(chat_id=chat_id, text=final_message, parse_mode=ParseMode.MARKDOWN)
-            return
-        retries += 1
-    await context.bot.send_message(chat_id=chat_id, text=f"🔔 *任务超时*\n\n任务 \`{task_name}\` 轮询超时（超过10分钟），请在网页端查看最终结果。")
+# --- 任务完成通知：所有待通知任务共用一个批量查询请求 (面板 task-status/batch 接口)，每 5 秒一次，取代每个任务单独轮询 ---
+TASK_POLL_INTERVAL = 5
+TASK_POLL_BATCH_SIZE = 200
+TASK_WATCH_LIMIT = 600
+_watched_tasks = {}
+_task_watcher = None
+
+async def send_task_result(context: ContextTypes.DEFAULT_TYPE, chat_id: int, task_name: str, result: str):
+    final_message = f"🔔 *任务完成通知*\n\n*任务名称*: \`{task_name}\`\n\n*结果*:\n\`{result}\`"
+    await context.bot.send_message(chat_id=chat_id, text=final_message, parse_mode=ParseMode.MARKDOWN)
+
+async def task_watcher_loop(context: ContextTypes.DEFAULT_TYPE):
+    global _task_watcher
+    loop = asyncio.get_running_loop()
+    try:
+        while _watched_tasks:
+            await asyncio.sleep(TASK_POLL_INTERVAL)
+            for task_id, watch in list(_watched_tasks.items()):
+                if loop.time() > watch['deadline']:
+                    _watched_tasks.pop(task_id, None)
+                    await context.bot.send_message(chat_id=watch['chat_id'], text=f"🔔 *任务超时*\n\n任务 \`{watch['task_name']}\` 轮询超时（超过10分钟），请在网页端查看最终结果。")
+            task_ids = list(_watched_tasks)
+            for i in range(0, len(task_ids), TASK_POLL_BATCH_SIZE):
+                statuses = await api_request("POST", "task-status/batch", json={"task_ids": task_ids[i:i + TASK_POLL_BATCH_SIZE]})
+                if "error" in statuses:
+                    break
+                for task_id, task in statuses.items():
+                    if task.get('status') not in ('success', 'failure', 'not_found'):
+                        continue
+                    watch = _watched_tasks.pop(task_id, None)
+                    if not watch:
+                        continue
+                    if task['status'] == 'not_found':
+                        await context.bot.send_message(chat_id=watch['chat_id'], text=f"🔔 任务 \`{watch['task_name']}\` 已不存在，请在网页端查看。")
+                    else:
+                        await send_task_result(context, watch['chat_id'], watch['task_name'], task.get('result'))
+    finally:
+        _task_watcher = None
+
+def watch_task(chat_id: int, context: ContextTypes.DEFAULT_TYPE, task_id: str, task_name: str):
+    global _task_watcher
+    _watched_tasks[task_id] = {"chat_id": chat_id, "task_name": task_name, "deadline": asyncio.get_running_loop().time() + TASK_WATCH_LIMIT}
+    if _task_watcher is None:
+        _task_watcher = asyncio.create_task(task_watcher_loop(context))
 
 async def build_main_menu():
-    profiles = await api_request("GET", "profiles")
+    profiles = await cached_api_get("profiles")
     if not profiles or "error" in profiles:
         return None, f"❌ 无法从面板获取账户列表: {profiles.get('error', '未知错误') if profiles else '无响应'}"
     if not profiles:
@@ -183,7 +241,7 @@ async def build_instance_action_menu(alias: str):
     return InlineKeyboardMarkup(keyboard), f"请为账户 *{alias}* 选择实例操作类型:"
 
 async def build_instance_selection_menu(alias: str, action: str, context: ContextTypes.DEFAULT_TYPE):
-    instances = await api_request("GET", f"{alias}/instances")
+    instances = await cached_api_get(f"{alias}/instances")
     if not instances or "error" in instances:
         return None, f"❌ 获取实例列表失败: {instances.get('error', '未知错误')}"
     if not instances:
@@ -258,7 +316,9 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
             task_id = result.get("task_id")
             task_name = f"{action} on {selected_instance['display_name']}"
             text = f"✅ 命令发送成功！\n任务ID: \`{task_id}\`\n\n机器人将在后台为您监控任务，完成后会主动通知您。"
-            asyncio.create_task(poll_task_status(update.effective_chat.id, context, task_id, task_name))
+            watch_task(update.effective_chat.id, context, task_id, task_name)
+            # 实例状态即将变化，下次打开实例列表时重新获取
+            invalidate_menu_cache(f"{alias}/instances")
         else:
             text = f"❌ 命令发送失败: {result.get('error', '未知错误')}"
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
@@ -378,7 +438,8 @@ async def submit_form(update: Update, context: ContextTypes.DEFAULT_TYPE, form_d
         task_id = result.get("task_id")
         task_name = payload.get('display_name_prefix', 'N/A')
         await context.bot.send_message(chat_id=update.effective_chat.id, text=f"✅ 任务提交成功！\n任务ID: \`{task_id}\`")
-        asyncio.create_task(poll_task_status(update.effective_chat.id, context, task_id, task_name))
+        watch_task(update.effective_chat.id, context, task_id, task_name)
+        invalidate_menu_cache(f"{alias}/instances")
     else:
         await context.bot.send_message(chat_id=update.effective_chat.id, text=f"❌ 任务提交失败: {result.get('error', '未知错误')}")
     context.user_data.clear()
@@ -188,54 +188,112 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     };
     
-    const startLogPolling = (taskId) => {
+    // 当前查看日志的任务。日志按 offset 增量读取 (任意 worker 都能从 Redis 中读取)；推送可用时由 TaskEvents 推送日志，
+    // 序号不连续 (断线重连) 时按 offset 补齐，推送不可用时每秒轮询。读取与推送按顺序逐个处理，offset 不会被并发推进
+    let logTask = null;
+
+    const stopLogPolling = () => {
         if (logPollingInterval) {
             clearInterval(logPollingInterval);
             logPollingInterval = null;
         }
-        UI.instanceList.innerHTML = `<tr><td colspan="6" class="text-center" data-loading-row="true">查询中... <div class="spinner-border spinner-border-sm"></div></td></tr>`;
-        
-        logPollingInterval = setInterval(async () => {
-            try {
-                const data = await apiCall(`/aws/api/task/${taskId}/logs`);
-                if (data && data.logs) {
-                    const loadingRow = UI.instanceList.querySelector('td[data-loading-row="true"]');
-                    if (loadingRow) {
-                        loadingRow.parentNode.remove();
-                    }
+    };
 
-                    data.logs.forEach(logLine => {
-                        if (logLine.startsWith("FOUND_INSTANCE::")) {
-                            try {
-                                const instanceData = JSON.parse(logLine.substring("FOUND_INSTANCE::".length));
-                                if (!document.querySelector(`[data-id="${instanceData.id}"]`)) {
-                                    renderInstanceRow(instanceData);
-                                }
-                            } catch (e) {
-                                log("无法解析实例数据: " + logLine, 'error');
-                            }
-                        } else {
-                            log(logLine);
-                        }
-                    });
+    const processLogLines = (lines) => {
+        const loadingRow = UI.instanceList.querySelector('td[data-loading-row="true"]');
+        if (loadingRow) {
+            loadingRow.parentNode.remove();
+        }
 
-                    if (data.logs.includes("--- 任务完成 ---")) {
-                        clearInterval(logPollingInterval);
-                        logPollingInterval = null;
-                        log("所有区域查询任务已完成。", 'success');
-                        
-                        if (UI.instanceList.rows.length === 0) {
-                            UI.instanceList.innerHTML = `<tr><td colspan="6" class="text-center text-muted">未找到实例</td></tr>`;
-                        }
+        lines.forEach(logLine => {
+            if (logLine.startsWith("FOUND_INSTANCE::")) {
+                try {
+                    const instanceData = JSON.parse(logLine.substring("FOUND_INSTANCE::".length));
+                    if (!document.querySelector(`[data-id="${instanceData.id}"]`)) {
+                        renderInstanceRow(instanceData);
                     }
+                } catch (e) {
+                    log("无法解析实例数据: " + logLine, 'error');
                 }
-            } catch (error) {
-                clearInterval(logPollingInterval);
-                logPollingInterval = null;
-                log("日志轮询失败或任务已结束。", 'error');
+            } else {
+                log(logLine);
+            }
+        });
+
+        if (lines.includes("--- 任务完成 ---")) {
+            stopLogPolling();
+            logTask = null;
+            log("所有区域查询任务已完成。", 'success');
+            
+            if (UI.instanceList.rows.length === 0) {
+                UI.instanceList.innerHTML = `<tr><td colspan="6" class="text-center text-muted">未找到实例</td></tr>`;
+            }
+        }
+    };
+
+    // 把对当前任务的一步处理排入队列，上一步完成后才执行
+    const runLogStep = (step) => {
+        const current = logTask;
+        if (!current) return;
+        current.pending++;
+        current.queue = current.queue
+            .then(() => (logTask === current ? step(current) : undefined))
+            .finally(() => { current.pending--; });
+    };
+
+    const fetchTaskLogs = async (current) => {
+        try {
+            const data = await apiCall(`/aws/api/task/${current.taskId}/logs?offset=${current.offset}`);
+            if (logTask !== current) return;
+            if (data && data.logs) {
+                if (data.next_offset !== undefined) current.offset = data.next_offset;
+                processLogLines(data.logs);
             }
+        } catch (error) {
+            stopLogPolling();
+            logTask = null;
+            log("日志轮询失败或任务已结束。", 'error');
+        }
+    };
+
+    const startLogInterval = () => {
+        if (logPollingInterval) return;
+        // 上一次读取尚未完成时跳过本轮
+        logPollingInterval = setInterval(() => {
+            if (logTask && logTask.pending === 0) runLogStep(fetchTaskLogs);
         }, 1000);
     };
+
+    const startLogPolling = (taskId) => {
+        stopLogPolling();
+        UI.instanceList.innerHTML = `<tr><td colspan="6" class="text-center" data-loading-row="true">查询中... <div class="spinner-border spinner-border-sm"></div></td></tr>`;
+        logTask = { taskId, offset: 0, pending: 0, queue: Promise.resolve() };
+        runLogStep(fetchTaskLogs);
+        if (!TaskEvents.isLive()) startLogInterval();
+    };
+
+    TaskEvents.on('aws', 'log', event => {
+        if (!logTask || event.task_id !== logTask.taskId) return;
+        runLogStep(async current => {
+            if (event.seq <= current.offset) return;
+            if (event.seq === current.offset + 1) {
+                current.offset = event.seq;
+                processLogLines([event.message]);
+            } else {
+                await fetchTaskLogs(current);
+            }
+        });
+    });
+
+    TaskEvents.onResync(() => {
+        if (!logTask) return;
+        if (TaskEvents.isLive()) {
+            stopLogPolling();
+        } else {
+            startLogInterval();
+        }
+        runLogStep(fetchTaskLogs);
+    });
     
     const setUIState = (isAwsLoggedIn) => {
         [UI.createEc2Btn, UI.createLsBtn, UI.querySelectedRegionBtn, UI.queryAllRegionsBtn, UI.regionSelector].forEach(el => el.disabled = !isAwsLoggedIn);
@@ -248,37 +248,76 @@ document.addEventListener('DOMContentLoaded', function() {
         createVmModalInstance.show();
     });
     
-    const pollTaskStatus = (taskId) => {
-        let notFoundCount = 0;
-        let lastLoggedStatus = '';
-        const interval = setInterval(async () => {
-            try {
-                const status = await apiCall(`/azure/api/task_status/${taskId}`);
-                if (status.status === 'success' || status.status === 'failure') {
-                    clearInterval(interval);
-                    log(status.result, status.status === 'success' ? 'success' : 'error');
-                    if (status.status === 'success') {
-                        setTimeout(loadVms, 5000); 
-                    }
-                } else if (status.status === 'running') {
-                    if(status.result && status.result !== lastLoggedStatus) {
-                        log(status.result, 'info');
-                        lastLoggedStatus = status.result;
-                    }
-                } else if (status.status === 'not_found') {
-                    notFoundCount++;
-                    if (notFoundCount > 3) {
-                        log(`错误：无法追踪任务 ${taskId} 的状态。`, 'error');
-                        clearInterval(interval);
-                    }
-                }
-            } catch (e) {
-                log(`查询任务状态失败: ${e.message}`, 'error');
-                clearInterval(interval);
+    // 正在跟踪的任务：推送可用时由 TaskEvents 驱动，否则共用一个定时器每 5 秒批量查询一次
+    const trackedTasks = {};
+    let taskPollTimer = null;
+
+    // 处理一次任务状态，返回是否需要继续跟踪
+    const handleTaskStatus = (taskId, status) => {
+        const tracked = trackedTasks[taskId];
+        if (!tracked) return false;
+        if (status.status === 'success' || status.status === 'failure') {
+            stopTracking(taskId);
+            log(status.result, status.status === 'success' ? 'success' : 'error');
+            if (status.status === 'success') {
+                setTimeout(loadVms, 5000); 
+            }
+            return false;
+        } else if (status.status === 'running') {
+            if(status.result && status.result !== tracked.lastLoggedStatus) {
+                log(status.result, 'info');
+                tracked.lastLoggedStatus = status.result;
             }
-        }, 5000);
+        } else if (status.status === 'not_found') {
+            tracked.notFoundCount++;
+            if (tracked.notFoundCount > 3) {
+                log(`错误：无法追踪任务 ${taskId} 的状态。`, 'error');
+                stopTracking(taskId);
+                return false;
+            }
+        }
+        return true;
     };
 
+    const stopTracking = (taskId) => {
+        delete trackedTasks[taskId];
+    };
+
+    const scheduleTaskPoll = (delay = 5000) => {
+        if (taskPollTimer) clearTimeout(taskPollTimer);
+        taskPollTimer = setTimeout(pollTrackedTasks, delay);
+    };
+
+    const pollTrackedTasks = async () => {
+        taskPollTimer = null;
+        const taskIds = Object.keys(trackedTasks);
+        if (taskIds.length === 0) return;
+        try {
+            const statuses = await apiCall('/azure/api/task_status/batch', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ task_ids: taskIds.slice(0, 200) })
+            });
+            Object.entries(statuses).forEach(([taskId, status]) => handleTaskStatus(taskId, status));
+        } catch (e) {
+            log(`查询任务状态失败: ${e.message}`, 'error');
+        }
+        if (!TaskEvents.isLive()) scheduleTaskPoll();
+    };
+
+    const pollTaskStatus = (taskId) => {
+        trackedTasks[taskId] = { notFoundCount: 0, lastLoggedStatus: '' };
+        // 已有定时器时新任务并入下一轮批量查询；推送可用时这一次查询用于补上加入跟踪前的变化
+        if (!taskPollTimer) scheduleTaskPoll();
+    };
+
+    TaskEvents.on('azure', 'task', event => handleTaskStatus(event.task_id, event));
+
+    // 推送重连时补查一次；推送不可用时补查后继续定时轮询
+    TaskEvents.onResync(() => {
+        if (Object.keys(trackedTasks).length > 0) scheduleTaskPoll(0);
+    });
+
     UI.confirmCreateVmBtn.addEventListener('click', async () => {
         try {
             const selectedIpTypeElement = document.querySelector('input[name="ipType"]:checked');
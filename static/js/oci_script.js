@@ -115,6 +115,7 @@ document.addEventListener('DOMContentLoaded', function() {
     const cloudflareDomainInput = document.getElementById('cloudflareDomain');
     const saveCloudflareConfigBtn = document.getElementById('saveCloudflareConfigBtn');
     const autoBindDomainCheck = document.getElementById('autoBindDomainCheck');
+    const capacityProbeCheck = document.getElementById('capacityProbeCheck');
 
     // ✨✨✨ 新增：X-UI 配置元素 (对应 oci.html 修改) ✨✨✨
     const xuiManagerUrlInput = document.getElementById('xuiManagerUrl');
@@ -324,6 +325,10 @@ document.addEventListener('DOMContentLoaded', function() {
                 max_delay: parseInt(document.getElementById('maxDelay').value, 10) || 90,
                 auto_bind_domain: autoBindDomainCheck.checked
             };
+            // 只有改动了默认勾选状态才提交，否则由服务器按 SNATCH_CAPACITY_PROBE 决定
+            if (capacityProbeCheck.checked !== (capacityProbeCheck.dataset.default === 'true')) {
+                details.capacity_probe = capacityProbeCheck.checked;
+            }
     
             if (shape.includes('Flex')) {
                 details.ocpus = parseInt(document.getElementById('instanceOcpus').value, 10);
@@ -563,6 +568,10 @@ document.addEventListener('DOMContentLoaded', function() {
     clearLogBtn.addEventListener('click', () => logOutput.innerHTML = '');
     clearSnatchLogBtn.addEventListener('click', () => snatchLogOutput.innerHTML = '');
 
+    function escapeHtml(text) {
+        return String(text).replace(/[&<>"']/g, c => ({ '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;' }[c]));
+    }
+
     async function apiRequest(url, options = {}) {
         try {
             const response = await fetch(url, options);
@@ -664,57 +673,106 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
-    function pollTaskStatus(taskId, isRepoll = false) {
-        if (!window.taskPollers) window.taskPollers = {};
-    
-        const poller = async () => {
-            try {
-                const apiResponse = await apiRequest(`/oci/api/task_status/${taskId}`);
-                if (!apiResponse || apiResponse.status === 'not_found') {
-                    console.warn(`Task ${taskId} not found or invalid response. Stopping poller.`);
-                    delete window.taskPollers[taskId];
-                    return;
-                }
-                const isFinalState = ['success', 'failure'].includes(apiResponse.status);
+    // 所有被跟踪的任务共用一个定时器，每轮通过批量接口一次查询全部任务状态；
+    // 推送可用时任务状态由 TaskEvents 推送，只在新任务加入或推送重连时补查一次
+    const TASK_POLL_INTERVAL = 5000;
+    const TASK_POLL_RETRY = 10000;
+    const TASK_POLL_BATCH_SIZE = 200;
+    let taskPollTimer = null;
+    let taskPollInFlight = false;
+
+    function scheduleTaskPoll(delay = TASK_POLL_INTERVAL) {
+        if (taskPollTimer) clearTimeout(taskPollTimer);
+        taskPollTimer = setTimeout(pollTrackedTasks, delay);
+    }
 
-                if (apiResponse.type === 'snatch') {
-                    handleSnatchTaskPolling(taskId, apiResponse, isFinalState, isRepoll);
-                } else {
-                    const lastLogKey = `lastLog_main_${taskId}`;
-                    if (window[lastLogKey] !== apiResponse.result) {
-                        const logType = apiResponse.status === 'success' ? 'success' : (apiResponse.status === 'failure' ? 'error' : 'info');
-                        addLog(`任务[${taskId.substring(0,8)}] ${apiResponse.result}`, logType);
-                        window[lastLogKey] = apiResponse.result;
-                    }
-                }
-    
-                if (!isFinalState) {
-                    if (apiResponse.status === 'paused') {
-                        delete window.taskPollers[taskId]; 
+    async function pollTrackedTasks() {
+        taskPollTimer = null;
+        const taskIds = Object.keys(window.taskPollers || {});
+        if (taskIds.length === 0) return;
+        if (taskPollInFlight) {
+            scheduleTaskPoll();
+            return;
+        }
+        taskPollInFlight = true;
+        try {
+            for (let i = 0; i < taskIds.length; i += TASK_POLL_BATCH_SIZE) {
+                const statuses = await apiRequest('/oci/api/task_status/batch', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ task_ids: taskIds.slice(i, i + TASK_POLL_BATCH_SIZE) })
+                });
+                Object.entries(statuses).forEach(([taskId, apiResponse]) => {
+                    const entry = window.taskPollers[taskId];
+                    if (!entry) return;
+                    if (apiResponse.status === 'not_found') {
+                        console.warn(`Task ${taskId} not found. Stopping poller.`);
+                        delete window.taskPollers[taskId];
                         return;
                     }
-                    window.taskPollers[taskId] = setTimeout(poller, 5000);
-                } else {
-                    delete window.taskPollers[taskId]; 
-                    const lastLogKey = `lastLog_main_${taskId}`;
-                    const lastSnatchLogKey = `lastSnatchLog_${taskId}`;
-                    delete window[lastLogKey];
-                    delete window[lastSnatchLogKey];
-
-                    if (apiResponse.status === 'success') {
-                        setTimeout(refreshInstances, 2000);
-                    }
-                }
-    
-            } catch (error) {
-                addLog(`监控任务 ${taskId} 时发生网络错误，将在10秒后重试...`, 'warning');
-                window.taskPollers[taskId] = setTimeout(poller, 10000); 
+                    handleTaskUpdate(taskId, apiResponse, entry.isRepoll);
+                });
             }
-        };
-        
-        poller();
+            if (!TaskEvents.isLive()) scheduleTaskPoll();
+        } catch (error) {
+            addLog(`监控任务状态时发生网络错误，将在10秒后重试...`, 'warning');
+            scheduleTaskPoll(TASK_POLL_RETRY);
+        } finally {
+            taskPollInFlight = false;
+        }
     }
 
+    function pollTaskStatus(taskId, isRepoll = false) {
+        if (!window.taskPollers) window.taskPollers = {};
+        window.taskPollers[taskId] = { isRepoll };
+        // 新任务立即查询一次，与其他任务合并为同一个批量请求
+        scheduleTaskPoll(0);
+    }
+
+    // 处理一次任务状态 (轮询结果或推送事件)，返回是否需要继续跟踪
+    function handleTaskUpdate(taskId, apiResponse, isRepoll) {
+        const isFinalState = ['success', 'failure'].includes(apiResponse.status);
+
+        if (apiResponse.type === 'snatch') {
+            handleSnatchTaskPolling(taskId, apiResponse, isFinalState, isRepoll);
+        } else {
+            const lastLogKey = `lastLog_main_${taskId}`;
+            if (window[lastLogKey] !== apiResponse.result) {
+                const logType = apiResponse.status === 'success' ? 'success' : (apiResponse.status === 'failure' ? 'error' : 'info');
+                addLog(`任务[${taskId.substring(0,8)}] ${apiResponse.result}`, logType);
+                window[lastLogKey] = apiResponse.result;
+            }
+        }
+
+        if (!isFinalState) {
+            if (apiResponse.status === 'paused') {
+                delete window.taskPollers[taskId]; 
+                return false;
+            }
+            return true;
+        }
+        delete window.taskPollers[taskId]; 
+        const lastLogKey = `lastLog_main_${taskId}`;
+        const lastSnatchLogKey = `lastSnatchLog_${taskId}`;
+        delete window[lastLogKey];
+        delete window[lastSnatchLogKey];
+
+        if (apiResponse.status === 'success') {
+            setTimeout(refreshInstances, 2000);
+        }
+        return false;
+    }
+
+    TaskEvents.on('oci', 'task', event => {
+        const entry = window.taskPollers && window.taskPollers[event.task_id];
+        if (entry) handleTaskUpdate(event.task_id, event, entry.isRepoll);
+    });
+
+    // 推送重连或不可用时，对所有跟踪中的任务补查一次 (不可用时会重新进入定时轮询)
+    TaskEvents.onResync(() => {
+        if (Object.keys(window.taskPollers || {}).length > 0) scheduleTaskPoll(0);
+    });
+
     function handleSnatchTaskPolling(taskId, apiResponse, isFinalState, isRepoll) {
         const lastLogKey = `lastSnatchLog_${taskId}`;
         let parsedResult = null;
@@ -1291,6 +1349,15 @@ document.addEventListener('DOMContentLoaded', function() {
                             ? `<div class="progress" style="height: 5px;"><div class="progress-bar bg-secondary" style="width: 100%"></div></div>`
                             : `<div class="progress" style="height: 5px;"><div class="progress-bar progress-bar-striped progress-bar-animated" style="width: 100%"></div></div>`;
                         
+                        const stageLabels = { wait_running: '等待运行', public_ip: '公网IP', firewall: '防火墙', dns: 'DNS' };
+                        const stageColors = { pending: 'secondary', retrying: 'warning text-dark', queued: 'info text-dark', done: 'success', failed: 'danger', skipped: 'light text-dark', superseded: 'light text-dark' };
+                        const pipelineString = task.result.pipeline
+                            ? '<div class="mt-1">' + Object.entries(stageLabels).map(([stage, label]) => {
+                                const state = task.result.pipeline[stage] || { status: 'pending' };
+                                return `<span class="badge bg-${stageColors[state.status] || 'secondary'} me-1" title="${escapeHtml(state.message || '')}">${label}</span>`;
+                            }).join('') + '</div>'
+                            : '';
+                        
                         const configString = `<strong>配置:</strong> ${details.shape} / ${details.ocpus || 'N/A'} OCPU / ${details.memory_in_gbs || 'N/A'} GB / ${details.boot_volume_size || 'N/A'} GB<br><strong>系统:</strong> ${details.os_name_version}`;
 
                         return `
@@ -1303,7 +1370,7 @@ document.addEventListener('DOMContentLoaded', function() {
                                         <div class="text-end">${statusBadge}</div>
                                     </div>
                                     <div class="bg-light p-2 rounded small mt-1">${configString}<br><strong>可用域:</strong> <code>${details.ad || '未知'}</code><br><strong>执行时长:</strong> ${formatElapsedTime(start_time)}</div>
-                                    <div class="mt-2">${progressBar}<p class="mb-0 mt-1 small text-info-emphasis"><strong>最新状态:</strong> ${last_message}</p></div>
+                                    <div class="mt-2">${progressBar}<p class="mb-0 mt-1 small text-info-emphasis"><strong>最新状态:</strong> ${last_message}</p>${pipelineString}</div>
                                 </div>
                             </div>
                         </li>`;
@@ -0,0 +1,85 @@
+// 任务状态推送 (SSE) 客户端。/events 由独立的推送进程 (events_server.py) 提供，连接长期保持。
+// 同一浏览器只由一个标签页 (持有 Web Lock 的标签页) 连接 /events，收到的事件通过 BroadcastChannel 转发给其他标签页。
+// 连接 (重新) 建立或服务器要求补查 (resync 事件) 时触发 onResync 回调，页面据此补查一次断线期间可能错过的状态；
+// 推送不可用时 (如未部署推送进程或未启用 Redis) isLive() 返回 false，页面继续使用定时轮询。
+window.TaskEvents = (function () {
+    const listeners = [];
+    const resyncListeners = [];
+    const channel = 'BroadcastChannel' in window ? new BroadcastChannel('cloud-manager-task-events') : null;
+    let live = false;
+    let started = false;
+
+    function dispatch(kind, data) {
+        listeners.forEach(l => {
+            if (l.kind === kind && l.provider === data.provider) l.handler(data);
+        });
+    }
+
+    // 推送状态变化 (或重连) 时通知页面补查：恢复推送时补上间隙，失去推送时恢复轮询
+    function setLive(value, force = false) {
+        if (live === value && !force) return;
+        live = value;
+        resyncListeners.forEach(cb => cb());
+    }
+
+    function connect() {
+        const source = new EventSource('/events');
+        ['task', 'log'].forEach(kind => {
+            source.addEventListener(kind, e => {
+                const data = JSON.parse(e.data);
+                dispatch(kind, data);
+                if (channel) channel.postMessage({ kind, data });
+            });
+        });
+        // 每次 (重新) 连接或推送进程重新订阅 Redis 后都补查一次，覆盖间隙中的变化
+        const resync = () => {
+            setLive(true, true);
+            if (channel) channel.postMessage({ kind: 'state', live: true });
+        };
+        source.addEventListener('open', resync);
+        source.addEventListener('resync', resync);
+        source.addEventListener('error', () => {
+            // 网络中断时 EventSource 会自动重连 (CONNECTING)，期间退回轮询；服务器返回错误时为 CLOSED，不再重连
+            setLive(false);
+            if (channel) channel.postMessage({ kind: 'state', live: false });
+        });
+        // 持有锁直到标签页关闭，其他标签页排队等待接替
+        return new Promise(() => {});
+    }
+
+    function start() {
+        if (started || !('EventSource' in window)) return;
+        started = true;
+        if (channel) {
+            channel.onmessage = e => {
+                const msg = e.data;
+                if (msg.kind === 'state') setLive(msg.live, msg.live);
+                else dispatch(msg.kind, msg.data);
+            };
+            channel.postMessage({ kind: 'hello' });
+        }
+        if (navigator.locks && channel) {
+            navigator.locks.request('cloud-manager-task-events', connect);
+            // 新打开的标签页询问当前连接状态
+            channel.addEventListener('message', e => {
+                if (e.data.kind === 'hello' && live) channel.postMessage({ kind: 'state', live: true });
+            });
+        } else {
+            connect();
+        }
+    }
+
+    return {
+        on(provider, kind, handler) {
+            listeners.push({ provider, kind, handler });
+            start();
+        },
+        onResync(cb) {
+            resyncListeners.push(cb);
+            start();
+        },
+        isLive() {
+            return live;
+        }
+    };
+})();
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+启动前容量探测测试。
+
+用 benchmarks/snatch_bench.py 中的模拟 OCI 客户端构造真实的 SnatchJob，通过 attempt()
+走完整的尝试流程 (choose_ad -> launch -> 重试排期)：三个可用性域中只有一个有容量，
+比较开启与关闭容量探测时失败的 launch 次数。
+
+在容器内运行 (需要完整依赖)：
+    docker compose exec worker python -m unittest discover -s tests
+"""
+
+import os, sys, json, uuid, random, argparse, tempfile, datetime, unittest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.snatch_bench import FakeBackend, FakeComputeClient, FakeObject
+
+ADS = [f"bench:AP-BENCH-1-AD-{i}" for i in (1, 2, 3)]
+AVAILABLE_AD = ADS[2]
+JOBS = 20
+ATTEMPTS_PER_JOB = 3
+oci_panel = None
+
+
+def setUpModule():
+    global oci_panel
+    # 与压测脚本一样在临时目录中导入，不触碰正式数据库
+    os.chdir(tempfile.mkdtemp(prefix="capacity-probe-test-"))
+    import app  # noqa: F401  先导入 app，蓝图模块依赖其中的 celery / redis_client
+    from blueprints import oci_panel as module
+    module.redis_client = None
+    oci_panel = module
+
+
+class CapacityByAdComputeClient(FakeComputeClient):
+    """只有 AVAILABLE_AD 有容量：容量报告与 launch 结果都按可用性域确定。"""
+    def create_compute_capacity_report(self, details, **kwargs):
+        status = 'AVAILABLE' if details.availability_domain == AVAILABLE_AD else 'OUT_OF_HOST_CAPACITY'
+        return self.backend.response('CreateComputeCapacityReport', FakeObject(shape_availabilities=[FakeObject(availability_status=status)]))
+
+    def launch_instance(self, launch_details, **kwargs):
+        import oci
+        from oci.exceptions import ServiceError
+        with self.backend.lock:
+            self.backend.launches += 1
+        if launch_details.availability_domain != AVAILABLE_AD:
+            raise ServiceError(500, "InternalError", {}, "Out of host capacity.")
+        instance = FakeObject(id=f"ocid1.instance.test.{uuid.uuid4().hex[:12]}", display_name=launch_details.display_name)
+        return oci.response.Response(200, {}, instance, None)
+
+
+class RecordingPostLaunch:
+    """替代置备任务：只记录被转交的任务。"""
+    def __init__(self):
+        self.task_ids = []
+
+    def delay(self, task_id, profile_config, alias, details, status_data):
+        self.task_ids.append(task_id)
+
+
+class CapacityProbeTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(42)
+        self.backend = FakeBackend(argparse.Namespace(latency_ms=0, capacity_rate=0.0, throttle_rate=0.0))
+        self.post_launch = RecordingPostLaunch()
+        self.original_post_launch = oci_panel._snatch_post_launch_task
+        oci_panel._snatch_post_launch_task = self.post_launch
+
+    def tearDown(self):
+        oci_panel._snatch_post_launch_task = self.original_post_launch
+
+    def make_job(self, capacity_probe, region, index):
+        """构造一个已在运行的抢占任务。每个任务使用独立的租户，互不共享启动令牌桶。"""
+        task_id, run_id = str(uuid.uuid4()), str(uuid.uuid4())
+        now_iso = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        status_data = {"run_id": run_id, "start_time": now_iso, "attempt_count": 0}
+        oci_panel._db_execute_celery('INSERT INTO tasks (id, type, name, status, result, created_at, account_alias) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                     (task_id, 'snatch', 'test', 'running', json.dumps(status_data), now_iso, 'test'))
+        tenancy = f"ocid1.tenancy.test.{region}.{index}"
+        details = {"shape": 'VM.Standard.A1.Flex', "ocpus": 1, "memory_in_gbs": 6, "min_delay": 1, "max_delay": 1}
+        if capacity_probe is not None:
+            details["capacity_probe"] = capacity_probe
+        base_launch_details = {"compartment_id": tenancy, "shape": details["shape"], "display_name": f"test-{index}"}
+        return oci_panel.SnatchJob(oci_panel.SnatchControlHandle(task_id, run_id), task_id,
+                                   {"tenancy": tenancy, "region": region}, 'test', details, run_id, status_data,
+                                   {"compute": CapacityByAdComputeClient(self.backend)}, ADS, base_launch_details, {})
+
+    def run_jobs(self, capacity_probe, region):
+        """每个任务最多尝试 ATTEMPTS_PER_JOB 次 (成功即结束)，返回 (launch 次数, 失败次数, 成功任务数)。"""
+        for index in range(JOBS):
+            job = self.make_job(capacity_probe, region, index)
+            for _ in range(ATTEMPTS_PER_JOB):
+                if job.attempt() is None:
+                    break
+        succeeded = len(self.post_launch.task_ids)
+        return self.backend.launches, self.backend.launches - succeeded, succeeded
+
+    def test_probe_skips_ads_without_capacity(self):
+        launches, failed, succeeded = self.run_jobs(True, "ap-test-probe-1")
+        self.assertEqual(failed, 0)
+        self.assertEqual(succeeded, JOBS)
+        self.assertEqual(launches, JOBS)
+
+    def test_probe_reduces_failed_launches(self):
+        _, failed_without_probe, _ = self.run_jobs(False, "ap-test-noprobe-1")
+        self.backend.launches = 0
+        self.post_launch.task_ids.clear()
+        _, failed_with_probe, _ = self.run_jobs(True, "ap-test-probe-2")
+        self.assertGreater(failed_without_probe, 0)
+        self.assertLess(failed_with_probe, failed_without_probe)
+
+    def test_env_default_applies_when_field_missing(self):
+        original = oci_panel.SNATCH_CAPACITY_PROBE
+        try:
+            oci_panel.SNATCH_CAPACITY_PROBE = True
+            launches, failed, succeeded = self.run_jobs(None, "ap-test-default-1")
+        finally:
+            oci_panel.SNATCH_CAPACITY_PROBE = original
+        self.assertEqual(failed, 0)
+        self.assertEqual(succeeded, JOBS)
+
+    def test_no_capacity_anywhere_skips_launch(self):
+        global AVAILABLE_AD
+        original = AVAILABLE_AD
+        try:
+            AVAILABLE_AD = "bench:AP-BENCH-1-AD-9"
+            job = self.make_job(True, "ap-test-none-1", 0)
+            delay = job.attempt()
+        finally:
+            AVAILABLE_AD = original
+        self.assertIsNotNone(delay)
+        self.assertEqual(self.backend.launches, 0)
+        self.assertIn("容量探测", job.status_data['last_message'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+抢占控制通道数据库核对测试。
+
+监听线程每次订阅成功后调用 SnatchControlRegistry._resync 核对已登记的循环，
+刚登记、任务行仍为 pending 的句柄不能被取消。
+
+在容器内运行 (需要完整依赖)：
+    docker compose exec worker python -m unittest discover -s tests
+"""
+
+import os, sys, json, uuid, tempfile, datetime, unittest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+oci_panel = None
+
+
+def setUpModule():
+    global oci_panel
+    # 在临时目录中导入，导入 app 时会在此初始化独立的数据库
+    os.chdir(tempfile.mkdtemp(prefix="snatch-control-test-"))
+    import app  # noqa: F401  先导入 app，蓝图模块依赖其中的 celery / redis_client
+    from blueprints import oci_panel as module
+    module.redis_client = None
+    oci_panel = module
+
+
+class SnatchControlResyncTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = oci_panel.SnatchControlRegistry()
+        self.task_id = str(uuid.uuid4())
+        self.run_id = str(uuid.uuid4())
+        now_iso = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        oci_panel._db_execute_celery('INSERT INTO tasks (id, type, name, status, result, created_at, account_alias) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                     (self.task_id, 'snatch', 'test', 'pending', '', now_iso, 'test'))
+
+    def mark_running(self, run_id):
+        oci_panel._db_execute_celery('UPDATE tasks SET status = ?, result = ? WHERE id = ?',
+                                     ('running', json.dumps({"run_id": run_id}), self.task_id))
+
+    def test_pending_task_survives_first_resync(self):
+        handle = self.registry.register(self.task_id, self.run_id)
+        self.registry._resync()
+        self.assertFalse(handle.cancelled)
+
+    def test_started_task_survives_resync(self):
+        handle = self.registry.register(self.task_id, self.run_id)
+        self.mark_running(self.run_id)
+        handle.started = True
+        self.registry._resync()
+        self.assertFalse(handle.cancelled)
+
+    def test_superseded_run_is_cancelled_on_resync(self):
+        handle = self.registry.register(self.task_id, self.run_id)
+        self.mark_running(str(uuid.uuid4()))
+        handle.started = True
+        self.registry._resync()
+        self.assertTrue(handle.cancelled)
+        self.assertEqual(handle.reason, 'resync')
+
+
+if __name__ == '__main__':
+    unittest.main()